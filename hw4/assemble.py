@@ -14,13 +14,13 @@ There are two approaches to "resolving" labels:
 import re
 import sys
 import json
+import struct
 from pathlib import Path
 import argparse
 import configparser
 from typing import Dict, List,  Optional, Tuple
 
 import logging
-logging.basicConfig()
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
@@ -47,6 +47,8 @@ def cli() -> object:
     parser.add_argument("source", type=argparse.FileType("r"))
     parser.add_argument("target", type=argparse.FileType("w"),
                         nargs="?", default=sys.stdout)
+    parser.add_argument("--binary", "-b", action="store_true",
+                        help="Write the binary object format instead of JSON")
     return parser.parse_args()
 
 
@@ -56,21 +58,22 @@ def cli() -> object:
 #      the second slot.
 #    - Field numbers for load and store operations
 #
-class ImportedModule:
-    """Imported module uses information from
-    json file
+class ModuleLayout:
+    """Vtable slots and field positions of a class,
+    whether read from its json file or computed by
+    the compiler.
     """
-    def __init__(self, path: Path):
-        with open(path, "r") as source:
-            self.json = json.load(source)
-        # Dict from name to position would be faster, but
-        # number of lookups is very small
-        self.methods: List[str] = self.json["methods"]
-        self.fields:  List[str] = self.json["fields"]
+    def __init__(self, methods: List[str], fields: List[str]):
+        # Ordered lists for the object code, and dicts from
+        # name to position alongside them for lookups
+        self.methods: List[str] = methods
+        self.fields:  List[str] = fields
+        self.method_slots: Dict[str, int] = slot_table(self.methods)
+        self.field_slots: Dict[str, int] = slot_table(self.fields)
 
     def method_slot(self, name: str) -> int:
-        if name in self.methods:
-            return self.methods.index(name)
+        if name in self.method_slots:
+            return self.method_slots[name]
         log.error(f"Method {name} not defined")
         return 0
 
@@ -78,11 +81,41 @@ class ImportedModule:
         return len(self.methods)
 
     def field_slot(self, name: str) -> int:
-        return self.fields.index(name)
+        return self.field_slots[name]
+
+
+class ImportedModule(ModuleLayout):
+    """Imported module uses information from
+    json file
+    """
+    def __init__(self, path: Path):
+        with open(path, "r") as source:
+            self.json = json.load(source)
+        super().__init__(self.json["methods"], self.json["fields"])
+
+
+def slot_table(names: List[str]) -> Dict[str, int]:
+    """Map each name to its first position in names,
+    the position list.index would give.
+    """
+    slots: Dict[str, int] = {}
+    for position, name in enumerate(names):
+        slots.setdefault(name, position)
+    return slots
 
 
+def add_slot(names: List[str], slots: Dict[str, int], name: str):
+    """Append name to the list and its position to the dict,
+    unless it is already there.
+    """
+    if name not in slots:
+        slots[name] = len(names)
+        names.append(name)
+
+
+# Modules read so far from json files, shared by every class
+# assembled without layouts from the compiler
 IMPORTS: Dict[str, Optional[ImportedModule]] = { "$": None }
-# $ will be replaced by current class name in output .json file
 
 
 def import_module(module: str) -> ImportedModule:
@@ -92,6 +125,12 @@ def import_module(module: str) -> ImportedModule:
     return IMPORTS[module]
 
 
+def clear_imports():
+    """Forget the imported modules, as at start up"""
+    IMPORTS.clear()
+    IMPORTS["$"] = None
+
+
 # The named literals MUST match the definitions
 # in vm_loader.h for CODE_NOTHING, etc
 # #define CODE_NOTHING  (-1)
@@ -104,6 +143,10 @@ NAMED_LITERALS = {
     "true": -3
 }
 
+# The operand of call_direct packs the class index and the method slot
+# as (class << DIRECT_CALL_SHIFT) | slot.  Must match vm_loader.h
+DIRECT_CALL_SHIFT = 16
+
 # ----------------
 #  The instruction set of the machine and the numeric
 #  encoding of instructions must be consistent between
@@ -210,14 +253,64 @@ class Instruction:
 #
 UNRESOLVED_ADDRESS = -42  # Just an easily recognized value
 
+# ----------------
+# The same information can be written in a compact binary
+# format, which the loader maps into memory and reads in place.
+# It MUST match the reader in vm_loader.c.  All numbers are
+# 32 bit little-endian words:
+#
+#   header:     "TVMO", version, n_fields, n_methods, n_inherited,
+#               n_imports, n_constants, n_code
+#   names:      class name, super name
+#   imports:    n_imports strings
+#   methods:    n_methods strings
+#   fields:     n_fields strings
+#   constants:  n_constants times kind ('i' or 's'), value string
+#   code:       n_code times method name string, slot,
+#               n_words, then the n_words code words
+#
+# A string is its length in bytes, the UTF-8 bytes, and a NUL,
+# padded with zeros to a multiple of 4 bytes so that the code
+# words stay aligned.
+#
+OBJECT_MAGIC = b"TVMO"
+OBJECT_VERSION = 1
+
+
+def pack_words(*words: int) -> bytes:
+    return struct.pack(f"<{len(words)}i", *words)
+
+
+def pack_string(text: str) -> bytes:
+    data = text.encode("utf-8")
+    padding = -(len(data) + 1) % 4
+    return pack_words(len(data)) + data + bytes(1 + padding)
+
+
+def unpack_string(data: bytes, pos: int) -> Tuple[str, int]:
+    """The string packed by pack_string at pos, and the position
+    after it."""
+    (length,) = struct.unpack_from("<i", data, pos)
+    start = pos + 4
+    return data[start:start + length].decode("utf-8"), start + length + 1 + (-(length + 1) % 4)
+
 
 class ObjectCode:
-    def __init__(self):
+    def __init__(self, layouts: Optional[Dict[str, ModuleLayout]] = None):
+        # Layouts of the classes we may refer to, if the compiler
+        # computed them; otherwise they are read from json files
+        self.layouts = layouts
+        # Classes referred to -> index in the "imports" list.
+        # $ will be replaced by current class name in output .json file
+        self.import_slots: Dict[str, int] = { "$": 0 }
         # The following are initialized in declare_class
         self.class_name: str = ""
         self.super_name: str = ""
         self.method_list: List[str] = []
         self.field_list: List[str] = []
+        # Name -> position in the lists above
+        self.method_slots: Dict[str, int] = {}
+        self.field_slots: Dict[str, int] = {}
         # Constant pool
         self.constants: List[Tuple[str, int]] = []
         # Method code (instructions)
@@ -228,6 +321,8 @@ class ObjectCode:
         self.method_code: List[dict] = []
         self.method_locals: List[str] = []
         self.method_args: List[str] = []
+        self.local_slots: Dict[str, int] = {}
+        self.arg_slots: Dict[str, int] = {}
         # Things to be resolved
         # Labels resolve to addresses within the code
         # of a method.
@@ -239,22 +334,36 @@ class ObjectCode:
     def declare_class(self, name: str, super_name: str):
         self.class_name = name
         self.super_name = super_name
-        super_module = import_module(super_name)
+        super_module = self.import_module(super_name)
         # Methods and field list are initially those
         # we inherit, but may be extended elsewhere
-        # in the assembly code
-        self.method_list = super_module.methods
+        # in the assembly code.  Copies, as the superclass
+        # may be shared with other classes
+        self.method_list = list(super_module.methods)
+        self.method_slots = dict(super_module.method_slots)
         self.n_inherited = len(super_module.methods)
-        self.field_list = super_module.fields
+        self.field_list = list(super_module.fields)
+        self.field_slots = dict(super_module.field_slots)
         # AND we need to be able to refer to this class in NEW
 
+    def import_module(self, module: str) -> Optional[ModuleLayout]:
+        """The layout of a class we refer to, adding it
+        to our imports if it is new.
+        """
+        if module not in self.import_slots:
+            self.import_slots[module] = len(self.import_slots)
+        if module == "$":
+            return None
+        if self.layouts is not None:
+            return self.layouts[module]
+        return import_module(module)
+
     def declare_field(self, name: str):
         """Add a field to objects of this class;
         do this before methods.
         """
         #assert name not in self.field_list, "Field already exists"
-        if name not in self.field_list:
-            self.field_list.append(name)
+        add_slot(self.field_list, self.field_slots, name)
 
     def declare_method(self, method_name: str):
         """If we need calls to a method before we
@@ -263,8 +372,7 @@ class ObjectCode:
         we define before (or without) calling from within
         the same class.
         """
-        if method_name not in self.method_list:
-            self.method_list.append(method_name)
+        add_slot(self.method_list, self.method_slots, method_name)
         # That's all!  We're just reserving a spot
         # in the vtable.  Bad things will happen if
         # it's not filled in later in the code.
@@ -277,11 +385,11 @@ class ObjectCode:
         # address -> unresolved label
         self.label_patch: Dict[int, str] = {}
         ###
-        if method_name not in self.method_list:
-            self.method_list.append(method_name)
-        method_slot = self.method_list.index(method_name)
+        add_slot(self.method_list, self.method_slots, method_name)
+        method_slot = self.method_slots[method_name]
         # Initialize code block
         self.method_locals = []
+        self.local_slots = {}
         self.code = []  # We will append instructions to this list
         self.method_code.append({"name": method_name, "slot": method_slot,
                                  "code": self.code})
@@ -289,10 +397,12 @@ class ObjectCode:
     def declare_locals(self, method_locals: List[str]):
         """Map local variable names to position in activation record"""
         self.method_locals = method_locals
+        self.local_slots = slot_table(method_locals)
 
     def declare_args(self, args: List[str]):
         """Map argument names to offsets *before* the frame pointer"""
         self.method_args = args
+        self.arg_slots = slot_table(args)
 
     def resolve_local(self, var: str) -> int:
         """Map local variable to position in activation record.
@@ -305,11 +415,11 @@ class ObjectCode:
         if var == "$":
             # Special case for the "this" variable
             return 0
-        if var in self.method_args:
-            arg_num = self.method_args.index(var)
+        if var in self.arg_slots:
+            arg_num = self.arg_slots[var]
             return arg_num - len(self.method_args)
-        if var in self.method_locals:
-            local_num = self.method_locals.index(var)
+        if var in self.local_slots:
+            local_num = self.local_slots[var]
             return 3 + local_num
         log.error(f"Local variable {var} not declared in this method")
         return 88   # Just a placeholder; this code should not be used!
@@ -320,26 +430,31 @@ class ObjectCode:
         try:
             if class_name == "$":
                 # This class
-                method_slot = self.method_list.index(method_name)
+                method_slot = self.method_slots[method_name]
             else:
                 # Imported class
-                module_record = import_module(class_name)
+                module_record = self.import_module(class_name)
                 method_slot = module_record.method_slot(method_name)
         except LookupError:
             log.error(f"No such method '{full_name}'")
             method_slot = 0xBAD  # 2989 decimal
         return method_slot
 
+    def resolve_direct_call(self, full_name: str) -> int:
+        """Resolve "Class:method" to the packed class index and slot number"""
+        class_name, _ = full_name.split(":")
+        return (self.resolve_class(class_name) << DIRECT_CALL_SHIFT) | self.resolve_call(full_name)
+
     def resolve_field(self, full_name: str) -> int:
         """Resolve Class:field to slot number"""
         class_name, field_name = full_name.split(":")
         try:
             if class_name == "$":
                 # This class
-                field_slot = self.field_list.index(field_name)
+                field_slot = self.field_slots[field_name]
             else:
                 # Imported class (is that legal in Quack?)
-                module_record = import_module(class_name)
+                module_record = self.import_module(class_name)
                 field_slot = module_record.field_slot(field_name)
         except LookupError:
             log.error(f"No such field '{full_name}'")
@@ -347,9 +462,8 @@ class ObjectCode:
         return field_slot
 
     def resolve_class(self, class_name: str) -> int:
-        import_module(class_name)  # In case we need to
-        index = list(IMPORTS).index(class_name)
-        return index
+        self.import_module(class_name)  # In case we need to
+        return self.import_slots[class_name]
 
     def resolve_jumps(self):
         """Patch up references to code labels"""
@@ -418,6 +532,9 @@ class ObjectCode:
         if op == "call":
             slot = self.resolve_call(operand)
             return slot
+        if op == "call_direct":
+            # The loader turns this into the method's code address
+            return self.resolve_direct_call(operand)
         if op in ["load_field", "store_field"]:
             # These operations use indexes into the fields of an object
             slot = self.resolve_field(operand)
@@ -432,7 +549,9 @@ class ObjectCode:
             # These operations have integer operands that should be
             # resolved by the compiler
             return int(operand)
-        if op in ["jump", "jump_if", "jump_ifnot"]:
+        if op in ["jump", "jump_if", "jump_ifnot",
+                  "jump_if_eq", "jump_if_ne", "jump_if_lt",
+                  "jump_if_le", "jump_if_gt", "jump_if_ge"]:
             # Operand is a label, which we may not have seen yet.
             # Leave it to be patched in the final label resolution step
             self.label_patch[len(self.code)] = operand
@@ -444,7 +563,7 @@ class ObjectCode:
         struct = {
             "class_name": self.class_name,
             "super": self.super_name,
-            "imports": [self.class_name] + list(IMPORTS)[1:],
+            "imports": [self.class_name] + list(self.import_slots)[1:],
             "methods": self.method_list,
             "fields": self.field_list,
             # It's just simpler to count fields and methods
@@ -458,6 +577,28 @@ class ObjectCode:
         }
         return json.dumps(struct, indent=4)
 
+    def binary(self) -> bytes:
+        """The object code in the binary format described above"""
+        imports = [self.class_name] + list(self.import_slots)[1:]
+        parts = [OBJECT_MAGIC,
+                 pack_words(OBJECT_VERSION, len(self.field_list),
+                            len(self.method_list), self.n_inherited,
+                            len(imports), len(self.constants),
+                            len(self.method_code)),
+                 pack_string(self.class_name),
+                 pack_string(self.super_name)]
+        parts.extend(pack_string(name) for name in imports)
+        parts.extend(pack_string(name) for name in self.method_list)
+        parts.extend(pack_string(name) for name in self.field_list)
+        for constant in self.constants:
+            parts.append(pack_words(ord(constant["kind"][0])))
+            parts.append(pack_string(constant["value"]))
+        for method in self.method_code:
+            parts.append(pack_string(method["name"]))
+            parts.append(pack_words(method["slot"], len(method["code"])))
+            parts.append(pack_words(*method["code"]))
+        return b"".join(parts)
+
     def __str__(self) -> str:
         return self.json()
 
@@ -499,6 +640,11 @@ LABEL_PAT = re.compile(r"""
    \s*
     """, re.VERBOSE)
 
+# Directives are lines beginning with ".", and the word after
+# the dot picks the one pattern to try.  Anything else is an
+# instruction, perhaps labeled, or a bare label.  So each line
+# is classified by one scan rather than by probing every pattern.
+
 # Directive:  Name this class
 CLASS_DECL_PAT = re.compile(r"""
 [.]class \s+ 
@@ -508,19 +654,12 @@ CLASS_DECL_PAT = re.compile(r"""
 
 # Directive: Name this method
 #   (Starts a new method entry in the code object)
-METHOD_DEF_PAT = re.compile(r"""
+# or, followed by "forward", declare a method to be defined
+# later in this class, so we can call it before we define it.
+METHOD_PAT = re.compile(r"""
 [.]method \s+
 (?P<method_name> [$]?\w+ )
-\s*
-""", re.VERBOSE)
-
-# Directive:  Declare a method to be defined
-# later in this class, so we can call it before
-# we define it.
-METHOD_DECL_PAT = re.compile(r"""
-[.]method \s+ 
-(?P<method_name> [$]?\w+ )
-\s+ forward
+(\s+ (?P<forward> forward))?
 \s*
 """, re.VERBOSE)
 
@@ -550,6 +689,58 @@ ARGS_DECL_PAT = re.compile(r"""
 \s*
 """, re.VERBOSE)
 
+# Directive word -> its pattern
+DIRECTIVE_PATS = {
+    "class": CLASS_DECL_PAT,
+    "method": METHOD_PAT,
+    "field": FIELD_DECL_PAT,
+    "local": LOCALS_DECL_PAT,
+    "args": ARGS_DECL_PAT
+}
+
+
+def translate_directive(code: ObjectCode, line: str) -> bool:
+    """Carry out a directive line, False if it doesn't parse"""
+    words = line[1:].split(None, 1)
+    pattern = DIRECTIVE_PATS.get(words[0]) if words else None
+    match = pattern.match(line) if pattern else None
+    if not match:
+        return False
+    kind = words[0]
+
+    if kind == "class":
+        # Class declaration (.class)
+        code.declare_class(match.group("class_name"), match.group("super_name"))
+    elif kind == "method":
+        if match.group("forward"):
+            # Method (.method f forward) to be filled in later
+            code.declare_method(match.group("method_name"))
+        else:
+            # Method (.method) followed immediately by body
+            code.begin_method(match.group("method_name"))
+    elif kind == "field":
+        # Field declaration, ".field name"
+        code.declare_field(match.group("field_name"))
+    elif kind == "local":
+        # Local variable declaration, ".local name,name,name"
+        method_locals = match.group("local_var_name").split(",")
+        n_locals = len(method_locals)
+        # Allocate space on stack for local variables
+        code.add_instruction(Instruction(
+            label=None,
+            operation=INSTRS["alloc"],
+            operand=n_locals))
+        # Now set up locals symbol table information
+        code.declare_locals(method_locals)
+    else:
+        # Argument declaration, ".args name,name,name"
+        # No space allocation needed, unlike local variables,
+        # because these are *before* (at negative offsets from)
+        # the frame pointer.
+        # Set up locals symbol table information
+        code.declare_args(match.group("arg_var_name").split(","))
+    return True
+
 
 def translate(lines: List[str]) -> ObjectCode:
     code = ObjectCode()
@@ -558,96 +749,96 @@ def translate(lines: List[str]) -> ObjectCode:
         if not line:
             continue
 
-        # Kinds of assembly language line:
-        # Class declaration (.class)
-        match = CLASS_DECL_PAT.match(line)
-        if match:
-            class_name = match.groupdict()["class_name"]
-            superclass_name = match.groupdict()["super_name"]
-            code.declare_class(class_name, superclass_name)
-            continue
-
-        # Method (.method f forward) to be filled in later
-        match = METHOD_DECL_PAT.match(line)
-        if match:
-            method_name = match.groupdict()["method_name"]
-            code.declare_method(method_name)
-            continue
-
-        # Method (.method) followed immediately by body
-        match = METHOD_DEF_PAT.match(line)
-        if match:
-            method_name = match.groupdict()["method_name"]
-            code.begin_method(method_name)
-            continue
-
-        # Field declaration, ".field name"
-        match = FIELD_DECL_PAT.match(line)
-        if match:
-            field_name = match.groupdict()["field_name"]
-            code.declare_field(field_name)
-            continue
-
-        # Local variable declaration, ".local name,name,name"
-        match = LOCALS_DECL_PAT.match(line)
-        if match:
-            locals_name_list = match.groupdict()["local_var_name"]
-            method_locals = locals_name_list.split(",")
-            n_locals = len(method_locals)
-            # Allocate space on stack for local variables
-            code.add_instruction(Instruction(
-                label=None,
-                operation=INSTRS["alloc"],
-                operand=n_locals))
-            # Now set up locals symbol table information
-            code.declare_locals(method_locals)
-            continue
-
-        # Local variable declaration, ".local name,name,name"
-        match = ARGS_DECL_PAT.match(line)
-        if match:
-            locals_name_list = match.groupdict()["arg_var_name"]
-            args = locals_name_list.split(",")
-            # No space allocation needed, unlike local variables,
-            # because these are *before* (at negative offsets from)
-            # the frame pointer.
-            # Set up locals symbol table information
-            code.declare_args(args)
+        if line[0] == ".":
+            if not translate_directive(code, line):
+                log.error(f"NO MATCH on '{line}'")
             continue
 
         # An operation (label: operation operand)
         match = INSTR_PAT.fullmatch(line)
         if match:
-            parts = match.groupdict()
-            label = parts["label"]
-            opname = parts["opname"]
-            operand = parts["operand"]
-            instruction = Instruction(label, INSTRS[opname], operand)
-            code.add_instruction(instruction)
+            label, opname, operand = match.group("label", "opname", "operand")
+            code.add_instruction(Instruction(label, INSTRS[opname], operand))
             continue
 
         # A label with no instruction
-        # An operation (label: operation operand)
         match = LABEL_PAT.match(line)
         if not match:
             log.error(f"NO MATCH on '{line}'")
             continue
-        parts = match.groupdict()
-        label = parts["label"]
-        code.add_label(label)
+        code.add_label(match.group("label"))
 
+    code.resolve_jumps()  # Of the last method entered
+    return code
 
 
+def translate_ir(clazz, layouts: Optional[Dict[str, ModuleLayout]] = None) -> ObjectCode:
+    """Translate the IR of one class (ir.ClassIR) without
+    going through assembly text.  Labels are taken from the
+    basic blocks and operands are already split out.
+    With the layouts of all classes from the compiler,
+    no json files are read, so classes can be translated
+    in any order.
+    """
+    code = ObjectCode(layouts)
+    code.declare_class(clazz.name, clazz.superclass)
+    for field_name in clazz.fields:
+        code.declare_field(field_name)
+    for method_name in clazz.forward:
+        code.declare_method(method_name)
+
+    for method in clazz.methods:
+        code.begin_method(method.name)
+        if method.locals:
+            # Allocate space on stack for local variables
+            code.add_instruction(Instruction(
+                label=None,
+                operation=INSTRS["alloc"],
+                operand=len(method.locals)))
+            code.declare_locals(method.locals)
+        if method.args:
+            code.declare_args(method.args)
+        for block in method.blocks:
+            for label in block.labels:
+                code.add_label(label)
+            for instr in block.instrs:
+                code.add_instruction(Instruction(None, INSTRS[instr.op], instr.operand))
+
     code.resolve_jumps()  # Of the last method entered
     return code
 
 
 def main():
     """Assemble one file into object code in json format"""
+    # Configured here rather than on import, so that tools
+    # importing the assembler can set up their own logging
+    logging.basicConfig()
     args = cli()
     source = [line for line in args.source]
     objcode = translate(source)
-    print(objcode.json(), file=args.target)
+    if args.binary:
+        args.target.flush()
+        args.target.buffer.write(objcode.binary())
+    else:
+        print(objcode.json(), file=args.target)
+    if args.target is not sys.stdout:
+        remove_stale(Path(args.target.name), objcode.class_name)
+
+
+def remove_stale(target: Path, class_name: str):
+    """The VM loads a .tvmo over a .json, and a program's .tvmi
+    image over both, so the other format left next to the file
+    just written would shadow it, and any image the class was
+    linked into is out of date with it.
+    """
+    # Imported here, as the linker imports the assembler
+    import link
+    stale = target.with_suffix(".json" if target.suffix == ".tvmo" else ".tvmo")
+    if stale.exists():
+        log.info(f"Removing stale {stale}")
+        stale.unlink()
+    for image in link.remove_stale_images(target.parent, [class_name]):
+        log.info(f"Removed stale image {image}, run link.py to link it again")
 
 
 if __name__ == "__main__":
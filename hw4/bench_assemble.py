@@ -0,0 +1,137 @@
+"""
+Benchmark for the text assembler. Generates a large .asm file and times assemble.translate on it, against
+translate_probing, the way translate classified lines before: trying every directive pattern on each line
+before the instruction one
+
+Run from hw4/ so the assembler finds OBJ/ through asm.conf. The generated class has a field, locals and args,
+and methods whose bodies mix labels, jumps, constants, locals, field access and calls, like compiler output
+"""
+
+import re
+import sys
+import time
+import logging
+import argparse
+
+import assemble
+
+METHOD_BODY = [
+    "\tload x",
+    "\tload $",
+    "\tload_field $:count",
+    "\tcall Int:plus",
+    "\tstore y",
+    "loop_{n}:",
+    "\tconst {n}",
+    "\tload y",
+    "\tjump_if_lt done_{n}",
+    "\tconst \"iteration {n}\\n\"",
+    "\tcall String:print",
+    "\tpop",
+    "\tload y",
+    "\tload $",
+    "\tstore_field $:count",
+    "\tjump loop_{n}",
+    "done_{n}:",
+    "\tload y  # back to the caller",
+    "\tload $",
+    "\tcall $:step",
+]
+
+
+# The forward declaration pattern translate_probing tries before METHOD_PAT, as translate used to
+METHOD_FORWARD_PAT = re.compile(r"""
+[.]method \s+
+(?P<method_name> [$]?\w+ )
+\s+ forward
+\s*
+""", re.VERBOSE)
+
+# Patterns in the order translate_probing tries them on every line
+PROBED_PATS = [assemble.CLASS_DECL_PAT, METHOD_FORWARD_PAT, assemble.METHOD_PAT, assemble.FIELD_DECL_PAT,
+               assemble.LOCALS_DECL_PAT, assemble.ARGS_DECL_PAT]
+
+
+def translate_probing(lines):
+    # assemble.translate as it was before lines were classified by their first character, as the baseline.
+    # A directive matched by a probe is then carried out by translate_directive, which makes the same object code
+    code = assemble.ObjectCode()
+    for line in lines:
+        line = assemble.strip_comments(line)
+        if not line:
+            continue
+
+        if any(pattern.match(line) for pattern in PROBED_PATS):
+            assemble.translate_directive(code, line)
+            continue
+
+        match = assemble.INSTR_PAT.fullmatch(line)
+        if match:
+            label, opname, operand = match.group("label", "opname", "operand")
+            code.add_instruction(assemble.Instruction(label, assemble.INSTRS[opname], operand))
+            continue
+
+        match = assemble.LABEL_PAT.match(line)
+        if not match:
+            assemble.log.error(f"NO MATCH on '{line}'")
+            continue
+        code.add_label(match.group("label"))
+
+    code.resolve_jumps()
+    return code
+
+
+def best_time(translate, lines, repeat):
+    # The object code and the best and all times of repeat runs of translate
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        objcode = translate(lines)
+        times.append(time.perf_counter() - start)
+        assemble.clear_imports()
+    return objcode, min(times), times
+
+
+def generate(n_lines, n_methods):
+    # The lines of a class with n_methods methods of about n_lines in total
+    lines = [".class Bench:Obj", ".field count", ".method step forward", ""]
+    per_method = n_lines // n_methods
+    for m in range(n_methods):
+        lines.extend([f".method m{m}", ".args x", ".local y", "\tenter"])
+        n = 0
+        while n * len(METHOD_BODY) < per_method:
+            lines.extend(line.format(n=n) for line in METHOD_BODY)
+            n += 1
+        lines.extend(["\tpop", "\tload $", "\treturn 1", ""])
+    lines.extend([".method step", "\tenter", "\tload $", "\treturn 0"])
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the text assembler on a generated .asm file")
+    parser.add_argument("--lines", type=int, default=1000000, help="Lines to generate. Default 1000000")
+    parser.add_argument("--methods", type=int, default=100, help="Methods to spread them over. Default 100")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs to take the best of. Default 3")
+    parser.add_argument("--save", metavar="file", default=None, help="If set, also writes the generated .asm here")
+    args = parser.parse_args()
+
+    lines = generate(args.lines, args.methods)
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            f.write("\n".join(lines))
+            f.write("\n")
+
+    assemble.log.setLevel(logging.INFO) # Its jump resolution debug lines would dominate the time
+    results = {}
+    for name, translate in [("probing", translate_probing), ("translate", assemble.translate)]:
+        objcode, best, times = best_time(translate, lines, args.repeat)
+        results[name] = (objcode.json(), best)
+        print(f"{name:>9}: assembled {len(lines)} lines in {best:.2f}s, {len(lines) / best / 1000:.0f}k lines/s "
+              f"(best of {args.repeat}: {', '.join(f'{t:.2f}' for t in times)})")
+    if results["probing"][0] != results["translate"][0]:
+        print("Object code differs between probing and translate")
+        return 1
+    print(f"Speedup over probing: {results['probing'][1] / results['translate'][1]:.2f}x")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Index over the class hierarchy for fast subtype and least common ancestor queries
+
+Built once from the class map and extended as classes are declared. Each class stores its depth
+and a binary lifting table of its 1st, 2nd, 4th, ... ancestors, so lca takes O(log depth) steps.
+Once every class is known, number_intervals() gives each class the preorder interval of its subtree,
+making is_subtype a constant time interval containment check
+"""
+
+import sys
+import logging
+import log_helper
+
+logger = logging.getLogger("class-hierarchy")
+
+ROOT = "$" # Superclass of the root classes
+
+LATTICE_TOP = "$T" # Top of the lattice
+LATTICE_BOTTOM = "$B" # Bottom of the lattice
+
+def compile_error(msg):
+    # Caught some compile-time error
+    logger.fatal(f"COMPILE ERROR: {msg}")
+    sys.exit(1)
+
+
+class ClassHierarchy:
+
+    def __init__(self, class_map=None):
+        self.superclass = {} # Class -> superclass
+        self.depth = {} # Class -> depth, root classes have depth 0
+        self.ancestors = {} # Class -> list where entry k is its 2^k-th ancestor
+        self.subclasses = {ROOT: []} # Class -> direct subclasses
+        self.order = [] # Classes in the order added, superclasses always before their subclasses
+        self.intervals = None # Class -> (enter, exit) preorder numbers, None when out of date
+
+        if class_map is not None:
+            cycle = self.add_classes({clazz: class_map[clazz]["superclass"] for clazz in class_map})
+            if cycle is not None:
+                compile_error(f"Cycle detected in the class hierarchy!")
+
+    def __contains__(self, clazz):
+        return clazz in self.depth
+
+    def add_class(self, clazz, superclass):
+        # Adds a class whose superclass is already in the hierarchy
+        if superclass != ROOT and superclass not in self.depth:
+            compile_error(f"Cannot find class {superclass}")
+
+        self.superclass[clazz] = superclass
+        self.order.append(clazz)
+        self.subclasses[clazz] = []
+        self.subclasses[superclass].append(clazz)
+        self.intervals = None
+
+        if superclass == ROOT:
+            self.depth[clazz] = 0
+            self.ancestors[clazz] = []
+            return
+
+        self.depth[clazz] = self.depth[superclass] + 1
+        ancestors = [superclass]
+        while len(ancestors) <= len(self.ancestors[ancestors[-1]]):
+            # The 2^(k+1)-th ancestor is the 2^k-th ancestor of the 2^k-th ancestor
+            ancestors.append(self.ancestors[ancestors[-1]][len(ancestors) - 1])
+        self.ancestors[clazz] = ancestors
+
+    def add_classes(self, superclasses):
+        """
+        Adds every class in superclasses, a dict of class -> superclass, adding superclasses first
+        Returns a class on a cycle in the hierarchy if there is one (leaving it and its subclasses out), otherwise None
+        """
+        for clazz in superclasses:
+            # Walk up until reaching a class already added, then add the path top down
+            path = []
+            on_path = set()
+            c = clazz
+            while c != ROOT and c not in self.depth:
+                if c in on_path:
+                    return c
+                if c not in superclasses:
+                    compile_error(f"Cannot find class {c}")
+                path.append(c)
+                on_path.add(c)
+                c = superclasses[c]
+
+            for c in reversed(path):
+                self.add_class(c, superclasses[c])
+
+        return None
+
+    def number_intervals(self):
+        # Numbers every class in preorder, so a class's subtree is the interval (enter, exit)
+        self.intervals = {}
+        counter = 0
+        stack = [(clazz, False) for clazz in reversed(self.subclasses[ROOT])]
+        while len(stack) > 0:
+            clazz, done = stack.pop()
+            if done:
+                self.intervals[clazz] = (self.intervals[clazz], counter)
+                continue
+            self.intervals[clazz] = counter
+            counter += 1
+            stack.append((clazz, True))
+            stack.extend((sub, False) for sub in reversed(self.subclasses[clazz]))
+        logger.trace(f"Numbered {counter} classes in preorder")
+
+    def ancestor_at(self, clazz, depth):
+        # Gets the ancestor of clazz (or clazz itself) at the given depth, jumping by powers of two
+        diff = self.depth[clazz] - depth
+        k = 0
+        while diff > 0:
+            if diff & 1:
+                clazz = self.ancestors[clazz][k]
+            diff >>= 1
+            k += 1
+        return clazz
+
+    def check_known(self, clazz):
+        if clazz not in self.depth:
+            compile_error(f"Cannot find class {clazz}")
+
+    def is_subtype(self, sub, sup):
+        # Checks if sub is sup or inherits from it, treating the lattice top and bottom as types
+        if sub == LATTICE_BOTTOM or sup == LATTICE_TOP:
+            return True
+        if sub == LATTICE_TOP or sup == LATTICE_BOTTOM:
+            return False
+
+        self.check_known(sub)
+        self.check_known(sup)
+
+        if self.intervals is not None:
+            sub_enter, sub_exit = self.intervals[sub]
+            sup_enter, sup_exit = self.intervals[sup]
+            return sup_enter <= sub_enter and sub_exit <= sup_exit
+
+        depth = self.depth[sup]
+        return self.depth[sub] >= depth and self.ancestor_at(sub, depth) == sup
+
+    def lca(self, clazz1, clazz2):
+        # Least common ancestor in the type lattice
+        if clazz1 == LATTICE_TOP or clazz2 == LATTICE_TOP:
+            return LATTICE_TOP
+        if clazz1 == LATTICE_BOTTOM:
+            return clazz2
+        if clazz2 == LATTICE_BOTTOM:
+            return clazz1
+
+        self.check_known(clazz1)
+        self.check_known(clazz2)
+
+        # Bring both to the same depth
+        depth = min(self.depth[clazz1], self.depth[clazz2])
+        clazz1 = self.ancestor_at(clazz1, depth)
+        clazz2 = self.ancestor_at(clazz2, depth)
+        if clazz1 == clazz2:
+            return clazz1
+
+        # Jump both up by the largest powers of two that keep them apart
+        for k in reversed(range(len(self.ancestors[clazz1]))):
+            if k < len(self.ancestors[clazz1]) and self.ancestors[clazz1][k] != self.ancestors[clazz2][k]:
+                clazz1 = self.ancestors[clazz1][k]
+                clazz2 = self.ancestors[clazz2][k]
+
+        superclass = self.superclass[clazz1]
+        if superclass == ROOT:
+            # Different root classes, return type error
+            return LATTICE_TOP
+        return superclass
+
+
+if __name__ == "__main__":
+    from default_class_map import default_class_map
+    log_helper.setup_logging("INFO")
+    h = ClassHierarchy(default_class_map)
+    h.add_classes({"A": "Obj", "B": "A", "C": "B", "D": "A", "E": "D", "F": "E"})
+    for numbered in [False, True]:
+        if numbered:
+            h.number_intervals()
+        print(f"Expect Obj, got {h.lca('Obj', 'Obj')}")
+        print(f"Expect Obj, got {h.lca('Int', 'Obj')}")
+        print(f"Expect Obj, got {h.lca('Int', 'String')}")
+        print(f"Expect A, got {h.lca('C', 'F')}")
+        print(f"Expect A, got {h.lca('F', 'B')}")
+        print(f"Expect D, got {h.lca('F', 'D')}")
+        print(f"Expect Int, got {h.lca('Int', LATTICE_BOTTOM)}")
+        print(f"Expect {LATTICE_TOP}, got {h.lca('Int', LATTICE_TOP)}")
+        print(f"Expect True, got {h.is_subtype('F', 'A')}")
+        print(f"Expect False, got {h.is_subtype('A', 'F')}")
+        print(f"Expect False, got {h.is_subtype('C', 'D')}")
+        print(f"Expect True, got {h.is_subtype(LATTICE_BOTTOM, 'Boolean')}")
+    print(f"Expect X, got {ClassHierarchy().add_classes({'X': 'Y', 'Y': 'X'})}")
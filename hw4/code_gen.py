@@ -1,20 +1,45 @@
 """
-Generates assembly code targeted at the tiny vm. Parsing is in parser.py
+Generates code targeted at the tiny vm, as the IR in ir.py. Parsing is in parser.py
 """
 
 from pathlib import Path
 
-from lark import Lark, v_args, Tree, Token
-from lark.visitors import Visitor_Recursive
 import sys
 import logging
 import log_helper
 
+import quack_ast as ast
+import ir
+import peephole
+import dce
+import devirt
+import inline
+import tailcall
+import licm
+import cse
+import liveness
 from default_class_map import default_class_map
-from type_inf import tree_type_table
 
 logger = logging.getLogger("asm-code-gen")
 
+# Int methods with their own opcode, used instead of a call when the receiver is statically an Int
+int_ops = {
+    "plus": "add",
+    "minus": "sub",
+    "times": "mul",
+    "divide": "div",
+    "negate": "neg"
+}
+
+# Int comparisons with a fused compare and jump opcode, which jumps if the comparison is true
+int_branches = {
+    "equals": "jump_if_eq",
+    "less": "jump_if_lt",
+    "more": "jump_if_gt",
+    "atleast": "jump_if_ge",
+    "atmost": "jump_if_le"
+}
+
 
 def compile_error(msg):
     # Caught some compile-time error
@@ -23,11 +48,12 @@ def compile_error(msg):
 
 
 # Walks the tree and generates the end asm
-class QuackASMGen(Visitor_Recursive):
+class QuackASMGen(ast.Visitor):
 
-    def __init__(self, main_class="Main", class_map = default_class_map, identifiers={}):
-        self.asm = {} # Stores each assembly instruction
+    def __init__(self, main_class="Main", class_map = default_class_map, identifiers={}, opt_level=0):
+        self.asm = {} # Stores the instructions of each method, class -> method -> flat instruction list
         self.main_class = main_class
+        self.opt_level = opt_level
 
         # Specifies which class and method we are in
         self.curr_class = ""
@@ -48,234 +74,141 @@ class QuackASMGen(Visitor_Recursive):
         return f"{prefix}_{num}"
 
     def infer_type(self, ident):
-        # Attempts to infer the type of this tree
-
-        if isinstance(ident, Tree):
-            # Check for default cases
-            #if ident.data == "this_ptr":
-            #    return self.curr_class
-
-            if ident.data in tree_type_table:
-                return tree_type_table[ident.data]
-
-            # Check for fields
-            elif ident.data.startswith("identifier_field"):
-                if "this" in ident.data:
-                    clazz = self.curr_class
-                    name = self.get_ident_name(ident.children[0])
-                else:
-                    clazz = self.infer_type(ident.children[0])
-                    name = self.get_ident_name(ident.children[1])
-                if clazz not in self.class_map:
-                    compile_error(f"Attempted to get field from unknown class {clazz}")
-                return self.class_map[clazz]["field_list"][name]
-
-            # Identifiers may be nested but will have a token eventually
-            elif ident.data.startswith("identifier"):
-                name = self.get_ident_name(ident.children[0])
-                return self.class_map[self.curr_class]["method_locals"][self.curr_method][name]
-
-            elif ident.data == "method_invocation":
-                # See what type the calling object is first
-                clazz = self.infer_type(ident.children[1])
-                # Look for return type of method
-                method = self.get_ident_name(ident.children[0])
-                if method not in self.class_map[clazz]["method_returns"]:
-                    compile_error(f"Attempted to get return type of unknown method {method} in ident of class {clazz}")
-                return self.class_map[clazz]["method_returns"][method]
-
-            elif ident.data == "obj_instantiation":
-                return self.get_ident_name(ident.children[0])
-            else:
-                compile_error(f"Attempted to infer type of unknown tree {ident}")
-
-        elif isinstance(ident, Token):
-            if ident.type == "INT":
-                return "Int"
-            elif ident.type == "ESCAPED_STRING":
-                return "String"
-            else:
-                compile_error(f"Attempted to infer type of unknown Token {ident}")
+        # Gets the type stored on the tree by type inference
+        # The this pointer is written as $ in the assembly, the assembler resolves it to the current class
+        if isinstance(ident, ast.ThisPtr):
+            return "$"
+        return ident.type
 
-        else:
-            compile_error(f"Attempted to infer type of unknown object {ident}")
-
-    def get_ident_name(self, ident):
-        # Gets the actual name of an identifier
-
-        if isinstance(ident, Tree):
-            # For identifiers, just recurse
-            if ident.data.startswith("identifier"):
-                if "field" in ident.data and "this" not in ident.data:
-                    return self.get_ident_name(ident.children[1])
-                return self.get_ident_name(ident.children[0]) # Recurse on only child
-            else:
-                compile_error(f"Attempted to get identifier name in unknown tree type {ident.data} {ident}")
-        elif isinstance(ident, Token):
-            return ident.value
-        else:
-            compile_error(f"Attempted to get identifier name in unrecognizable object {ident}")
-      
-    def get_asm(self):
+    def get_ir(self):
 
-        logger.trace("Writing assembly for program")
-        ret_asm = {}
+        logger.trace("Building the IR for program")
+        ret_ir = {}
 
-        # Return the ASM code in a dictionary per class
+        # Return the IR of each class
         for clazz in self.asm:
-            logger.trace(f"Writing assembly for class {clazz}")
-            class_code = []
+            logger.trace(f"Building the IR for class {clazz}")
 
-            # Add class info
+            # Class info, with methods forward declared
             superclass = self.class_map[clazz]["superclass"]
-            class_code.append(f".class {clazz}:{superclass}")
-            for field in self.class_map[clazz]["field_list"]:
-                class_code.append(f".field {field}")
-
-            # Forward declare methods
-            for method in self.class_map[clazz]["method_arg_names"]:
-                if method != "$constructor":
-                    class_code.append(f".method {method} forward")
+            fields = self.class_map[clazz]["field_list"]
+            forward = [method for method in self.class_map[clazz]["method_arg_names"] if method != "$constructor"]
+            class_ir = ir.ClassIR(clazz, superclass, fields, forward)
 
-            # Add method
             for method in self.asm[clazz]: # Only generate those which we have code for
-                logger.trace(f"Writing assembly for method {method} in class {clazz}")
-                class_code.append("")
-                class_code.append(f".method {method}")
+                logger.trace(f"Building the IR for method {method} in class {clazz}")
 
-                # Add method args and class code
+                # Method args and locals
                 method_args = self.class_map[clazz]["method_arg_names"][method]
                 local_vars = []
                 if method in self.class_map[clazz]["method_locals"]:
                     local_vars = [x for x in self.class_map[clazz]["method_locals"][method] if x not in method_args]
-                if len(method_args) > 0:
-                    class_code.append(f".args {','.join(method_args)}")
-                if len(local_vars) > 0:
-                    class_code.append(f".local {','.join(local_vars)}")
-
-                # Generate method code
-                for line in self.asm[clazz][method]:
-                    if line.startswith(".label"):
-                        class_code.append(line[7:] + ":")
-                    else:
-                        class_code.append("\t" + line)
-
-            ret_asm[clazz] = class_code
-
-        logger.trace("Generated assembly for program")
-        logger.trace(ret_asm)
-        return ret_asm
-
-    def add_asm(self, line):
-        # Adds a line of assembly to the output
-        logger.debug("Generated assembly: " + line)
-        code = self.asm[self.curr_class][self.curr_method]
-        code.append(line)
-        self.asm[self.curr_class][self.curr_method] = code
+
+                # Split the method code into basic blocks
+                class_ir.methods.append(ir.MethodIR(method, method_args, local_vars, self.asm[clazz][method]))
+
+            ret_ir[clazz] = class_ir
+
+        logger.trace("Built the IR for program")
+        return ret_ir
+
+    def add_asm(self, op, operand=None):
+        # Adds an instruction to the output
+        instr = ir.Instr(op, operand)
+        logger.debug(f"Generated instruction: {instr}")
+        self.asm[self.curr_class][self.curr_method].append(instr)
+
+    def add_label(self, name):
+        # Adds a label to the output, it names the next instruction
+        logger.debug(f"Generated label: {name}")
+        self.asm[self.curr_class][self.curr_method].append(ir.label(name))
+
+    def branch(self, cond, op, label):
+        # Generates the condition and a jump_if or jump_ifnot to the label
+        # An Int comparison is fused with the jump, so no Boolean is made
+        if (self.opt_level >= 1 and isinstance(cond, ast.MethodInvocation) and cond.method in int_branches
+                and cond.receiver.type == "Int" and cond.args[0].type == "Int"):
+            self.visit_all(cond.args)
+            self.visit(cond.receiver)
+            fused = int_branches[cond.method]
+            self.add_asm(fused if op == "jump_if" else ir.INVERSE[fused], label)
+        else:
+            self.visit(cond)
+            self.add_asm(op, label)
 
     def program(self, tree):
         logger.trace(f"Processed program: {tree}")
 
     def identifier(self, tree):
-        logger.trace(f"Processed identifier: {tree}")
-
-    def identifier_rhand(self, tree):
-        logger.debug(f"Processed identifier_rhand: {tree}")
-        ident = self.get_ident_name(tree.children[0])
-        self.add_asm("load " + ident)
-
-    def identifier_lhand(self, tree):
-        logger.trace(f"Processed identifier_lhand: {tree}")
-
-    def identifier_field_rhand_this(self, tree):
-        logger.debug(f"Processed identifier_field_rhand_this: {tree}")
-        ident = self.get_ident_name(tree.children[0])
-        self.add_asm(f"load $")
-        self.add_asm(f"load_field $:{ident}")
-
-    def identifier_field_lhand_this(self, tree):
-        logger.debug(f"Processed identifier_field_lhand_this: {tree}")
-        ident = self.get_ident_name(tree.children[0])
-        self.add_asm(f"load $")
-        self.add_asm(f"store_field $:{ident}")
-
-    def identifier_field_rhand(self, tree):
-        logger.debug(f"Processed identifier_field_rhand: {tree}")
-        ident = self.get_ident_name(tree.children[1])
-        # Calling object shjould already be on the stack
-        clazz = self.infer_type(tree.children[0])
-        self.add_asm(f"load_field {clazz}:{ident}")
+        logger.debug(f"Processed identifier: {tree}")
+        self.add_asm("load", tree.name)
+
+    def field(self, tree):
+        logger.debug(f"Processed field: {tree}")
+        # Calling object should already be on the stack
+        clazz = self.infer_type(tree.obj)
+        self.add_asm("load_field", f"{clazz}:{tree.name}")
 
     def statement(self, tree):
         logger.trace(f"Processed statement: {tree}")
 
-    def identifier_field_lhand(self, tree):
-        logger.debug(f"Processed identifier_field_lhand: {tree}")
-        ident = self.get_ident_name(tree.children[1])
-        # Calling object shjould already be on the stack
-        clazz = self.infer_type(tree.children[0])
-        self.add_asm(f"store_field {clazz}:{ident}")
-
     def assignment(self, tree):
         logger.debug(f"Processed assignment: {tree}")
 
-        # Identifier for local variable (without field)
-        if "field" not in tree.children[0].data:
-            ident = self.get_ident_name(tree.children[0])
-            self.add_asm("store " + ident)
+        if isinstance(tree.target, ast.Field):
+            # Calling object should already be on the stack
+            clazz = self.infer_type(tree.target.obj)
+            self.add_asm("store_field", f"{clazz}:{tree.target.name}")
+        else:
+            # Identifier for local variable (without field)
+            self.add_asm("store", tree.target.name)
 
     def obj_instantiation(self, tree):
         logger.debug(f"Processed obj_instantiation: {tree}")
 
-        clazz = self.get_ident_name(tree.children[0])
-        self.add_asm(f"new {clazz}")
-        self.add_asm(f"call {clazz}:$constructor")
+        clazz = tree.class_name
+        self.add_asm("new", clazz)
+        self.add_asm("call", f"{clazz}:$constructor")
 
     def string_literal(self, tree):
         logger.debug(f"Processed string literal: {tree}")
-        self.add_asm("const " + tree.children[0].value)
+        self.add_asm("const", tree.value)
 
     def int_literal(self, tree):
         logger.debug(f"Processed int literal: {tree}")
-        self.add_asm("const " + str(tree.children[0].value))
-
-    def boolean_literal_true(self, tree):
-        logger.debug(f"Processed boolean literal: {tree}")
-        self.add_asm("const true")
+        self.add_asm("const", tree.value)
 
-    def boolean_literal_false(self, tree):
+    def boolean_literal(self, tree):
         logger.debug(f"Processed boolean literal: {tree}")
-        self.add_asm("const false")
+        self.add_asm("const", "true" if tree.value else "false")
     
     def nothing_literal(self, tree):
         logger.debug(f"Processed nothing literal: {tree}")
-        self.add_asm("const none")
+        self.add_asm("const", "none")
 
     def this_ptr(self, tree):
         logger.debug(f"Processed this pointer: {tree}")
-        self.add_asm("load $")
+        self.add_asm("load", "$")
 
     def method_invocation(self, tree):
         logger.debug(f"Processed method invocation: {tree}")
-        clazz = self.infer_type(tree.children[1]) # Get object class
-        ident = self.get_ident_name(tree.children[0]) # Get method name
+        clazz = self.infer_type(tree.receiver) # Get object class
+        ident = tree.method # Get method name
         
-        self.add_asm(f"call {clazz}:{ident}")
+        if self.opt_level >= 1 and clazz == "Int" and ident in int_ops:
+            # Int arithmetic has opcodes that skip the method call
+            self.add_asm(int_ops[ident])
+        else:
+            self.add_asm("call", f"{clazz}:{ident}")
         
         # Pop the nothings
-        if clazz == "$":
-            clazz = self.curr_class
-        ret_type = self.class_map[clazz]["method_returns"][ident]
-        if ret_type == "Nothing":
+        if tree.type == "Nothing":
             self.add_asm("pop")
 
-    def method_args(self, tree):
-        logger.trace(f"Processed method args: {tree}")
-
     def return_statement(self, tree):
         logger.trace(f"Processed return_statement: {tree}")
         args = self.class_map[self.curr_class]["method_args"][self.curr_method]
-        self.add_asm(f"return {len(args)}")
+        self.add_asm("return", str(len(args)))
 
     def cond_and(self, tree):
         # Needs a label to use skip over. See if there's an active label
@@ -283,17 +216,14 @@ class QuackASMGen(Visitor_Recursive):
         label = self.sc_false if self.sc_false else self.gen_label("and")
         logger.trace(f"Processed cond_and with label {label}: {tree}")
         
-        # Visit first child
-        self.visit(tree.children[0])
-
-        # Jump if this is false
-        self.add_asm(f"jump_ifnot {label}")
+        # Visit first child, and jump if it is false
+        self.branch(tree.left, "jump_ifnot", label)
 
         # Visit second child
-        self.visit(tree.children[1])
+        self.visit(tree.right)
 
         # Add label
-        self.add_asm(f".label {label}")
+        self.add_label(label)
 
     def cond_or(self, tree):
         # Needs a label to use skip over. See if there's an active label
@@ -301,17 +231,14 @@ class QuackASMGen(Visitor_Recursive):
         label = self.sc_true if self.sc_true else self.gen_label("or")
         logger.trace(f"Processed cond_or with label {label}: {tree}")
         
-        # Visit first child
-        self.visit(tree.children[0])
-
-        # Jump if this is true
-        self.add_asm(f"jump_if {label}")
+        # Visit first child, and jump if it is true
+        self.branch(tree.left, "jump_if", label)
 
         # Visit second child
-        self.visit(tree.children[1])
+        self.visit(tree.right)
 
         # Add label
-        self.add_asm(f".label {label}")
+        self.add_label(label)
 
     def cond_not(self, tree):
         logger.trace(f"Processed cond_not: {tree}")
@@ -320,17 +247,17 @@ class QuackASMGen(Visitor_Recursive):
             logger.trace("cond_not in condition, swapping two branches")
             self.sc_true, self.sc_false = self.sc_false, self.sc_true
             # Now visit child
-            self.visit(tree.children[0])
+            self.visit(tree.expr)
         else:
             # Need to generate inversion logic. Wrote native method for this :)
             logger.trace("cond_not not in condition, calling native Boolean:negate")
-            self.visit(tree.children[0])
-            self.add_asm("call Boolean:negate")
+            self.visit(tree.expr)
+            self.add_asm("call", "Boolean:negate")
 
     def if_structure(self, tree):
         logger.trace(f"Processed if_structure: {tree}")
 
-        if len(tree.children) == 2: # No else clause
+        if tree.else_body is None: # No else clause
             # First generate two labels
             branch1 = self.gen_label("ifbranch1")
             self.sc_true = branch1
@@ -338,15 +265,14 @@ class QuackASMGen(Visitor_Recursive):
             self.sc_false = endif
 
             # Now generate the conditional
-            self.visit(tree.children[0])
-            self.add_asm(f"jump_ifnot {endif}")
+            self.branch(tree.cond, "jump_ifnot", endif)
 
             # Now generate the first branch
-            self.add_asm(f".label {branch1}")
-            self.visit(tree.children[1])
+            self.add_label(branch1)
+            self.visit_all(tree.then_body)
 
             # Now add the end of if
-            self.add_asm(f".label {endif}")
+            self.add_label(endif)
 
         else: # Else clause present
 
@@ -358,20 +284,19 @@ class QuackASMGen(Visitor_Recursive):
             endif = self.gen_label("ifend")
 
             # Now generate the conditional
-            self.visit(tree.children[0])
-            self.add_asm(f"jump_ifnot {branch2}")
+            self.branch(tree.cond, "jump_ifnot", branch2)
 
             # Now generate the first branch
-            self.add_asm(f".label {branch1}")
-            self.visit(tree.children[1])
-            self.add_asm(f"jump {endif}")
+            self.add_label(branch1)
+            self.visit_all(tree.then_body)
+            self.add_asm("jump", endif)
 
             # Now generate the second branch
-            self.add_asm(f".label {branch2}")
-            self.visit(tree.children[2])
+            self.add_label(branch2)
+            self.visit_all(tree.else_body)
 
             # Now add the end of if
-            self.add_asm(f".label {endif}")
+            self.add_label(endif)
 
         # Finally, reset the short circuit branches
         self.sc_true = None
@@ -388,19 +313,18 @@ class QuackASMGen(Visitor_Recursive):
         cond = self.gen_label("whilecond")
 
         # First jump to condition
-        self.add_asm(f"jump {cond}")
+        self.add_asm("jump", cond)
 
         # Now generate the loop
-        self.add_asm(f".label {loop}")
-        self.visit(tree.children[1])
+        self.add_label(loop)
+        self.visit_all(tree.body)
 
         # Now generate the test condition
-        self.add_asm(f".label {cond}")
-        self.visit(tree.children[0])
-        self.add_asm(f"jump_if {loop}")
+        self.add_label(cond)
+        self.branch(tree.cond, "jump_if", loop)
 
         # Now add the end of while
-        self.add_asm(f".label {endwhile}")
+        self.add_label(endwhile)
 
         # Finally, reset the short circuit branches
         self.sc_true = None
@@ -410,96 +334,95 @@ class QuackASMGen(Visitor_Recursive):
         logger.trace(f"Processed clazz: {tree}")
 
         # First set current class
-        self.curr_class = self.get_ident_name(tree.children[0])
+        self.curr_class = tree.name
         self.asm[self.curr_class] = {}
 
-        # Now visit third child, which is class body
-        self.visit(tree.children[2])
+        # Now visit the class body
+        self.visit_all(tree.methods)
 
     def class_method(self, tree):
         logger.trace(f"Processed method: {tree}")
 
         # First set current method
-        self.curr_method = self.get_ident_name(tree.children[0])
+        self.curr_method = tree.name
         self.asm[self.curr_class][self.curr_method] = []
 
         self.add_asm("enter")
 
-        # Now visit body (fourth child)
-        self.visit(tree.children[3])
+        # Now visit body
+        self.visit_all(tree.body)
 
     def typecase_statement(self, tree):
         logger.trace(f"Processed method: {tree}")
 
         # Since we only compute the expression once, store to dummy variable
-        self.visit(tree.children[0])
-        self.add_asm("store __typecase_var")
+        self.visit(tree.expr)
+        self.add_asm("store", "__typecase_var")
 
         # For each branch, generate labels to jump to them and then jump out
         end = self.gen_label("typecaseend")
-        for child in tree.children[1:]:
+        for child in tree.alts:
             type_label = self.gen_label("typecase")
 
             # What I should do is desugar the tree to change the type specific
             # variable name to be the same on all branches since it will always
             # be the same object. However, I am lazy so I will just generate a
             # ton of code instead to copy into the variable
-            ident = self.get_ident_name(child.children[0])
-            clazz = self.get_ident_name(child.children[1])
-            self.add_asm("load __typecase_var")
-            self.add_asm(f"store {ident}")
-            self.add_asm("load __typecase_var")
-            self.add_asm(f"is_instance {clazz}")
-            self.add_asm(f"jump_ifnot {type_label}")
+            ident = child.name
+            clazz = child.type_name
+            self.add_asm("load", "__typecase_var")
+            self.add_asm("store", ident)
+            self.add_asm("load", "__typecase_var")
+            self.add_asm("is_instance", clazz)
+            self.add_asm("jump_ifnot", type_label)
 
             # Generate the branch code
             self.visit(child)
-            self.add_asm(f"jump {end}")
+            self.add_asm("jump", end)
 
             # Generate the skip
-            self.add_asm(f".label {type_label}")
+            self.add_label(type_label)
         
         # Finally, generate the last label
-        self.add_asm(f".label {end}")
+        self.add_label(end)
 
 
     def visit(self, tree):
 
-        if not isinstance(tree, Tree):
-            return tree
-
         # For specific trees, need to visit them in special order
-        if tree.data == "assignment":
+        if isinstance(tree, ast.Assignment):
             # Want to visit rhand before lhand to put rhand on the stack first
             logger.trace("Processing assignment, using custom traversal")
-            self.visit(tree.children[1])
-            self.visit(tree.children[0])
+            self.visit(tree.value)
+            if isinstance(tree.target, ast.Field):
+                # Then the object whose field we store into
+                self.visit(tree.target.obj)
             self._call_userfunc(tree)
 
-        elif tree.data == "method_invocation":
-            # Want to visit method args in reverse order to put calling object on stack last
+        elif isinstance(tree, ast.MethodInvocation):
+            # Want to visit method args first to put calling object on stack last
             logger.trace("Processing method_invocation, using custom traversal")
-            for child in reversed(tree.children):
-                self.visit(child)
+            self.visit_all(tree.args)
+            self.visit(tree.receiver)
             self._call_userfunc(tree)
 
-        elif tree.data == "if_structure" or tree.data == "while_structure":
+        elif isinstance(tree, (ast.IfStatement, ast.WhileStatement)):
             # Let control structures handle themselves, do not visit children
             self._call_userfunc(tree)
 
-        elif tree.data.startswith("cond"):
+        elif isinstance(tree, (ast.CondAnd, ast.CondOr, ast.CondNot)):
             # and/or/not (has short circuit logic). Do not visit children, let method handle it
             self._call_userfunc(tree)
 
-        elif tree.data == "clazz":
+        elif isinstance(tree, ast.Clazz):
             # Let class handle itself
             self._call_userfunc(tree)
 
-        elif tree.data == "class_method":
+        elif isinstance(tree, ast.ClassMethod):
             # Let method handle itself
             self._call_userfunc(tree)
 
-        elif tree.data == "typecase_statement":
+        elif isinstance(tree, ast.TypecaseStatement):
             # Let typecase handle itself
             self._call_userfunc(tree)
 
@@ -509,12 +432,31 @@ class QuackASMGen(Visitor_Recursive):
 
         return tree
 
-def gen_asm_code(tree, main_class, idents):
+def gen_asm_code(tree, main_class, idents, opt_level=0, inline_limit=0):
     logger.trace("Attempting to construct the code generator")
-    quack_gen = QuackASMGen(main_class=main_class, identifiers=idents)
+    quack_gen = QuackASMGen(main_class=main_class, identifiers=idents, opt_level=opt_level)
     logger.debug("Attempting to walk the tree to generate ASM")
     quack_gen.visit(tree)
-    logger.debug("Attempting to generate the final asm")
-    asm = quack_gen.get_asm()
-    logger.debug("Successfully generated asm code")
-    return asm
+    if opt_level >= 1:
+        logger.debug("Attempting to run the peephole optimizer on each method")
+        peephole.optimize(quack_gen.asm)
+    logger.debug("Attempting to build the IR")
+    program_ir = quack_gen.get_ir()
+    logger.debug("Successfully built the IR")
+    if opt_level >= 1:
+        logger.debug("Attempting to devirtualize calls")
+        devirt.devirtualize_all(program_ir, idents)
+        logger.debug("Attempting to eliminate self tail calls")
+        tailcall.eliminate_all(program_ir)
+        if inline_limit > 0:
+            logger.debug("Attempting to inline small methods")
+            inline.inline_all(program_ir, inline_limit)
+        logger.debug("Attempting to hoist loop invariant code")
+        licm.move_all(program_ir, idents)
+        logger.debug("Attempting to eliminate common subexpressions")
+        cse.eliminate_all(program_ir, idents)
+        logger.debug("Attempting to eliminate dead code")
+        dce.eliminate_all(program_ir)
+        logger.debug("Attempting to share local slots")
+        liveness.share_all(program_ir)
+    return program_ir
@@ -15,6 +15,10 @@ if __name__ == "__main__":
     cliparser.add_argument("--main-class", "-m", metavar="clazz", default=None, help="Specifies the main class name. Default inferred from source filename")
     cliparser.add_argument("--output-dir", "-o", metavar="file", default=None, help="Specifies the output file directory. Default out/")
     cliparser.add_argument("--obj-dir", "-j", metavar="file", default=None, help="Specifies the output file directory for OBJ files. Default OBJ/")
+    cliparser.add_argument("-O", dest="opt_level", metavar="level", type=int, default=0, help="Specifies the optimization level. 0 disables optimizations. Default 0")
+    cliparser.add_argument("--inline-limit", metavar="words", type=int, default=16, help="Specifies the largest method body, in code words, inlined at -O 1 and up. Default 16")
+    cliparser.add_argument("--no-inline", action="store_true", help="If set, disables inlining, e.g. for debugging")
+    cliparser.add_argument("--no-binary", action="store_true", help="If set, writes only the JSON object files, not the binary .tvmo ones the VM loads faster")
     cliparser.add_argument("--png", "-p", metavar="filename", default=None, help="If set, visualizes the parsed tree as a PNG stored at given filename")
     cliparser.add_argument("source", metavar="<source>", help="The source program file")
     args = cliparser.parse_args()
@@ -32,6 +36,9 @@ if __name__ == "__main__":
     import ident_usage
     import type_inf
     import manual_checks
+    import const_fold
+    import layout
+    import link
     
     # Read entire program into memory
     prgm_file = args.source
@@ -56,22 +63,32 @@ if __name__ == "__main__":
     png_file = args.png
     if png_file:
         logger.debug("Attempting to save the tree as a PNG")
-        parser.visualize(tree, png_file)
+        parser.visualize(parser.parse_tree(prgm_text, main_class=main_class), png_file)
         logger.info(f"Successfully saved tree to file {png_file}")
 
     # Static semantic checks
     logger.debug("Attempting to check identifier declaration vs usage")
     ident_usage.check(tree) # Check tree declares identifiers before using them
+    logger.debug("Attempting to check the class hierarchy")
+    hierarchy = manual_checks.check_hierarchy(tree) # Also sorts classes so superclasses come first
     logger.debug("Attempting to perform type inferencing on declarations")
-    inferred_types = type_inf.infer(tree) # Perform type inferencing
+    inferred_types = type_inf.infer(tree, hierarchy) # Perform type inferencing
     logger.debug("Attempting to perform final tree and class hierarchy checks")
-    manual_checks.check(tree, inferred_types)
+    manual_checks.check(tree, inferred_types, hierarchy)
     logger.info("Successfully performed static semantic checks on tree")
 
-    # Generate the assembly
-    logger.debug("Attempting to generate the assembly with main class name " + main_class)
-    asm_output = code_gen.gen_asm_code(tree, main_class, inferred_types)
-    logger.info("Successfully generated the assembly code")
+    # Optimize the tree
+    opt_level = args.opt_level
+    if opt_level >= 1:
+        logger.debug("Attempting to fold constants")
+        const_fold.fold(tree)
+        logger.info("Successfully folded constants")
+
+    # Generate the IR
+    logger.debug("Attempting to generate the IR with main class name " + main_class)
+    inline_limit = 0 if args.no_inline else args.inline_limit
+    program_ir = code_gen.gen_asm_code(tree, main_class, inferred_types, opt_level, inline_limit)
+    logger.info("Successfully generated the IR")
 
     output_dir = args.output_dir
     if output_dir == None:
@@ -81,20 +98,23 @@ if __name__ == "__main__":
     if obj_dir == None:
         obj_dir = "OBJ"
 
+    # Vtable slots and field positions of every class, so each class assembles on its own
+    layouts = layout.compute_layouts(program_ir)
+
     # Output the assembly and object code
-    for clazz in asm_output:
+    for clazz in program_ir:
         output_file = f"{output_dir}/{clazz}.asm"
         logger.debug("Attempting to output assembly code to file " + output_file)
         os.makedirs(os.path.dirname(output_file), exist_ok=True) # Make subdirectories
         with open(output_file, "w") as f:
-            for line in asm_output[clazz]:
+            for line in program_ir[clazz].dump():
                 f.write(line)
                 f.write("\n")
         logger.info("Successfully written assembly to file " + output_file)
 
-        # Generate the object code
+        # Generate the object code straight from the IR
         logger.debug(f"Attempting to generate object code for {clazz}")
-        obj = assemble.translate(asm_output[clazz])
+        obj = assemble.translate_ir(program_ir[clazz], layouts)
         logger.debug(f"Successfully generated object code for {clazz}")
 
         output_file = f"{obj_dir}/{clazz}.json"
@@ -103,8 +123,22 @@ if __name__ == "__main__":
         with open(output_file, "w") as f:
             f.write(obj.json())
 
-        os.sync() # Fixes race condition bugs with assembler loading
+        # The VM loads the binary object file over the JSON one, so don't leave a stale one behind
+        binary_file = f"{obj_dir}/{clazz}.tvmo"
+        if args.no_binary:
+            if os.path.exists(binary_file):
+                os.remove(binary_file)
+        else:
+            logger.debug("Attempting to output binary object code to file " + binary_file)
+            with open(binary_file, "wb") as f:
+                f.write(obj.binary())
+
         logger.info("Successfully written object code to file " + output_file)
 
+    # Prelinked images of any program using these classes are out of date now, and the VM would prefer them
+    # over the new object files
+    for image_file in link.remove_stale_images(obj_dir, program_ir.keys()):
+        logger.info("Removed stale image " + image_file + ", run link.py to link the program again")
+
     logger.info("Compilation success")
 
@@ -0,0 +1,167 @@
+"""
+Constant folding and algebraic simplification on the typed tree. Runs after type inference
+
+Folds Int arithmetic and comparisons on literals, String literal concatenation and not on Boolean literals,
+and drops identities like x * 1 and x + 0 when x is statically an Int
+"""
+
+import logging
+import log_helper
+
+import quack_ast as ast
+
+logger = logging.getLogger("const-fold")
+
+# Range of the VM's Int, results outside it are left for the VM to compute. INT_MIN itself is left too, as it
+# would be the negation of the literal 2147483648, which does not fit in an Int
+INT_MIN = -2**31
+INT_MAX = 2**31 - 1
+
+def int_divide(a, b):
+    # Division rounding towards zero like C
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+# Int methods folded when both operands are literals. Returns None if the result can't be folded
+int_folds = {
+    "plus": lambda a, b: a + b,
+    "minus": lambda a, b: a - b,
+    "times": lambda a, b: a * b,
+    "divide": lambda a, b: int_divide(a, b) if b != 0 else None,
+    "equals": lambda a, b: a == b,
+    "less": lambda a, b: a < b,
+    "more": lambda a, b: a > b,
+    "atleast": lambda a, b: a >= b,
+    "atmost": lambda a, b: a <= b
+}
+
+# Int methods with an identity operand, and which side it may be on
+int_identities = {
+    "plus": (0, True), # x + 0 and 0 + x
+    "minus": (0, False), # Only x - 0
+    "times": (1, True), # x * 1 and 1 * x
+    "divide": (1, False) # Only x / 1
+}
+
+
+def typed(node, clazz):
+    # Sets the static type on a node made by this pass
+    node.type = clazz
+    return node
+
+def int_node(value):
+    # Makes the tree for an Int constant. The assembler only takes non negative literals,
+    # so negative constants are the negation of a literal
+    if value >= 0:
+        return typed(ast.IntLiteral(str(value)), "Int")
+    return typed(ast.MethodInvocation("negate", int_node(-value), []), "Int")
+
+def int_value(node):
+    # Gets the value of an Int constant tree, or None if the tree is not constant
+    if isinstance(node, ast.IntLiteral):
+        return int(node.value)
+    if isinstance(node, ast.MethodInvocation) and node.method == "negate" and isinstance(node.receiver, ast.IntLiteral):
+        return -int(node.receiver.value)
+    return None
+
+
+class ConstantFolder(ast.Visitor):
+    # Rewrites the tree bottom up. Handlers return the node to replace the visited node with
+
+    def __init__(self):
+        self.folded = 0 # Number of folds and simplifications made
+
+    def method_invocation(self, tree):
+        receiver = tree.receiver
+        if tree.method == "negate":
+            value = int_value(receiver)
+            if value is not None and isinstance(receiver, ast.MethodInvocation):
+                # Double negation of a literal
+                self.folded += 1
+                return int_node(-value)
+            return tree
+
+        if len(tree.args) != 1:
+            return tree
+        arg = tree.args[0]
+
+        if receiver.type == "Int" and tree.method in int_folds:
+            a = int_value(receiver)
+            b = int_value(arg)
+            if a is not None and b is not None:
+                result = int_folds[tree.method](a, b)
+                if isinstance(result, bool):
+                    self.folded += 1
+                    return typed(ast.BooleanLiteral(result), "Boolean")
+                if result is not None and INT_MIN < result <= INT_MAX:
+                    self.folded += 1
+                    return int_node(result)
+                return tree
+
+        if receiver.type == "Int" and arg.type == "Int" and tree.method in int_identities:
+            identity, commutes = int_identities[tree.method]
+            if int_value(arg) == identity:
+                self.folded += 1
+                return receiver
+            if commutes and int_value(receiver) == identity:
+                self.folded += 1
+                return arg
+
+        if tree.method == "plus" and isinstance(receiver, ast.StringLiteral) and isinstance(arg, ast.StringLiteral):
+            # Both are escaped and double quoted, so join the insides
+            self.folded += 1
+            return typed(ast.StringLiteral(receiver.value[:-1] + arg.value[1:]), "String")
+
+        return tree
+
+    def cond_not(self, tree):
+        if isinstance(tree.expr, ast.BooleanLiteral):
+            self.folded += 1
+            return typed(ast.BooleanLiteral(not tree.expr.value), "Boolean")
+        return tree
+
+    def visit(self, tree):
+        # Replace each child with its folded form, then fold this node
+        for name in tree.child_fields:
+            child = getattr(tree, name)
+            if isinstance(child, list):
+                setattr(tree, name, [self.visit(node) for node in child])
+            elif child is not None:
+                setattr(tree, name, self.visit(child))
+
+        handler = self.get_handler(tree)
+        if handler is not None:
+            return handler(self, tree)
+        return tree
+
+
+def fold(tree):
+    # Folds constants in the tree in place
+    logger.trace("Attempting to fold constants")
+    folder = ConstantFolder()
+    folder.visit(tree)
+    logger.debug(f"Folded {folder.folded} constant expressions")
+    return tree
+
+
+if __name__ == "__main__":
+    log_helper.setup_logging("INFO")
+
+    def lit(value):
+        return int_node(value)
+
+    def call(method, receiver, arg):
+        return typed(ast.MethodInvocation(method, receiver, [arg]), "Int")
+
+    x = typed(ast.Identifier("x"), "Int")
+    print(f"Expect 6, got {int_value(fold(ast.Statement(call('times', lit(2), lit(3)))).expr)}")
+    print(f"Expect -3, got {int_value(fold(ast.Statement(call('divide', lit(7), lit(-2)))).expr)}")
+    print(f"Expect 7, got {int_value(fold(ast.Statement(call('minus', lit(2), call('minus', lit(0), lit(5))))).expr)}")
+    print(f"Expect True, got {fold(ast.Statement(call('less', lit(2), lit(3)))).expr.value}")
+    print(f"Expect x, got {fold(ast.Statement(call('times', lit(1), call('plus', x, lit(0))))).expr.name}")
+    print(f"Expect divide, got {fold(ast.Statement(call('divide', lit(1), lit(0)))).expr.method}")
+    print(f"Expect times, got {fold(ast.Statement(call('times', lit(2**20), lit(2**20)))).expr.method}")
+    print(f"Expect minus, got {fold(ast.Statement(call('minus', lit(-INT_MAX), lit(1)))).expr.method}")
+    joined = typed(ast.MethodInvocation("plus", typed(ast.StringLiteral('"a\\n"'), "String"), [typed(ast.StringLiteral('"b"'), "String")]), "String")
+    print(f"Expect \"a\\nb\", got {fold(ast.Statement(joined)).expr.value}")
+    print(f"Expect False, got {fold(ast.Statement(ast.CondNot(ast.BooleanLiteral(True)))).expr.value}")
@@ -0,0 +1,173 @@
+"""
+Common subexpression elimination by local value numbering. Runs after loop invariant code motion
+
+Within each basic block, every value on the stack gets a number. Constants with the same text and loads of
+a local with no store in between get the same number, and so do pure builtin operations on the same numbers.
+When a pure operation is computed again from side effect free code, the first result is kept in a fresh local
+and the repeat becomes a load of it, saving the call and the allocation of the result
+"""
+
+import logging
+import log_helper
+
+import ir
+
+logger = logging.getLogger("cse")
+
+# Operations and builtin methods whose result only depends on their operands. Reusing a result is always safe,
+# even for ones that can fail, since the first computation already succeeded
+PURE_OPS = ("add", "sub", "mul", "div", "neg")
+PURE_CALLS = tuple(f"{clazz}:{method}" for clazz, methods in [
+    ("Int", ["plus", "minus", "times", "divide", "negate", "equals", "less", "more", "atleast", "atmost", "string"]),
+    ("String", ["plus", "equals", "less", "more", "atleast", "atmost", "string"]),
+    ("Boolean", ["negate", "equals", "string"])
+] for method in methods)
+
+
+class Value:
+    # A value on the stack, its number, and the instructions start to end of the block that computed it
+    # if they have no side effects
+
+    __slots__ = ("number", "start", "end")
+
+    def __init__(self, number, start=None, end=None):
+        self.number = number
+        self.start = start
+        self.end = end
+
+
+class ValueNumbering:
+
+    def __init__(self, class_map, clazz):
+        self.class_map = class_map
+        self.clazz = clazz
+        self.numbers = {} # Constant or pure operation on numbers -> number
+        self.count = 0
+
+    def fresh(self):
+        # A number for a value nothing else is known to equal
+        self.count += 1
+        return self.count - 1
+
+    def number(self, key):
+        if key not in self.numbers:
+            self.numbers[key] = self.fresh()
+        return self.numbers[key]
+
+    def repeats(self, block):
+        # Finds the pure operations computed again. Returns operation key -> index of its first computation,
+        # and the (start, end, key) of each repeat that can be replaced
+        first = {}
+        repeats = []
+        local_numbers = {} # Local -> number of its current value
+        stack = []
+        for i, instr in enumerate(block.instrs):
+            effect = ir.stack_effect(instr, self.class_map, self.clazz)
+            if effect is None:
+                stack = []
+                continue
+            pops, pushes = effect
+            args = [stack.pop() if stack else Value(self.fresh()) for _ in range(pops)][::-1]
+
+            if instr.op == "const":
+                stack.append(Value(self.number(("const", instr.operand)), i, i))
+            elif instr.op == "load":
+                if instr.operand not in local_numbers:
+                    local_numbers[instr.operand] = self.fresh()
+                stack.append(Value(local_numbers[instr.operand], i, i))
+            elif instr.op == "store":
+                local_numbers[instr.operand] = args[0].number
+            elif instr.op in PURE_OPS or (instr.op == "call_direct" and instr.operand in PURE_CALLS):
+                key = (instr.op, instr.operand) + tuple(arg.number for arg in args)
+                # Side effect free if its operands are, and they are the instructions right before it
+                pure = (all(arg.start is not None for arg in args) and args[-1].end == i - 1
+                        and all(args[k].end + 1 == args[k + 1].start for k in range(len(args) - 1)))
+                if key not in first:
+                    first[key] = i
+                elif pure:
+                    repeats.append((args[0].start, i, key))
+                stack.append(Value(self.number(key), args[0].start if pure else None, i))
+            elif pushes:
+                stack.append(Value(self.fresh()))
+        return first, repeats
+
+    def eliminate(self, method, block):
+        # Replaces the block's repeated pure operations, returns the number replaced
+        first, repeats = self.repeats(block)
+        kept = []
+        for start, end, key in sorted(repeats, key=lambda r: (r[0], -r[1])):
+            if not kept or start > kept[-1][1]: # Not inside a repeat already replaced
+                kept.append((start, end, key))
+        if not kept:
+            return 0
+
+        temps = {}
+        for _, _, key in kept:
+            if key not in temps:
+                temps[key] = f"__cse{sum(1 for var in method.locals if var.startswith('__cse'))}"
+                method.locals = method.locals + [temps[key]]
+        saves = {first[key]: temps[key] for key in temps}
+        replaced = {start: (end, temps[key]) for start, end, key in kept}
+
+        instrs = []
+        i = 0
+        while i < len(block.instrs):
+            if i in replaced:
+                end, temp = replaced[i]
+                instrs.append(ir.Instr("load", temp))
+                i = end + 1
+                continue
+            instrs.append(block.instrs[i])
+            if i in saves:
+                # Keep the first result, and leave it on the stack
+                instrs.append(ir.Instr("store", saves[i]))
+                instrs.append(ir.Instr("load", saves[i]))
+            i += 1
+        block.instrs = instrs
+        return len(kept)
+
+
+def eliminate_all(program_ir, class_map):
+    # Eliminates repeated pure operations in every method, program_ir maps class -> ClassIR
+    eliminated = {}
+    for clazz in program_ir:
+        for method in program_ir[clazz].methods:
+            numbering = ValueNumbering(class_map, clazz)
+            count = sum(numbering.eliminate(method, block) for block in method.blocks)
+            report = logger.info if count > 0 else logger.debug
+            report(f"Eliminated {count} repeated pure operations in method {clazz}:{method.name}")
+            eliminated[(clazz, method.name)] = count
+    return eliminated
+
+
+if __name__ == "__main__":
+    from default_class_map import default_class_map
+    log_helper.setup_logging("INFO")
+    # (a + b).print(); c = a + b; (s + t).print(); (s + t).print()
+    method = ir.MethodIR("f", ["a", "b", "s", "t"], ["c"], [
+        ir.Instr("enter"),
+        ir.Instr("load", "b"),
+        ir.Instr("load", "a"),
+        ir.Instr("add"),
+        ir.Instr("call_direct", "Int:print"),
+        ir.Instr("pop"),
+        ir.Instr("load", "b"),
+        ir.Instr("load", "a"),
+        ir.Instr("add"),
+        ir.Instr("store", "c"),
+        ir.Instr("load", "t"),
+        ir.Instr("load", "s"),
+        ir.Instr("call_direct", "String:plus"),
+        ir.Instr("call_direct", "String:print"),
+        ir.Instr("pop"),
+        ir.Instr("load", "t"),
+        ir.Instr("load", "s"),
+        ir.Instr("call_direct", "String:plus"),
+        ir.Instr("call_direct", "String:print"),
+        ir.Instr("load", "$"),
+        ir.Instr("return", "4")
+    ])
+    program_ir = {"C": ir.ClassIR("C", "Obj", [], ["f"])}
+    program_ir["C"].methods = [method]
+    print(f"Expect {{('C', 'f'): 2}}, got {eliminate_all(program_ir, default_class_map)}")
+    print("\n".join(method.dump()))
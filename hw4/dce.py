@@ -0,0 +1,73 @@
+"""
+Dead code elimination on the IR. Runs after the IR is built
+
+Drops basic blocks control can't reach from the method entry, then jumps to the block laid out right after them
+and labels no jump goes to. Reports the code words saved in each class, since the VM's code block is small
+"""
+
+import logging
+import log_helper
+
+import ir
+
+logger = logging.getLogger("dce")
+
+
+def eliminate(method):
+    # Removes dead code from the method in place, returns the number of words saved
+    before = method.words()
+    reachable = set(method.reverse_postorder())
+    blocks = [block for block in method.blocks if block in reachable]
+    removed = len(method.blocks) - len(blocks)
+
+    code = []
+    for i, block in enumerate(blocks):
+        instrs = block.instrs
+        last = block.last()
+        next_labels = blocks[i + 1].labels if i + 1 < len(blocks) else []
+        if last is not None and last.is_jump() and last.operand in next_labels:
+            # Both ways go to the next block, a conditional jump still has to pop what it compares
+            instrs = instrs[:-1] + [ir.Instr("pop") for _ in range(ir.JUMP_POPS[last.op])]
+        code.extend(ir.label(name) for name in block.labels)
+        code.extend(instrs)
+
+    used = set(instr.operand for instr in code if instr.is_jump())
+    code = [instr for instr in code if not instr.is_label() or instr.operand in used]
+    method.set_code(code)
+
+    saved = before - method.words()
+    logger.debug(f"Removed {removed} unreachable blocks, {saved} words, from method {method.name}")
+    return saved
+
+
+def eliminate_all(program_ir):
+    # Removes dead code from every method, program_ir maps class -> ClassIR
+    saved = {}
+    for clazz in program_ir:
+        before = sum(method.words() for method in program_ir[clazz].methods)
+        saved[clazz] = sum(eliminate(method) for method in program_ir[clazz].methods)
+        logger.info(f"Dead code elimination saved {saved[clazz]} of {before} words in class {clazz}")
+    return saved
+
+
+if __name__ == "__main__":
+    log_helper.setup_logging("DEBUG")
+    # if c { return 1; } else { return 2; } return none;
+    method = ir.MethodIR("f", [], ["c"], [
+        ir.Instr("enter"),
+        ir.Instr("load", "c"),
+        ir.Instr("jump_ifnot", "ifbranch2_1"),
+        ir.Instr("const", "1"),
+        ir.Instr("return", "0"),
+        ir.Instr("jump", "ifend_1"),
+        ir.label("ifbranch2_1"),
+        ir.Instr("const", "2"),
+        ir.Instr("return", "0"),
+        ir.label("ifend_1"),
+        ir.Instr("const", "none"),
+        ir.Instr("return", "0"),
+        ir.label("dead_1"),
+        ir.Instr("jump", "dead_1")
+    ])
+    print(f"Expect 8, got {eliminate(method)}")
+    print("\n".join(method.dump()))
@@ -0,0 +1,99 @@
+"""
+Devirtualization by class hierarchy analysis. Runs after the IR is built
+
+The compiler sees every class of the program, so a call C:m whose method no subclass of C overrides can only
+ever run one method. Those calls become call_direct, which the loader resolves to the method's code address,
+so the VM skips the vtable lookup. Constructors are called right after new, so their receiver class is exact
+"""
+
+import logging
+import log_helper
+
+import ir
+from class_hierarchy import ClassHierarchy
+
+logger = logging.getLogger("devirt")
+
+
+class HierarchyAnalysis:
+
+    def __init__(self, program_ir, class_map):
+        self.hierarchy = ClassHierarchy(class_map)
+        self.defined = {} # Class -> methods it defines or overrides
+        for clazz in class_map:
+            if clazz in program_ir:
+                self.defined[clazz] = set(method.name for method in program_ir[clazz].methods)
+            else:
+                # Built in classes, assume they override everything they list
+                self.defined[clazz] = set(class_map[clazz]["method_returns"])
+        self.monomorphic = {} # (class, method) -> whether the call can be direct
+
+    def is_monomorphic(self, clazz, method):
+        # Whether no subclass of clazz (at any depth) overrides the method
+        if method == "$constructor":
+            return True
+        if (clazz, method) not in self.monomorphic:
+            stack = list(self.hierarchy.subclasses[clazz])
+            overridden = False
+            while stack and not overridden:
+                sub = stack.pop()
+                overridden = method in self.defined[sub]
+                stack.extend(self.hierarchy.subclasses[sub])
+            self.monomorphic[(clazz, method)] = not overridden
+        return self.monomorphic[(clazz, method)]
+
+    def devirtualize(self, clazz, method):
+        # Turns the monomorphic calls in the method into direct calls, returns the number of calls and of direct ones
+        calls = 0
+        direct = 0
+        for block in method.blocks:
+            for i, instr in enumerate(block.instrs):
+                if instr.op != "call":
+                    continue
+                calls += 1
+                receiver, name = instr.operand.split(":")
+                if self.is_monomorphic(clazz if receiver == "$" else receiver, name):
+                    block.instrs[i] = ir.Instr("call_direct", instr.operand)
+                    direct += 1
+        return calls, direct
+
+
+def devirtualize_all(program_ir, class_map):
+    # Devirtualizes calls in every method, program_ir maps class -> ClassIR
+    analysis = HierarchyAnalysis(program_ir, class_map)
+    total = {}
+    for clazz in program_ir:
+        calls = 0
+        direct = 0
+        for method in program_ir[clazz].methods:
+            method_calls, method_direct = analysis.devirtualize(clazz, method)
+            calls += method_calls
+            direct += method_direct
+        logger.info(f"Devirtualized {direct} of {calls} call sites in class {clazz}")
+        total[clazz] = direct
+    return total
+
+
+if __name__ == "__main__":
+    from default_class_map import default_class_map
+    log_helper.setup_logging("INFO")
+    # class A { def f() { return this.g(); } def g() { ... } }, B extends A and overrides g
+    class_map = dict(default_class_map)
+    class_map["A"] = {"superclass": "Obj", "method_returns": {"$constructor": "A", "f": "Int", "g": "Int"}}
+    class_map["B"] = {"superclass": "A", "method_returns": {"$constructor": "B", "f": "Int", "g": "Int"}}
+    method = ir.MethodIR("f", [], [], [
+        ir.Instr("enter"),
+        ir.Instr("load", "$"),
+        ir.Instr("call", "$:g"),
+        ir.Instr("call", "Int:print"),
+        ir.Instr("new", "B"),
+        ir.Instr("call", "B:$constructor"),
+        ir.Instr("call", "A:f"),
+        ir.Instr("call", "Obj:string"),
+        ir.Instr("return", "0")
+    ])
+    program_ir = {"A": ir.ClassIR("A", "Obj", [], ["f", "g"]), "B": ir.ClassIR("B", "A", [], ["f", "g"])}
+    program_ir["A"].methods = [method, ir.MethodIR("g", [], [], [])]
+    program_ir["B"].methods = [ir.MethodIR("g", [], [], [])]
+    print(f"Expect {{'A': 3, 'B': 0}}, got {devirtualize_all(program_ir, class_map)}")
+    print("\n".join(method.dump()))
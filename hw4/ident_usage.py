@@ -3,12 +3,11 @@ Static semantic
 Checks that the given tree consistently assigns identifiers before their usage
 """
 
-from lark import Lark, v_args, Tree, Token
-from lark.visitors import Visitor_Recursive
 import sys
 import logging
 import log_helper
 
+import quack_ast as ast
 from default_class_map import default_class_map
 
 logger = logging.getLogger("ident-usage")
@@ -20,7 +19,7 @@ def compile_error(msg):
     sys.exit(1)
 
 
-class IdentUsageCheck(Visitor_Recursive):
+class IdentUsageCheck(ast.Visitor):
 
     def __init__(self):
         self.constructor = False # Whether we are currently in a constructor
@@ -28,67 +27,49 @@ class IdentUsageCheck(Visitor_Recursive):
         self.class_idents = set()
         self.class_idents_seen = set()
 
-    def get_ident_name(self, ident):
-        # Gets the actual name of the identifier
+    def assignment_target(self, target):
+        if isinstance(target, ast.Identifier):
+            # We have now seen this variable, keep track of it
+            logger.trace(f"Logging identifier {target.name} as seen from tree {target}")
+            self.idents.add(target.name)
+
+        elif isinstance(target.obj, ast.ThisPtr):
+            # Note it only checks within the class, let type checker handle cross-class
+            # Have now seen this field variable, add to class
+            logger.trace(f"Logging field identifier {target.name} as seen from tree {target}")
+            if self.constructor: # Class fields must defined in constructor
+                self.class_idents.add(target.name)
+            self.class_idents_seen.add(target.name)
 
-        if isinstance(ident, Tree):
-            # For identifiers, just recurse
-            if ident.data == "identifier":
-                return ident.children[0].value # Child is a token
-            elif ident.data.startswith("identifier"):
-                return self.get_ident_name(ident.children[0]) # Recurse on only child
-            else:
-                compile_error(f"Attempted to get identifier name in unknown tree type {ident.data} {ident}")
-        elif isinstance(ident, Token):
-            return ident.value
         else:
-            compile_error(f"Attempted to get identifier name in unrecognizable tree {ident}")
-
-
-    def identifier_lhand(self, tree):
-        # We have now seen this variable, keep track of it
-        ident = self.get_ident_name(tree)
-        logger.trace(f"Logging identifier {ident} as seen from tree {tree}")
-        self.idents.add(ident)
-
-    def identifier_field_lhand_this(self, tree):
-        # Note it only checks within the class, let type checker handle cross-class
-        # Have now seen this field variable, add to class
-        ident = self.get_ident_name(tree.children[0])
-        logger.trace(f"Logging field identifier {ident} as seen from tree {tree}")
-        if self.constructor: # Class fields must defined in constructor
-            self.class_idents.add(ident)
-        self.class_idents_seen.add(ident)
-
-    def identifier_field_rhand_this(self, tree):
-        # We must check if we've seen this field variable. Check later, mark as seen now
-        ident = self.get_ident_name(tree.children[0])
-        logger.trace(f"Checking whether field identifier {ident} has been seen at tree {tree}")
-        self.class_idents_seen.add(ident)
-
-    def identifier_rhand(self, tree):
+            # Field of some other object, check the object expression
+            self.visit(target.obj)
+
+    def field(self, tree):
+        if isinstance(tree.obj, ast.ThisPtr):
+            # We must check if we've seen this field variable. Check later, mark as seen now
+            logger.trace(f"Checking whether field identifier {tree.name} has been seen at tree {tree}")
+            self.class_idents_seen.add(tree.name)
+
+    def identifier(self, tree):
         # We must check if we've seen this variable
-        ident = self.get_ident_name(tree)
-        logger.trace(f"Checking whether identifier {ident} has been seen at tree {tree}")
-        if ident not in self.idents:
-            compile_error(f"Identifier {ident} has not been declared/assigned yet")
+        logger.trace(f"Checking whether identifier {tree.name} has been seen at tree {tree}")
+        if tree.name not in self.idents:
+            compile_error(f"Identifier {tree.name} has not been declared/assigned yet")
 
     def visit(self, tree):
 
-        if not isinstance(tree, Tree):
-            return tree
-
         # For class, flush class identifier list
-        elif tree.data == "class":
+        if isinstance(tree, ast.Clazz):
             self.class_idents = set()
             self.class_idents_seen = set()
             self.idents = set()
             
-            class_name = self.get_ident_name(tree.children[0])
+            class_name = tree.name
             logger.trace(f"Class {class_name} has base ident set {self.idents}") 
 
             # Now visit class body
-            self.visit(tree.children[-1])
+            self.visit_all(tree.methods)
 
             # Now make sure every identifier seen has been used
             logger.debug(f"Checking class field usage for clas {class_name} with detected field set {self.class_idents}") 
@@ -98,44 +79,48 @@ class IdentUsageCheck(Visitor_Recursive):
             self.class_idents_seen = set()
 
 
-        elif tree.data == "class_method":
+        elif isinstance(tree, ast.ClassMethod):
             # First set constructor mode on/off
-            if tree.children[0].children[0].value == "$constructor":
+            if tree.name == "$constructor":
                 self.constructor = True
             else:
                 self.constructor = False
 
             # Add formal args to method set
-            f_args = tree.children[1].children
             self.idents = set()
-            for i in range(0, len(f_args), 2):
-                self.idents.add(f_args[i].children[0].value)
+            for name, _ in tree.args:
+                self.idents.add(name)
 
-            method_name = self.get_ident_name(tree.children[0])
+            method_name = tree.name
             logger.trace(f"Method {method_name} has base ident set {self.idents}") 
 
             # Now visit method body
-            self.visit(tree.children[-1])
+            self.visit_all(tree.body)
+
+        elif isinstance(tree, ast.Assignment):
+            # Left hand side first, then the value
+            self.assignment_target(tree.target)
+            self.visit(tree.value)
 
         # For if statement, need to take the intersection of both branches
-        elif tree.data == "if_structure":
+        elif isinstance(tree, ast.IfStatement):
 
             ident = self.idents.copy()
             class_idents = self.class_idents.copy()
 
             # First visit conditional
-            self.visit(tree.children[0])
+            self.visit(tree.cond)
 
             # Then visit branch 1 and get identiifers
-            self.visit(tree.children[1])
+            self.visit_all(tree.then_body)
             ident_branch1 = self.idents.copy()
             class_idents1 = self.class_idents.copy()
             self.idents = class_idents
             self.idents = ident
 
             # Then visit branch 2 (if exists) and get identifiers
-            if len(tree.children) > 2:
-                self.visit(tree.children[2])
+            if tree.else_body is not None:
+                self.visit_all(tree.else_body)
             ident_branch2 = self.idents.copy()
             class_idents2 = self.class_idents.copy()
 
@@ -152,16 +137,16 @@ class IdentUsageCheck(Visitor_Recursive):
             self.class_idents = class_idents1.intersection(class_idents2)
 
         # For while statement, just throw away any changes
-        elif tree.data == "while_structure":
+        elif isinstance(tree, ast.WhileStatement):
 
             ident = self.idents.copy()
             class_idents = self.class_idents.copy()
 
             # First visit conditional
-            self.visit(tree.children[0])
+            self.visit(tree.cond)
 
             # Now visit child then reset idents
-            self.visit(tree.children[1])
+            self.visit_all(tree.body)
             self.idents = ident
 
             # For constructor, need to check declared fields are on both branches
@@ -174,16 +159,15 @@ class IdentUsageCheck(Visitor_Recursive):
             self.class_idents = class_idents
 
         # For typecase statement, just throw away any changes
-        elif tree.data == "type_alt":
+        elif isinstance(tree, ast.TypeAlt):
             idents = self.idents.copy()
             class_idents = self.class_idents.copy()
 
             # First add type ident name
-            ident = self.get_ident_name(tree.children[0])
-            self.idents.add(ident)
+            self.idents.add(tree.name)
 
             # Now visit child then reset idents
-            self.visit(tree.children[2])
+            self.visit_all(tree.body)
             self.idents = idents
             self.class_idents = class_idents
 
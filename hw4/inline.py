@@ -0,0 +1,135 @@
+"""
+Inlining of small leaf methods at direct call sites. Runs after devirtualization
+
+A method whose code is one basic block with no calls (getters, setters and the like) is copied into its
+callers in place of call_direct. The receiver and arguments the caller pushed are stored into fresh locals,
+the method's own locals are renamed, and the value its return would leave is left on the stack.
+The peephole optimizer then runs again on the callers, which drops most of the copying
+"""
+
+import logging
+import log_helper
+
+import ir
+import peephole
+
+logger = logging.getLogger("inline")
+
+CALLS = ("call", "call_direct", "call_native")
+DEFAULT_LIMIT = 16 # Largest body inlined, in code words without enter and return
+
+
+class Inliner:
+
+    def __init__(self, program_ir, limit=DEFAULT_LIMIT):
+        self.program_ir = program_ir
+        self.limit = limit
+        self.inlinable = {} # (class, method) -> whether it can be inlined
+
+    def find_method(self, clazz, name):
+        # The class among clazz and its superclasses whose code the method runs, and the method's IR
+        # None if that is a built in class
+        while clazz in self.program_ir:
+            for method in self.program_ir[clazz].methods:
+                if method.name == name:
+                    return clazz, method
+            clazz = self.program_ir[clazz].superclass
+        return None
+
+    def can_inline(self, clazz, method):
+        # One block of enter, a body with no calls or jumps, and return, with the body within the size limit
+        if (clazz, method.name) not in self.inlinable:
+            instrs = method.blocks[0].instrs
+            ok = (len(method.blocks) == 1 and len(instrs) >= 2
+                  and instrs[0].op == "enter" and instrs[-1].op == "return")
+            if ok:
+                body = instrs[1:-1]
+                ok = (not any(instr.op in CALLS or instr.is_jump() for instr in body)
+                      and sum(1 if instr.operand is None else 2 for instr in body) <= self.limit)
+            self.inlinable[(clazz, method.name)] = ok
+        return self.inlinable[(clazz, method.name)]
+
+    def expand(self, clazz, method, prefix):
+        # The method's body for a call site, with its receiver, arguments and locals renamed with the prefix
+        # and its fields named by class
+        rename = {var: prefix + var for var in method.args + method.locals}
+        rename["$"] = prefix + "this"
+        code = [ir.Instr("store", rename["$"])]
+        code.extend(ir.Instr("store", rename[arg]) for arg in reversed(method.args))
+        for instr in method.blocks[0].instrs[1:-1]:
+            if instr.op in ["load", "store"]:
+                instr = ir.Instr(instr.op, rename[instr.operand])
+            elif instr.op in ["load_field", "store_field"] and instr.operand.startswith("$:"):
+                instr = ir.Instr(instr.op, clazz + instr.operand[1:])
+            code.append(instr)
+        return code, list(rename.values())
+
+    def inline(self, clazz, method):
+        # Inlines the calls in the method, returns the number of calls inlined
+        code = []
+        new_locals = []
+        for instr in method.instrs():
+            target = None
+            if instr.op == "call_direct":
+                receiver, name = instr.operand.split(":")
+                target = self.find_method(clazz if receiver == "$" else receiver, name)
+            if target is None or target[1] is method or not self.can_inline(*target):
+                code.append(instr)
+                continue
+            logger.debug(f"Inlining {instr.operand} into {clazz}:{method.name}")
+            body, body_locals = self.expand(*target, f"__inline{len(new_locals)}_")
+            code.extend(body)
+            new_locals.append(body_locals)
+        if not new_locals:
+            return 0
+        method.locals = method.locals + [var for body_locals in new_locals for var in body_locals]
+        method.set_code(peephole.PeepholeOptimizer().optimize(code))
+        return len(new_locals)
+
+
+def inline_all(program_ir, limit=DEFAULT_LIMIT):
+    # Inlines small leaf methods into every method, program_ir maps class -> ClassIR
+    inliner = Inliner(program_ir, limit)
+    inlined = {}
+    for clazz in program_ir:
+        inlined[clazz] = sum(inliner.inline(clazz, method) for method in program_ir[clazz].methods)
+        logger.info(f"Inlined {inlined[clazz]} calls in class {clazz}")
+    return inlined
+
+
+if __name__ == "__main__":
+    log_helper.setup_logging("INFO")
+    # class Node { def data() { return this.data; } def set(v: Int) { this.data = v; } }
+    node = ir.ClassIR("Node", "Obj", ["data"], ["data", "set"])
+    node.methods = [
+        ir.MethodIR("data", [], [], [
+            ir.Instr("enter"),
+            ir.Instr("load", "$"),
+            ir.Instr("load_field", "$:data"),
+            ir.Instr("return", "0")
+        ]),
+        ir.MethodIR("set", ["v"], [], [
+            ir.Instr("enter"),
+            ir.Instr("load", "v"),
+            ir.Instr("load", "$"),
+            ir.Instr("store_field", "$:data"),
+            ir.Instr("const", "none"),
+            ir.Instr("return", "1")
+        ])
+    ]
+    # n.set(n.data() + 1)
+    main = ir.ClassIR("Main", "Obj", [], [])
+    main.methods = [ir.MethodIR("$constructor", [], ["n"], [
+        ir.Instr("enter"),
+        ir.Instr("const", "1"),
+        ir.Instr("load", "n"),
+        ir.Instr("call_direct", "Node:data"),
+        ir.Instr("add"),
+        ir.Instr("load", "n"),
+        ir.Instr("call_direct", "Node:set"),
+        ir.Instr("pop"),
+        ir.Instr("load", "$"),
+        ir.Instr("return", "0")
+    ])]
+    print(f"Expect {{'Node': 0, 'Main': 2}}, got {inline_all({'Node': node, 'Main': main})}")
+    print("\n".join(main.methods[0].dump()))
@@ -0,0 +1,309 @@
+"""
+Intermediate representation between code_gen.py and the assembler
+
+Each method is a list of basic blocks of instructions, with successor and predecessor edges and a
+dominator tree. code_gen.py emits a flat instruction list per method (labels are pseudo instructions),
+which is split into blocks here. The assembler reads the blocks directly, and the text assembly is a dump
+"""
+
+import logging
+import log_helper
+
+logger = logging.getLogger("ir")
+
+LABEL = ".label" # Pseudo operation marking a label in a flat instruction list
+BRANCHES = ("jump_if", "jump_ifnot") # Jumps on a Boolean that may also fall through
+INT_BRANCHES = ("jump_if_eq", "jump_if_ne", "jump_if_lt", "jump_if_le", "jump_if_gt", "jump_if_ge") # Fused Int compare and jump
+JUMPS = ("jump",) + BRANCHES + INT_BRANCHES # Operations with a label operand
+
+# Values each jump pops, and the conditional jump taken exactly when the other one isn't
+JUMP_POPS = {"jump": 0, "jump_if": 1, "jump_ifnot": 1, **{op: 2 for op in INT_BRANCHES}}
+INVERSE = {
+    "jump_if": "jump_ifnot",
+    "jump_ifnot": "jump_if",
+    "jump_if_eq": "jump_if_ne",
+    "jump_if_ne": "jump_if_eq",
+    "jump_if_lt": "jump_if_ge",
+    "jump_if_ge": "jump_if_lt",
+    "jump_if_gt": "jump_if_le",
+    "jump_if_le": "jump_if_gt"
+}
+
+# Values each operation pops and pushes. Calls are left out, they pop their arguments and receiver
+STACK_EFFECTS = {
+    "enter": (0, 0),
+    "const": (0, 1),
+    "load": (0, 1),
+    "new": (0, 1),
+    "store": (1, 0),
+    "pop": (1, 0),
+    "load_field": (1, 1),
+    "store_field": (2, 0),
+    "is_instance": (1, 1),
+    "return": (1, 0),
+    "add": (2, 1),
+    "sub": (2, 1),
+    "mul": (2, 1),
+    "div": (2, 1),
+    "neg": (1, 1),
+    **{op: (JUMP_POPS[op], 0) for op in JUMPS}
+}
+CALLS = ("call", "call_direct") # Method calls, through the vtable or not
+
+
+class Instr:
+    # One instruction, or a label in a flat instruction list. Operands are kept as assembly text
+
+    __slots__ = ("op", "operand")
+
+    def __init__(self, op, operand=None):
+        self.op = op
+        self.operand = operand
+
+    def is_label(self):
+        return self.op == LABEL
+
+    def is_jump(self):
+        return self.op in JUMPS
+
+    def __eq__(self, other):
+        return isinstance(other, Instr) and self.op == other.op and self.operand == other.operand
+
+    def __hash__(self):
+        return hash((self.op, self.operand))
+
+    def __str__(self):
+        return self.op if self.operand is None else f"{self.op} {self.operand}"
+
+    def __repr__(self):
+        return f"Instr({str(self)!r})"
+
+
+def label(name):
+    # Makes the label pseudo instruction for a flat instruction list
+    return Instr(LABEL, name)
+
+
+def stack_effect(instr, class_map, clazz):
+    # Values the instruction pops and pushes, None if unknown. A call's arguments are looked up in the class map,
+    # with $ meaning clazz
+    if instr.op in CALLS:
+        receiver, name = instr.operand.split(":")
+        receiver = clazz if receiver == "$" else receiver
+        return len(class_map[receiver]["method_args"][name]) + 1, 1
+    return STACK_EFFECTS.get(instr.op)
+
+
+class BasicBlock:
+    # Straight line code entered only at the top, through any of its labels
+
+    __slots__ = ("index", "labels", "instrs", "succs", "preds", "idom", "dom_children")
+
+    def __init__(self, index):
+        self.index = index # Position in the method
+        self.labels = []
+        self.instrs = []
+        self.succs = [] # Blocks control may go to next, the jump target last
+        self.preds = []
+        self.idom = None # Immediate dominator, None for the entry and unreachable blocks
+        self.dom_children = [] # Blocks this one immediately dominates
+
+    def last(self):
+        return self.instrs[-1] if self.instrs else None
+
+    def __repr__(self):
+        return f"BasicBlock({self.index}, {self.labels}, {[str(i) for i in self.instrs]})"
+
+
+class MethodIR:
+    # The basic blocks of a method, in layout order. The first block is the entry
+
+    def __init__(self, name, args, local_vars, code):
+        self.name = name
+        self.args = args
+        self.locals = local_vars
+        self.set_code(code)
+
+    def set_code(self, code):
+        # Replaces the method body with a flat instruction list, rebuilding the blocks, edges and dominators
+        self.blocks = []
+        self.build_blocks(code)
+        self.build_edges()
+        self.build_dominators()
+
+    def build_blocks(self, code):
+        # Labels start a new block, jumps and returns end one
+        block = None
+        for instr in code:
+            if block is None or (instr.is_label() and block.instrs):
+                block = BasicBlock(len(self.blocks))
+                self.blocks.append(block)
+            if instr.is_label():
+                block.labels.append(instr.operand)
+                continue
+            block.instrs.append(instr)
+            if instr.is_jump() or instr.op == "return":
+                block = None
+        if not self.blocks:
+            self.blocks.append(BasicBlock(0))
+
+    def build_edges(self):
+        targets = {}
+        for block in self.blocks:
+            for name in block.labels:
+                targets[name] = block
+
+        for block in self.blocks:
+            last = block.last()
+            fall_through = block.index + 1 < len(self.blocks)
+            if last is not None and last.op == "return":
+                continue
+            if (last is None or last.op != "jump") and fall_through:
+                block.succs.append(self.blocks[block.index + 1])
+            if last is not None and last.is_jump():
+                if last.operand not in targets:
+                    logger.error(f"Unresolved label {last.operand} in method {self.name}")
+                    continue
+                block.succs.append(targets[last.operand])
+        for block in self.blocks:
+            for succ in block.succs:
+                if block not in succ.preds:
+                    succ.preds.append(block)
+
+    def reverse_postorder(self):
+        # Reachable blocks, each before its successors except along back edges
+        order = []
+        seen = {self.blocks[0]}
+        stack = [(self.blocks[0], iter(self.blocks[0].succs))]
+        while stack:
+            block, succs = stack[-1]
+            succ = next(succs, None)
+            if succ is None:
+                stack.pop()
+                order.append(block)
+            elif succ not in seen:
+                seen.add(succ)
+                stack.append((succ, iter(succ.succs)))
+        order.reverse()
+        return order
+
+    def build_dominators(self):
+        # Cooper, Harvey and Kennedy's iterative algorithm over the reverse postorder
+        order = self.reverse_postorder()
+        number = {block: i for i, block in enumerate(order)}
+        entry = order[0]
+        idom = {entry: entry}
+
+        def intersect(a, b):
+            while a is not b:
+                while number[a] > number[b]:
+                    a = idom[a]
+                while number[b] > number[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for block in order[1:]:
+                new_idom = None
+                for pred in block.preds:
+                    if pred in idom:
+                        new_idom = pred if new_idom is None else intersect(pred, new_idom)
+                if idom.get(block) is not new_idom:
+                    idom[block] = new_idom
+                    changed = True
+
+        for block in self.blocks:
+            block.idom = None
+            block.dom_children = []
+        for block in order[1:]:
+            block.idom = idom[block]
+            idom[block].dom_children.append(block)
+
+    def words(self):
+        # Code words the method body takes in the VM, an operation and then its operand if it has one
+        return sum(1 if instr.operand is None else 2 for block in self.blocks for instr in block.instrs)
+
+    def dominates(self, a, b):
+        # Whether every path from the entry to block b goes through block a
+        while b is not None:
+            if b is a:
+                return True
+            b = b.idom
+        return False
+
+    def instrs(self):
+        # The method as a flat instruction list, with labels
+        code = []
+        for block in self.blocks:
+            code.extend(label(name) for name in block.labels)
+            code.extend(block.instrs)
+        return code
+
+    def dump(self):
+        # The method as lines of assembly
+        lines = [f".method {self.name}"]
+        if self.args:
+            lines.append(f".args {','.join(self.args)}")
+        if self.locals:
+            lines.append(f".local {','.join(self.locals)}")
+        for block in self.blocks:
+            lines.extend(f"{name}:" for name in block.labels)
+            lines.extend(f"\t{instr}" for instr in block.instrs)
+        return lines
+
+
+class ClassIR:
+    # A class and the methods it has code for
+
+    def __init__(self, name, superclass, fields, forward):
+        self.name = name
+        self.superclass = superclass
+        self.fields = fields
+        self.forward = forward # Methods declared up front so they can be called before their code
+        self.methods = []
+
+    def dump(self):
+        # The class as lines of assembly
+        lines = [f".class {self.name}:{self.superclass}"]
+        lines.extend(f".field {field}" for field in self.fields)
+        lines.extend(f".method {method} forward" for method in self.forward)
+        for method in self.methods:
+            lines.append("")
+            lines.extend(method.dump())
+        return lines
+
+
+if __name__ == "__main__":
+    log_helper.setup_logging("INFO")
+    # while i < n { if c { i = i + 1 } }
+    code = [
+        Instr("enter"),
+        Instr("jump", "whilecond_1"),
+        label("whileloop_1"),
+        Instr("load", "c"),
+        Instr("jump_ifnot", "ifend_1"),
+        Instr("const", "1"),
+        Instr("load", "i"),
+        Instr("call", "Int:plus"),
+        Instr("store", "i"),
+        label("ifend_1"),
+        label("whilecond_1"),
+        Instr("load", "n"),
+        Instr("load", "i"),
+        Instr("call", "Int:less"),
+        Instr("jump_if", "whileloop_1"),
+        Instr("load", "$"),
+        Instr("return", "0"),
+        Instr("const", "none")
+    ]
+    method = MethodIR("loop", [], ["i", "n", "c"], code)
+    for block in method.blocks:
+        idom = block.idom.index if block.idom else None
+        print(f"Block {block.index} {block.labels}: succs {[b.index for b in block.succs]}, "
+              f"preds {[b.index for b in block.preds]}, idom {idom}")
+    print(f"Expect True, got {method.dominates(method.blocks[3], method.blocks[4])}")
+    print(f"Expect False, got {method.dominates(method.blocks[1], method.blocks[3])}")
+    print(f"Expect True, got {method.instrs() == code}")
+    print("\n".join(method.dump()))
@@ -0,0 +1,64 @@
+"""
+Object layout of every class: the vtable slot of each method and the position of each field. Runs after the IR
+is built, and is handed to the assembler so that it needs no object files of other classes
+
+A class starts with its superclass's methods and fields in their slots. Its own methods go after them, forward
+declared ones first and then the rest in the order of their code, and its own fields go after the inherited ones.
+This is the order the assembler gives them when it reads the same declarations
+"""
+
+import logging
+import log_helper
+
+import ir
+from assemble import ModuleLayout
+
+logger = logging.getLogger("layout")
+
+# Vtables of the built in classes. These MUST match the vtables in builtins.c
+BUILTIN_METHODS = {
+    "Obj": ["$constructor", "string", "print", "equals"],
+    "Int": ["$constructor", "string", "print", "equals", "less", "more", "atleast", "atmost",
+            "plus", "minus", "times", "divide", "negate"],
+    "String": ["$constructor", "string", "print", "equals", "less", "more", "atleast", "atmost", "plus"],
+    "Boolean": ["$constructor", "string", "print", "equals", "negate"],
+    "Nothing": ["$constructor", "string", "print", "equals"]
+}
+
+
+def compute_layouts(program_ir):
+    # Layouts of the built in classes and every class of the program, program_ir maps class -> ClassIR
+    layouts = {clazz: ModuleLayout(list(methods), []) for clazz, methods in BUILTIN_METHODS.items()}
+
+    def layout(clazz):
+        if clazz not in layouts:
+            class_ir = program_ir[clazz]
+            inherited = layout(class_ir.superclass)
+            methods = list(inherited.methods)
+            for name in class_ir.forward + [method.name for method in class_ir.methods]:
+                if name not in methods:
+                    methods.append(name)
+            fields = list(inherited.fields)
+            for name in class_ir.fields:
+                if name not in fields:
+                    fields.append(name)
+            layouts[clazz] = ModuleLayout(methods, fields)
+            logger.debug(f"Class {clazz} has {len(methods)} methods and {len(fields)} fields")
+        return layouts[clazz]
+
+    for clazz in program_ir:
+        layout(clazz)
+    return layouts
+
+
+if __name__ == "__main__":
+    log_helper.setup_logging("DEBUG")
+    # class Pt(x: Int) { this.x = x; def get(): Int { return this.x; } }
+    # class Pt3(x: Int, z: Int) extends Pt { this.x = x; this.z = z; def string(): String { ... } }
+    pt = ir.ClassIR("Pt", "Obj", ["x"], [])
+    pt.methods = [ir.MethodIR("$constructor", ["x"], [], []), ir.MethodIR("get", [], [], [])]
+    pt3 = ir.ClassIR("Pt3", "Pt", ["x", "z"], [])
+    pt3.methods = [ir.MethodIR("$constructor", ["x", "z"], [], []), ir.MethodIR("string", [], [], [])]
+    layouts = compute_layouts({"Pt3": pt3, "Pt": pt})
+    print(f"Expect ['$constructor', 'string', 'print', 'equals', 'get'] and ['x', 'z'], "
+          f"got {layouts['Pt3'].methods} and {layouts['Pt3'].fields}")
@@ -0,0 +1,275 @@
+"""
+Loop invariant code motion on the IR. Runs after inlining
+
+Loops are found from back edges in the dominator tree. Within a loop, an expression is invariant if it is built
+from constants, this, locals the loop never stores, loads of fields nothing in the loop may store, and pure
+Int and String operations. Each such expression is computed once into a fresh local before the loop.
+A field counts as stored by the loop if the loop stores it, or calls a user method that may store it
+(directly or through its own calls). Stores a constructor makes to its own new object don't count
+"""
+
+import logging
+import log_helper
+
+import ir
+from class_hierarchy import ClassHierarchy
+
+logger = logging.getLogger("licm")
+
+# Operations and builtin methods with no side effects that can't fail on their static types, so running them
+# before a loop that may not run at all is safe. Division is left out, it fails on zero
+PURE_OPS = ("add", "sub", "mul", "neg")
+PURE_CALLS = ("Int:plus", "Int:minus", "Int:times", "Int:negate", "Int:string", "String:plus", "String:string")
+
+
+def field_name(operand):
+    return operand.split(":")[1]
+
+
+class FieldWrites:
+    # The fields each method of the program may store, directly or through the methods it calls
+
+    def __init__(self, program_ir, class_map):
+        self.program_ir = program_ir
+        self.hierarchy = ClassHierarchy(class_map)
+        self.writes = {} # (class, method) -> field names
+        callees = {}
+        for clazz in program_ir:
+            for method in program_ir[clazz].methods:
+                key = (clazz, method.name)
+                self.writes[key] = set()
+                callees[key] = set()
+                for instr in method.instrs():
+                    if instr.op == "store_field":
+                        if method.name != "$constructor" or not instr.operand.startswith("$:"):
+                            self.writes[key].add(field_name(instr.operand))
+                    elif instr.op in ir.CALLS:
+                        callees[key] |= self.targets(clazz, instr)
+
+        changed = True
+        while changed:
+            changed = False
+            for key in self.writes:
+                for callee in callees[key]:
+                    if not self.writes[callee] <= self.writes[key]:
+                        self.writes[key] |= self.writes[callee]
+                        changed = True
+
+    def find_method(self, clazz, name):
+        # The class among clazz and its superclasses that defines the method, None if a builtin one does
+        while clazz in self.program_ir:
+            if any(method.name == name for method in self.program_ir[clazz].methods):
+                return clazz
+            clazz = self.program_ir[clazz].superclass
+        return None
+
+    def targets(self, clazz, instr):
+        # The user methods a call may run, as (class, method). A call through the vtable may run overrides
+        receiver, name = instr.operand.split(":")
+        receiver = clazz if receiver == "$" else receiver
+        found = set()
+        definer = self.find_method(receiver, name)
+        if definer is not None:
+            found.add((definer, name))
+        if instr.op == "call":
+            stack = list(self.hierarchy.subclasses.get(receiver, []))
+            while stack:
+                sub = stack.pop()
+                if sub in self.program_ir and any(method.name == name for method in self.program_ir[sub].methods):
+                    found.add((sub, name))
+                stack.extend(self.hierarchy.subclasses[sub])
+        return found
+
+    def of_call(self, clazz, instr):
+        fields = set()
+        for target in self.targets(clazz, instr):
+            fields |= self.writes[target]
+        return fields
+
+
+class Expr:
+    # A value on the stack computed by instructions start to end of the block, invariant in the loop
+    # Worth hoisting if it does more than push a constant or local
+
+    __slots__ = ("start", "end", "worth")
+
+    def __init__(self, start, end, worth):
+        self.start = start
+        self.end = end
+        self.worth = worth
+
+
+class LoopMotion:
+
+    def __init__(self, program_ir, class_map):
+        self.class_map = class_map
+        self.field_writes = FieldWrites(program_ir, class_map)
+
+    def loops(self, method):
+        # Natural loops as (header, set of blocks), smallest first. Back edges go to a block that dominates them
+        found = {}
+        for block in method.blocks:
+            for succ in block.succs:
+                if method.dominates(succ, block):
+                    body = found.setdefault(succ, {succ})
+                    stack = [block]
+                    while stack:
+                        b = stack.pop()
+                        if b not in body:
+                            body.add(b)
+                            stack.extend(b.preds)
+        return sorted(found.items(), key=lambda loop: len(loop[1]))
+
+    def invariant_exprs(self, clazz, block, stored, written):
+        # The maximal invariant expressions worth hoisting in the block, as (start, end)
+        found = []
+        stack = []
+
+        def used(exprs):
+            # Values used by something that isn't invariant
+            found.extend((e.start, e.end) for e in exprs if e is not None and e.worth)
+
+        for i, instr in enumerate(block.instrs):
+            effect = ir.stack_effect(instr, self.class_map, clazz)
+            if effect is None:
+                # Don't know what it does to the stack
+                used(stack)
+                stack = []
+                continue
+            pops, pushes = effect
+            args = [stack.pop() if stack else None for _ in range(pops)][::-1]
+
+            result = None
+            if instr.op == "const" or (instr.op == "load" and instr.operand not in stored):
+                result = Expr(i, i, False)
+            elif (instr.op in PURE_OPS or (instr.op == "call_direct" and instr.operand in PURE_CALLS)
+                  or (instr.op == "load_field" and field_name(instr.operand) not in written)):
+                # Invariant if its operands are, and they are the instructions right before it
+                if (all(e is not None for e in args) and args[-1].end == i - 1
+                        and all(args[k].end + 1 == args[k + 1].start for k in range(len(args) - 1))):
+                    result = Expr(args[0].start, i, True)
+
+            if result is None:
+                used(args)
+            if pushes:
+                stack.append(result)
+        used(stack) # Values left for the next block
+        return found
+
+    def hoist(self, clazz, method, header, body):
+        # Moves the loop's invariant expressions before it, returns the number moved. Nothing is moved
+        # unless the loop is entered from one block that only goes to the loop
+        outside = [pred for pred in header.preds if pred not in body]
+        if len(outside) != 1 or outside[0].succs != [header]:
+            return 0
+        preheader = outside[0]
+
+        stored = set()
+        written = set()
+        for block in body:
+            for instr in block.instrs:
+                if instr.op == "store":
+                    stored.add(instr.operand)
+                elif instr.op == "store_field":
+                    written.add(field_name(instr.operand))
+                elif instr.op in ir.CALLS:
+                    written |= self.field_writes.of_call(clazz, instr)
+
+        temps = {} # Expression instructions -> local holding its value
+        first = sum(1 for var in method.locals if var.startswith("__licm")) # Earlier loops' temps
+        hoisted = []
+        for block in sorted(body, key=lambda b: b.index):
+            exprs = self.invariant_exprs(clazz, block, stored, written)
+            if not exprs:
+                continue
+            instrs = []
+            last = 0
+            for start, end in sorted(exprs):
+                code = tuple(block.instrs[start:end + 1])
+                if code not in temps:
+                    temps[code] = f"__licm{first + len(temps)}"
+                    hoisted.extend(code)
+                    hoisted.append(ir.Instr("store", temps[code]))
+                instrs.extend(block.instrs[last:start])
+                instrs.append(ir.Instr("load", temps[code]))
+                last = end + 1
+            instrs.extend(block.instrs[last:])
+            block.instrs = instrs
+
+        if not temps:
+            return 0
+        end = len(preheader.instrs)
+        if preheader.instrs and preheader.instrs[-1].op == "jump":
+            end -= 1
+        preheader.instrs[end:end] = hoisted
+        method.locals = method.locals + list(temps.values())
+        return len(temps)
+
+    def move(self, clazz, method):
+        # Hoists invariant code out of every loop of the method, inner loops first
+        moved = 0
+        done = set()
+        changed = True
+        while changed:
+            changed = False
+            for header, body in self.loops(method):
+                if not header.labels or header.labels[0] in done:
+                    continue
+                done.add(header.labels[0])
+                count = self.hoist(clazz, method, header, body)
+                if count:
+                    moved += count
+                    method.set_code(method.instrs())
+                    changed = True
+                    break
+        return moved
+
+
+def move_all(program_ir, class_map):
+    # Hoists loop invariant code in every method, program_ir maps class -> ClassIR
+    motion = LoopMotion(program_ir, class_map)
+    moved = {}
+    for clazz in program_ir:
+        moved[clazz] = 0
+        for method in program_ir[clazz].methods:
+            count = motion.move(clazz, method)
+            if count > 0:
+                logger.info(f"Hoisted {count} loop invariant computations in method {clazz}:{method.name}")
+            moved[clazz] += count
+    return moved
+
+
+if __name__ == "__main__":
+    from default_class_map import default_class_map
+    log_helper.setup_logging("INFO")
+    # while i < this.n { s = s + this.r * this.r; i = i + 1; }
+    class_map = dict(default_class_map)
+    class_map["C"] = {"superclass": "Obj", "method_args": {"$constructor": [], "f": []}}
+    method = ir.MethodIR("f", [], ["i", "s"], [
+        ir.Instr("enter"),
+        ir.Instr("jump", "whilecond_1"),
+        ir.label("whileloop_1"),
+        ir.Instr("load", "$"),
+        ir.Instr("load_field", "$:r"),
+        ir.Instr("load", "$"),
+        ir.Instr("load_field", "$:r"),
+        ir.Instr("mul"),
+        ir.Instr("load", "s"),
+        ir.Instr("add"),
+        ir.Instr("store", "s"),
+        ir.Instr("const", "1"),
+        ir.Instr("load", "i"),
+        ir.Instr("add"),
+        ir.Instr("store", "i"),
+        ir.label("whilecond_1"),
+        ir.Instr("load", "$"),
+        ir.Instr("load_field", "$:n"),
+        ir.Instr("load", "i"),
+        ir.Instr("jump_if_lt", "whileloop_1"),
+        ir.Instr("load", "s"),
+        ir.Instr("return", "0")
+    ])
+    program_ir = {"C": ir.ClassIR("C", "Obj", ["r", "n"], ["f"])}
+    program_ir["C"].methods = [method]
+    print(f"Expect {{'C': 2}}, got {move_all(program_ir, class_map)}")
+    print("\n".join(method.dump()))
@@ -0,0 +1,194 @@
+"""
+Links the object files of a program into one prelinked image, which the VM loads in a single read
+
+Starting from the main class, every class the program references is read from its JSON object file and given
+a place in one class table, superclasses before their subclasses. The image holds a global constant pool, the
+class table with each vtable already laid out, and the code of all methods back to back. Constant operands
+index the global pool and class operands index the class table, so the loader never searches by name.
+Built in classes are only named, the VM supplies them
+"""
+
+import os
+import sys
+import glob
+import json
+import struct
+import logging
+import argparse
+
+import log_helper
+
+import assemble
+
+logger = logging.getLogger("link")
+
+# ----------------
+# The image format, which MUST match the reader in vm_loader.c. Numbers are 32 bit little-endian words,
+# and strings are packed as in the binary object files (see assemble.py):
+#
+#   header:     "TVMI", version, n_classes, n_constants, n_words
+#   constants:  n_constants times kind ('i' or 's'), value string
+#   classes:    n_classes times name string, superclass index, n_fields, n_methods,
+#               then n_methods vtable entries
+#   code:       the n_words code words
+#
+# A built in class has superclass index -1 and no fields or methods, as the VM already has it. A vtable entry
+# is the method's offset in the code, or one of the markers below
+#
+IMAGE_MAGIC = b"TVMI"
+IMAGE_VERSION = 1
+BUILTIN_CLASSES = ("Obj", "String", "Boolean", "Int", "Nothing") # Must match vm_loader_init
+INHERITED = -1 # Slot copied from the superclass once the VM has it, for methods of built in classes
+NO_METHOD = -2 # Slot declared but never defined
+CLASS_OPS = ("new", "is_instance")
+
+
+class Linker:
+
+    def __init__(self, obj_dir):
+        self.obj_dir = obj_dir
+        self.modules = {} # Class -> its object file contents
+        self.classes = [] # Class table order
+        self.index = {} # Class -> position in the class table
+        self.constants = [] # Global pool of (kind, value)
+        self.constant_index = {} # (kind, value) -> position in the pool
+        self.vtables = {} # Class -> vtable entries
+        self.code = []
+        self.opcodes = {instr.code: instr for instr in assemble.INSTRS.ops.values()}
+
+    def load(self, clazz):
+        path = os.path.join(self.obj_dir, f"{clazz}.json")
+        with open(path, "r") as f:
+            self.modules[clazz] = json.load(f)
+
+    def visit(self, clazz):
+        # Adds the class to the class table after its superclass, then the classes it imports
+        if clazz in self.modules:
+            return
+        self.load(clazz)
+        if clazz not in BUILTIN_CLASSES:
+            self.visit(self.modules[clazz]["super"])
+        self.index[clazz] = len(self.classes)
+        self.classes.append(clazz)
+        if clazz not in BUILTIN_CLASSES:
+            for imported in self.modules[clazz]["imports"]:
+                self.visit(imported)
+
+    def constant(self, constant):
+        key = (constant["kind"], constant["value"])
+        if key not in self.constant_index:
+            self.constant_index[key] = len(self.constants)
+            self.constants.append(key)
+        return self.constant_index[key]
+
+    def link_class(self, clazz):
+        # Appends the class's code with operands resolved, and lays out its vtable
+        module = self.modules[clazz]
+        const_map = [self.constant(constant) for constant in module["constants"]]
+        class_map = [self.index[imported] for imported in module["imports"]]
+
+        superclass = module["super"]
+        n_super = len(self.modules[superclass]["methods"])
+        vtable = [NO_METHOD] * module["n_methods"]
+        for slot in range(min(module["n_inherited"], n_super)):
+            vtable[slot] = INHERITED if superclass in BUILTIN_CLASSES else self.vtables[superclass][slot]
+
+        for method in module["code"]:
+            vtable[method["slot"]] = len(self.code)
+            words = method["code"]
+            i = 0
+            while i < len(words):
+                instr = self.opcodes[words[i]]
+                self.code.append(words[i])
+                if instr.ops != "0":
+                    operand = words[i + 1]
+                    if instr.name == "const" and operand >= 0:
+                        operand = const_map[operand] # Named literals stay negative
+                    elif instr.name in CLASS_OPS:
+                        operand = class_map[operand]
+                    elif instr.name == "call_direct":
+                        operand = (class_map[operand >> assemble.DIRECT_CALL_SHIFT] << assemble.DIRECT_CALL_SHIFT
+                                   | operand & ((1 << assemble.DIRECT_CALL_SHIFT) - 1))
+                    self.code.append(operand)
+                i += 1 + (instr.ops != "0")
+        self.vtables[clazz] = vtable
+        logger.debug(f"Linked {clazz}, {len(module['code'])} methods")
+
+    def link(self, main_class):
+        # The image of the program whose main class is main_class
+        self.visit(main_class)
+        for clazz in self.classes:
+            if clazz not in BUILTIN_CLASSES:
+                self.link_class(clazz)
+
+        parts = [IMAGE_MAGIC,
+                 assemble.pack_words(IMAGE_VERSION, len(self.classes), len(self.constants), len(self.code))]
+        for kind, value in self.constants:
+            parts.append(assemble.pack_words(ord(kind[0])))
+            parts.append(assemble.pack_string(value))
+        for clazz in self.classes:
+            parts.append(assemble.pack_string(clazz))
+            if clazz in BUILTIN_CLASSES:
+                parts.append(assemble.pack_words(-1, 0, 0))
+                continue
+            module = self.modules[clazz]
+            parts.append(assemble.pack_words(self.index[module["super"]], module["n_fields"], module["n_methods"]))
+            parts.append(assemble.pack_words(*self.vtables[clazz]))
+        parts.append(assemble.pack_words(*self.code))
+        logger.info(f"Linked {len(self.classes)} classes, {len(self.constants)} constants "
+                    f"and {len(self.code)} code words for {main_class}")
+        return b"".join(parts)
+
+
+def image_classes(path):
+    # The names in the class table of an image file, or None if it isn't one
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(IMAGE_MAGIC)] != IMAGE_MAGIC:
+        return None
+    _, n_classes, n_constants, _ = struct.unpack_from("<4i", data, len(IMAGE_MAGIC))
+    pos = len(IMAGE_MAGIC) + 16
+    for _ in range(n_constants):
+        _, pos = assemble.unpack_string(data, pos + 4) # After the kind
+    classes = []
+    for _ in range(n_classes):
+        name, pos = assemble.unpack_string(data, pos)
+        _, _, n_methods = struct.unpack_from("<3i", data, pos)
+        pos += 4 * (3 + n_methods)
+        classes.append(name)
+    return classes
+
+
+def remove_stale_images(obj_dir, classes):
+    # Removes the images in obj_dir that any of the classes is linked into, as they are out of date once the
+    # classes are compiled again. Returns the paths removed
+    classes = set(classes)
+    removed = []
+    for path in sorted(glob.glob(os.path.join(obj_dir, "*.tvmi"))):
+        linked = image_classes(path)
+        if linked is None or classes.intersection(linked):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Links a compiled Quack program into one image for the VM")
+    parser.add_argument("--log-level", "-D", metavar="log-level", default="INFO", help="Specifies the log level. Default INFO")
+    parser.add_argument("--obj-dir", "-j", metavar="dir", default="OBJ", help="Where the JSON object files are. Default OBJ/")
+    parser.add_argument("--output", "-o", metavar="file", default=None, help="The image file. Default <obj-dir>/<main class>.tvmi")
+    parser.add_argument("main_class", metavar="<main class>", help="The program's main class")
+    args = parser.parse_args()
+    log_helper.setup_logging(args.log_level)
+
+    image = Linker(args.obj_dir).link(args.main_class)
+    output = args.output
+    if output is None:
+        output = os.path.join(args.obj_dir, f"{args.main_class}.tvmi")
+    with open(output, "wb") as f:
+        f.write(image)
+    logger.info(f"Successfully written image to file {output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Liveness analysis on the IR, and local slot sharing. Runs after dead code elimination
+
+A local is live where its current value may still be loaded. Locals that are never live at the same time
+share a slot in the activation record, which shrinks every frame of the method
+"""
+
+import logging
+import log_helper
+
+import ir
+
+logger = logging.getLogger("liveness")
+
+
+def live_sets(method):
+    # Backwards dataflow over the blocks. Returns block -> locals live on entry, and block -> live on exit
+    local_vars = set(method.locals)
+    uses = {}
+    defs = {}
+    for block in method.blocks:
+        # Locals loaded before any store in the block, and locals stored in the block
+        use = set()
+        kill = set()
+        for instr in block.instrs:
+            if instr.operand not in local_vars:
+                continue
+            if instr.op == "load" and instr.operand not in kill:
+                use.add(instr.operand)
+            elif instr.op == "store":
+                kill.add(instr.operand)
+        uses[block] = use
+        defs[block] = kill
+
+    live_in = {block: set() for block in method.blocks}
+    live_out = {block: set() for block in method.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(method.blocks):
+            out = set()
+            for succ in block.succs:
+                out |= live_in[succ]
+            new_in = uses[block] | (out - defs[block])
+            if out != live_out[block] or new_in != live_in[block]:
+                live_out[block] = out
+                live_in[block] = new_in
+                changed = True
+    return live_in, live_out
+
+
+def interference(method):
+    # Pairs of locals that are live at the same time. A store interferes with everything else live after it
+    _, live_out = live_sets(method)
+    local_vars = set(method.locals)
+    edges = {var: set() for var in method.locals}
+    used = set()
+    for block in method.blocks:
+        live = set(live_out[block])
+        for instr in reversed(block.instrs):
+            if instr.operand not in local_vars:
+                continue
+            var = instr.operand
+            used.add(var)
+            if instr.op == "store":
+                for other in live:
+                    if other != var:
+                        edges[var].add(other)
+                        edges[other].add(var)
+                live.discard(var)
+            elif instr.op == "load":
+                live.add(var)
+    return edges, used
+
+
+def share_slots(method):
+    # Gives locals that don't interfere the same slot, renaming them in place to the first local in their slot
+    # Locals the method never loads or stores get no slot. Returns the number of slots before and after
+    edges, used = interference(method)
+    slots = [] # The locals in each slot, first one names it
+    rename = {}
+    for var in method.locals:
+        if var not in used:
+            continue
+        for slot in slots:
+            if not any(other in edges[var] for other in slot):
+                slot.append(var)
+                break
+        else:
+            slot = [var]
+            slots.append(slot)
+        rename[var] = slot[0]
+
+    before = len(method.locals)
+    for block in method.blocks:
+        block.instrs = [ir.Instr(instr.op, rename[instr.operand])
+                        if instr.op in ["load", "store"] and instr.operand in rename else instr
+                        for instr in block.instrs]
+    method.locals = [slot[0] for slot in slots]
+    return before, len(method.locals)
+
+
+def share_all(program_ir):
+    # Shares local slots in every method, program_ir maps class -> ClassIR
+    for clazz in program_ir:
+        for method in program_ir[clazz].methods:
+            before, after = share_slots(method)
+            report = logger.info if after < before else logger.debug
+            report(f"Method {clazz}:{method.name} uses {after} local slots instead of {before}")
+
+
+if __name__ == "__main__":
+    log_helper.setup_logging("INFO")
+    # a = 1; a.print(); b = 2; c = b; b + c. a shares a slot with b, but c is live with b
+    method = ir.MethodIR("f", [], ["a", "b", "c", "unused"], [
+        ir.Instr("enter"),
+        ir.Instr("const", "1"),
+        ir.Instr("store", "a"),
+        ir.Instr("load", "a"),
+        ir.Instr("call", "Int:print"),
+        ir.Instr("pop"),
+        ir.Instr("const", "2"),
+        ir.Instr("store", "b"),
+        ir.Instr("load", "b"),
+        ir.Instr("store", "c"),
+        ir.Instr("load", "b"),
+        ir.Instr("load", "c"),
+        ir.Instr("call", "Int:plus"),
+        ir.Instr("return", "0")
+    ])
+    print(f"Expect (4, 2), got {share_slots(method)}")
+    print("\n".join(method.dump()))
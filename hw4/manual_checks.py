@@ -11,14 +11,13 @@ Manual checks including
 Covariance/contravariance checks for method overriding happen in type_inf
 """
 
-from lark import Lark, v_args, Tree, Token
-from lark.visitors import Visitor_Recursive
 import sys
 import logging
 import log_helper
 
+import quack_ast as ast
 from default_class_map import default_class_map
-from type_inf import LATTICE_TOP, LATTICE_BOTTOM, tree_type_table
+from class_hierarchy import ClassHierarchy, ROOT
 
 logger = logging.getLogger("manual-checks")
 
@@ -32,181 +31,49 @@ def compile_error(msg):
 def cycle_check(classes):
     """
     Checks for cycle in clazzes, which is a list of (class, superclass)
-    Based on union find algorithm
+    Walks each class up to an already placed class, so every class is visited once
     """
-    sc = {}
-    for clazz, superclass in classes:
-        class_set = sc.get(clazz, clazz)
+    superclasses = dict(classes)
+    for _, superclass in classes:
+        if superclass not in superclasses:
+            superclasses[superclass] = ROOT # Treat undeclared superclasses as roots
 
-        superclass_set = sc.get(superclass, superclass)
-
-        if class_set != superclass_set:
-            # They belong to different sets. Merge disjoint set
-
-            for c in sc:
-                if sc[c] == class_set:
-                    sc[c] = superclass_set
-            sc[superclass] = superclass_set
-            sc[clazz] = superclass_set
-        else:
-            # Part of same set. Cycle found!
-            return True
-
-    return False
+    return ClassHierarchy().add_classes(superclasses) is not None
         
 
-class ManualChecks(Visitor_Recursive):
+class ManualChecks(ast.Visitor):
 
-    def __init__(self, class_map=default_class_map):
+    def __init__(self, hierarchy, class_map=default_class_map):
         self.class_map = class_map
+        self.hierarchy = hierarchy
         self.uniq_classes = set()
         self.uniq_methods = set()
 
-        # Check no cycles in class graph
-        classes = [(x, self.class_map[x]["superclass"]) for x in class_map]
-        logger.trace(f"Performing cycle check with class hierarchy {classes}")
-        if cycle_check(classes):
-            compile_error(f"Cycle detected in the class hierarchy!")
-        logger.debug("Cycle detection completed with no errors")
-
     def lca(self, clazz1, clazz2):
         # Least common ancestor algorithm
         logger.trace(f"Performing lca algorithm with operands {clazz1} {clazz2}")
+        return self.hierarchy.lca(clazz1, clazz2)
 
-        # Checks for top/bottom of lattice
-        if clazz1 == LATTICE_TOP or clazz2 == LATTICE_TOP:
-            return LATTICE_TOP
-        if clazz1 == LATTICE_BOTTOM:
-            return clazz2
-        if clazz2 == LATTICE_BOTTOM:
-            return clazz1
-
-        # Do actual LCA algorithm by comparing superclass lineage
-        clazz1_lineage = []
-        clazz2_lineage = []
-        c = clazz1
-        while c != "$":
-            clazz1_lineage.insert(0, c)
-            if c not in self.class_map:
-                compile_error(f"Cannot find class {c}")
-            c = self.class_map[c]["superclass"]
-        c = clazz2
-        while c != "$":
-            clazz2_lineage.insert(0, c)
-            if c not in self.class_map:
-                compile_error(f"Cannot find class {c}")
-            c = self.class_map[c]["superclass"]
-
-        if clazz1_lineage[0] != clazz2_lineage[0]:
-            # No match found, return type error
-            return LATTICE_TOP
-        
-        i = 0
-        while i < len(clazz1_lineage) and i < len(clazz2_lineage) and clazz1_lineage[i] == clazz2_lineage[i]:
-            i += 1
-
-        return clazz1_lineage[i-1]
-
-
-    def infer_type(self, ident):
-        # Attempts to infer the type of this tree
-
-        if isinstance(ident, Tree):
-            # Check for default cases
-            if ident.data == "this_ptr":
-                return self.curr_class
-
-            if ident.data in tree_type_table:
-                return tree_type_table[ident.data]
-
-            # Check for fields
-            elif ident.data.startswith("identifier_field"):
-                if "this" in ident.data:
-                    clazz = self.curr_class
-                    name = self.get_ident_name(ident.children[0])
-                else:
-                    clazz = self.infer_type(ident.children[0])
-                    name = self.get_ident_name(ident.children[1])
-                if clazz not in self.class_map:
-                    compile_error(f"Attempted to get field from unknown class {clazz}")
-                return self.class_map[clazz]["field_list"].get(name, LATTICE_BOTTOM)
-
-            # Identifiers may be nested but will have a token eventually
-            elif ident.data.startswith("identifier"):
-                name = self.get_ident_name(ident.children[0])
-                return self.class_map[self.curr_class]["method_locals"][self.curr_method].get(name, LATTICE_BOTTOM)
-
-            elif ident.data == "method_invocation":
-                # See what type the calling object is first
-                clazz = self.infer_type(ident.children[1])
-                # Look for return type of method
-                method = self.get_ident_name(ident.children[0])
-                if method not in self.class_map[clazz]["method_returns"]:
-                    compile_error(f"Attempted to get return type of unknown method {method} in class {clazz}")
-                return self.class_map[clazz]["method_returns"][method]
-
-            elif ident.data == "obj_instantiation":
-                return self.get_ident_name(ident.children[0])
-            else:
-                compile_error(f"Attempted to infer type of unknown tree {ident}")
-
-        elif isinstance(ident, Token):
-            if ident.type == "INT":
-                return "Int"
-            elif ident.type == "ESCAPED_STRING":
-                return "String"
-            else:
-                compile_error(f"Attempted to infer type of unknown Token {ident}")
-
-        else:
-            compile_error(f"Attempted to infer type of unknown object {ident}")
-
-    def get_ident_name(self, ident):
-        # Gets the actual name of an identifier
-
-        if isinstance(ident, Tree):
-            # For identifiers, just recurse
-            if ident.data.startswith("identifier"):
-                if "field" in ident.data and "this" not in ident.data:
-                    return self.get_ident_name(ident.children[1])
-                return self.get_ident_name(ident.children[0]) # Recurse on only child
-            else:
-                compile_error(f"Attempted to get identifier name in unknown tree type {ident.data} {ident}")
-        elif isinstance(ident, Token):
-            return ident.value
-        else:
-            compile_error(f"Attempted to get identifier name in unrecognizable object {ident}")
 
-    def identifier_lhand(self, tree):
+    def identifier(self, tree):
         logger.trace(f"Checking if ident does not clash with existing class for tree {tree}")
-        ident = self.get_ident_name(tree)
+        ident = tree.name
         if ident in self.uniq_classes:
             compile_error(f"Identifier {ident} has clashing name with existing class")
 
-    def identifier_field_lhand(self, tree):
-        self.identifier_lhand(tree) 
-
-    def identifier_field_lhand_this(self, tree):
-        self.identifier_lhand(tree)
-
-    def identifier_rhand(self, tree):
-        self.identifier_lhand(tree)
-
-    def identifier_field_rhand(self, tree):
-        self.identifier_lhand(tree)
-
-    def identifier_field_rhand_this(self, tree):
-        self.identifier_lhand(tree)
+    def field(self, tree):
+        self.identifier(tree)
+        if tree.obj.type not in self.class_map:
+            compile_error(f"Attempted to get field from unknown class {tree.obj.type}")
 
     def method_invocation(self, tree):
-        method = self.get_ident_name(tree.children[0])
+        method = tree.method
         logger.trace(f"Checking method invocation of {method} in {self.curr_method} of {self.curr_class}")
         logger.trace(f"{tree}")
-        clazz = self.infer_type(tree.children[1])
-        given_args = tree.children[2:]
-        if len(given_args) > 0 and given_args[0].data == "method_args":
-            # Look at children
-            given_args = given_args[0].children
+        clazz = tree.receiver.type
+        if clazz not in self.class_map or method not in self.class_map[clazz]["method_args"]:
+            compile_error(f"Attempted to get return type of unknown method {method} in class {clazz}")
+        given_args = tree.args
         method_args = self.class_map[clazz]["method_args"][method]
 
         if len(given_args) != len(method_args):
@@ -214,21 +81,21 @@ class ManualChecks(Visitor_Recursive):
 
         for i, child in enumerate(given_args):
             decl_type = self.class_map[clazz]["method_args"][method][i]
-            infr_type = self.infer_type(child)
+            infr_type = child.type
 
-            if self.lca(decl_type, infr_type) != decl_type:
+            if not self.hierarchy.is_subtype(infr_type, decl_type):
                 compile_error(f"Method invocation of {method} within class method {self.curr_method} of {self.curr_class} has unexpected type for arg {i}, expected {decl_type} got {infr_type}")
 
     def return_statement(self, tree):
         logger.trace(f"Checking return statement {self.curr_method} of {self.curr_class}")
         decl_type = self.class_map[self.curr_class]["method_returns"][self.curr_method]
-        infr_type = self.infer_type(tree.children[0])
+        infr_type = tree.value.type
 
-        if self.lca(decl_type, infr_type) != decl_type:
+        if not self.hierarchy.is_subtype(infr_type, decl_type):
             compile_error(f"Method return within class method {self.curr_method} of {self.curr_class} has unexpected type, expected {decl_type} got {infr_type}")
 
     def class_method(self, tree):
-        method = self.get_ident_name(tree.children[0])
+        method = tree.name
         logger.trace(f"Checking method redefinition of {method} of {self.curr_class}")
         if method in self.uniq_methods:
             compile_error(f"Detected redefinition of method {method} in class {self.curr_class}")
@@ -239,7 +106,7 @@ class ManualChecks(Visitor_Recursive):
         return tree
 
     def clazz(self, tree):
-        clazz = self.get_ident_name(tree.children[0])
+        clazz = tree.name
         logger.trace(f"Checking class redefinition of {clazz}")
         if clazz in self.uniq_classes:
             compile_error(f"Detected redefinition of class {clazz}")
@@ -251,20 +118,16 @@ class ManualChecks(Visitor_Recursive):
 
     def visit(self, tree):
 
-        if not isinstance(tree, Tree):
-            return tree
-
         # For class and class method, preorder traversal
-        elif tree.data == "clazz":
+        if isinstance(tree, ast.Clazz):
             
             self.clazz(tree)
-            self.visit(tree.children[2])
+            self.visit_all(tree.methods)
 
-        elif tree.data == "class_method":
+        elif isinstance(tree, ast.ClassMethod):
    
             self.class_method(tree)
-            for child in tree.children:
-                self.visit(child)
+            self.visit_all(tree.body)
 
         else:
             # Default to super
@@ -273,9 +136,36 @@ class ManualChecks(Visitor_Recursive):
         return tree
 
 
-def check(tree, class_map):
+def check_hierarchy(tree):
+    """
+    Checks the classes declared in the program extend known classes without cycles,
+    then sorts tree.classes so superclasses come before their subclasses
+    Returns the ClassHierarchy over the builtin and program classes, reused by the later passes
+    """
+    hierarchy = ClassHierarchy(default_class_map)
+
+    superclasses = {}
+    for clazz in tree.classes:
+        if clazz.name not in hierarchy: # Redefinitions are reported by ManualChecks
+            superclasses.setdefault(clazz.name, clazz.superclass)
+    for clazz, superclass in superclasses.items():
+        if superclass not in superclasses and superclass not in hierarchy:
+            compile_error(f"Class {clazz} inherits from unknown superclass {superclass}")
+
+    # Check no cycles in class graph. Only the program classes are walked, the builtins are already placed
+    logger.trace(f"Performing cycle check with class hierarchy {superclasses}")
+    if hierarchy.add_classes(superclasses) is not None:
+        compile_error(f"Cycle detected in the class hierarchy!")
+    logger.debug("Cycle detection completed with no errors")
+
+    position = {clazz: i for i, clazz in enumerate(hierarchy.order)}
+    tree.classes.sort(key=lambda clazz: position.get(clazz.name, -1))
+    hierarchy.number_intervals()
+    return hierarchy
+
+def check(tree, class_map, hierarchy):
     logger.trace("Attempting to perform final tree and class hierarchy validation")
-    mc = ManualChecks(class_map);
+    mc = ManualChecks(hierarchy, class_map);
     mc.visit(tree)
     logger.debug("Successfully checked tree and class hierarchy")
 
@@ -288,4 +178,3 @@ if __name__ == "__main__":
     set2 = [("class1", "class2"), ("class2", "class3"), ("class3", "class4"), ("class4", "class1")]
     print(set2)
     print(cycle_check(set2))
-
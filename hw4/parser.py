@@ -5,12 +5,25 @@ Handles parsing the language and perform tree transformation cleanup
 from lark import Lark, v_args, Tree, Token, tree as lark_tree
 from lark.visitors import Transformer
 from lark.exceptions import UnexpectedInput
+import lark
+import os
 import sys
+import glob
+import hashlib
 import logging
 import log_helper
 
+import quack_ast as ast
+
 logger = logging.getLogger("quack-parser")
 
+# Where the built LALR parser is cached between compiler runs
+PARSER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+PARSER_CACHE_PREFIX = "quack_parser_"
+
+# The parser built (or loaded from cache) by this process, see get_parser()
+_quack_parser = None
+
 def compile_error(msg):
     logger.fatal(f"COMPILE ERROR: {msg}")
     sys.exit(1)
@@ -134,6 +147,21 @@ quack_grammar = """
 %ignore CPP_COMMENT
 """
 
+def escape_long_string(s):
+    # Turns a long string literal into an escaped, double quoted one on one line
+
+    # Remove surrounding quotes
+    if s.startswith("\"\"\"") or s.startswith("'''"):
+        s = s[3:-3]
+    if s.startswith("\""):
+        s = s[1:-1]
+
+    # Unescaping this string was difficult, I tried re.escape(s), 
+    # s.encode(unicode_escape), ast.literal_eval(s), r({}).format(s)
+    # TODO there has to be a cleaner way to encode string literals
+    return "\"" + repr(s)[1:-1] + "\""
+
+
 @v_args(tree=True)
 class MethodInvokeCleanup(Transformer):
     # Desugars method invocations
@@ -247,18 +275,7 @@ class StringLiteralCleanup(Transformer):
 
         tree.data = "string_literal"
 
-        # Remove surrounding quotes
-        s = tree.children[0].value
-        if s.startswith("\"\"\"") or s.startswith("'''"):
-            s = s[3:-3]
-        if s.startswith("\""):
-            s = s[1:-1]
-
-        # Unescaping this string was difficult, I tried re.escape(s), 
-        # s.encode(unicode_escape), ast.literal_eval(s), r({}).format(s)
-        # TODO there has to be a cleaner way to encode string literals
-        s = "\"" + repr(s)[1:-1] + "\""
-        tree.children[0].value = s
+        tree.children[0].value = escape_long_string(tree.children[0].value)
         return tree        
 
 @v_args(tree=True)
@@ -394,6 +411,339 @@ class MethodReturnCleanup(Transformer):
             logger.trace("Desugaring blank return to return none")
             tree.children.append(Tree("nothing_literal", []))
         return tree
+
+class ASTBuilder(Transformer):
+    # Desugars the program and builds the typed AST of quack_ast.py in one go
+    # Handed to Lark as an inline transformer, so each node is made as the LALR parser reduces its rule
+    # and the tree only gets built once. Does the same rewrites as the cleanup transformers above,
+    # but on AST nodes. Loose statements need the main class name, so they are moved by build_program
+
+    def program(self, children):
+        # Still holds the loose statements after the classes
+        return ast.Program(children)
+
+    def clazz(self, children):
+        # Every class gets a superclass, Obj if none is given, and a $constructor made of its loose statements
+        name, body = children[0], children[-1]
+        args, superclass = [], "Obj"
+        for child in children[1:-1]:
+            if isinstance(child, list):
+                args = child
+            else:
+                superclass = child
+        methods = [item for item in body if isinstance(item, ast.ClassMethod)]
+        statements = [item for item in body if not isinstance(item, ast.ClassMethod)]
+        methods.insert(0, make_method("$constructor", args, name, statements))
+        return ast.Clazz(name, superclass, methods)
+
+    def class_body(self, children):
+        return children
+
+    def class_method(self, children):
+        args = children[1] if len(children) == 4 else []
+        return make_method(children[0], args, children[-2], children[-1])
+
+    def formal_args(self, children):
+        return [(children[i], children[i+1]) for i in range(0, len(children), 2)]
+
+    def statement_block(self, children):
+        return children
+
+    def identifier(self, children):
+        return children[0].value
+
+    def identifier_method(self, children):
+        return children[0]
+
+    def statement(self, children):
+        return ast.Statement(children[0])
+
+    def assignment(self, children):
+        target, value = children
+        return ast.Assignment(target, value)
+
+    def assignment_decl(self, children):
+        target, decl_type, value = children
+        return ast.Assignment(target, value, decl_type)
+
+    def if_structure(self, children):
+        # Each elif becomes an if nested in the else branch of the one before it
+        else_body = children[-1] if len(children) % 2 != 0 else None
+        for i in range(len(children) - len(children) % 2 - 2, 0, -2):
+            else_body = [ast.IfStatement(children[i], children[i+1], else_body)]
+        return ast.IfStatement(children[0], children[1], else_body)
+
+    def while_structure(self, children):
+        return ast.WhileStatement(children[0], children[1])
+
+    def return_statement(self, children):
+        # A blank return returns none
+        return ast.ReturnStatement(children[0] if children else ast.NothingLiteral())
+
+    def typecase_statement(self, children):
+        return ast.TypecaseStatement(children[0], children[1:])
+
+    def type_alt(self, children):
+        name, type_name, body = children
+        return ast.TypeAlt(name, type_name, body)
+
+    def identifier_lhand(self, children):
+        return ast.Identifier(children[0])
+
+    def identifier_rhand(self, children):
+        return ast.Identifier(children[0])
+
+    def identifier_field_lhand_this(self, children):
+        return ast.Field(ast.ThisPtr(), children[0])
+
+    def identifier_field_rhand_this(self, children):
+        return ast.Field(ast.ThisPtr(), children[0])
+
+    def identifier_field_lhand(self, children):
+        obj, name = children
+        return ast.Field(obj, name)
+
+    def identifier_field_rhand(self, children):
+        obj, name = children
+        return ast.Field(obj, name)
+
+    def method_invocation(self, children):
+        args = children[2] if len(children) > 2 else []
+        return ast.MethodInvocation(children[1], children[0], args)
+
+    def method_invocation_self(self, children):
+        args = children[1] if len(children) > 1 else []
+        return ast.MethodInvocation(children[0], ast.ThisPtr(), args)
+
+    def method_args(self, children):
+        return children
+
+    # Binary and unary operators are invocations of the methods named here
+    def method_add(self, children):
+        return ast.MethodInvocation("plus", children[0], [children[1]])
+
+    def method_sub(self, children):
+        return ast.MethodInvocation("minus", children[0], [children[1]])
+
+    def method_mul(self, children):
+        return ast.MethodInvocation("times", children[0], [children[1]])
+
+    def method_div(self, children):
+        return ast.MethodInvocation("divide", children[0], [children[1]])
+
+    def method_neg(self, children):
+        return ast.MethodInvocation("negate", children[0], [])
+
+    def method_eq(self, children):
+        return ast.MethodInvocation("equals", children[0], [children[1]])
+
+    def method_leq(self, children):
+        return ast.MethodInvocation("atmost", children[0], [children[1]])
+
+    def method_geq(self, children):
+        return ast.MethodInvocation("atleast", children[0], [children[1]])
+
+    def method_lt(self, children):
+        return ast.MethodInvocation("less", children[0], [children[1]])
+
+    def method_gt(self, children):
+        return ast.MethodInvocation("more", children[0], [children[1]])
+
+    def obj_instantiation(self, children):
+        args = children[1] if len(children) > 1 else []
+        return ast.ObjInstantiation(children[0], args)
+
+    def string_literal(self, children):
+        return ast.StringLiteral(children[0].value)
+
+    def longstring_literal(self, children):
+        return ast.StringLiteral(escape_long_string(children[0].value))
+
+    def int_literal(self, children):
+        return ast.IntLiteral(children[0].value)
+
+    def boolean_literal_true(self, children):
+        return ast.BooleanLiteral(True)
+
+    def boolean_literal_false(self, children):
+        return ast.BooleanLiteral(False)
+
+    def nothing_literal(self, children):
+        return ast.NothingLiteral()
+
+    def this_ptr(self, children):
+        return ast.ThisPtr()
+
+    def cond_and(self, children):
+        return ast.CondAnd(children[0], children[1])
+
+    def cond_or(self, children):
+        return ast.CondOr(children[0], children[1])
+
+    def cond_not(self, children):
+        return ast.CondNot(children[0])
+
+
+def make_method(name, args, return_type, body):
+    # Makes a method, adding a return statement at its end if there isn't one
+    # The constructor returns this, other methods return none
+
+    # TODO bug involving if statements with returns on every branch
+    if len(body) == 0 or not isinstance(body[-1], ast.ReturnStatement):
+        logger.trace(f"Adding return statement to end of method {name}")
+        body.append(ast.ReturnStatement(ast.ThisPtr() if name == "$constructor" else ast.NothingLiteral()))
+    return ast.ClassMethod(name, args, return_type, body)
+
+
+class ASTLowering(Transformer):
+    # Lowers the tree made by cleanup_passes into the typed AST of quack_ast.py
+    # Identifier trees become plain name strings, blocks and argument lists become Python lists
+    # Only used with cleanup_passes, as the reference ASTBuilder is checked against
+
+    def program(self, children):
+        return ast.Program(children)
+
+    def clazz(self, children):
+        name, superclass, methods = children
+        return ast.Clazz(name, superclass, methods)
+
+    def class_body(self, children):
+        return children
+
+    def class_method(self, children):
+        name, args, return_type, body = children
+        return ast.ClassMethod(name, args, return_type, body)
+
+    def formal_args(self, children):
+        return [(children[i], children[i+1]) for i in range(0, len(children), 2)]
+
+    def statement_block(self, children):
+        return children
+
+    def identifier(self, children):
+        return children[0].value
+
+    def statement(self, children):
+        return ast.Statement(children[0])
+
+    def assignment(self, children):
+        target, value = children
+        return ast.Assignment(target, value)
+
+    def assignment_decl(self, children):
+        target, decl_type, value = children
+        return ast.Assignment(target, value, decl_type)
+
+    def if_structure(self, children):
+        else_body = None
+        if len(children) > 2:
+            # An elif is a nested if_structure rather than a statement_block
+            else_body = children[2] if isinstance(children[2], list) else [children[2]]
+        return ast.IfStatement(children[0], children[1], else_body)
+
+    def while_structure(self, children):
+        return ast.WhileStatement(children[0], children[1])
+
+    def return_statement(self, children):
+        return ast.ReturnStatement(children[0])
+
+    def typecase_statement(self, children):
+        return ast.TypecaseStatement(children[0], children[1:])
+
+    def type_alt(self, children):
+        name, type_name, body = children
+        return ast.TypeAlt(name, type_name, body)
+
+    def identifier_lhand(self, children):
+        return ast.Identifier(children[0])
+
+    def identifier_rhand(self, children):
+        return ast.Identifier(children[0].value)
+
+    def identifier_field_lhand_this(self, children):
+        return ast.Field(ast.ThisPtr(), children[0].value)
+
+    def identifier_field_rhand_this(self, children):
+        return ast.Field(ast.ThisPtr(), children[0].value)
+
+    def identifier_field_lhand(self, children):
+        obj, name = children
+        return ast.Field(obj, name)
+
+    def identifier_field_rhand(self, children):
+        obj, name = children
+        return ast.Field(obj, name)
+
+    def method_invocation(self, children):
+        args = children[2:]
+        if len(args) > 0 and isinstance(args[0], list):
+            # Invocations on this keep their method_args node
+            args = args[0]
+        # The method name is a lowered identifier, or a token for desugared operators
+        return ast.MethodInvocation(str(children[0]), children[1], args)
+
+    def method_args(self, children):
+        return children
+
+    def obj_instantiation(self, children):
+        args = children[1] if len(children) > 1 else []
+        return ast.ObjInstantiation(children[0], args)
+
+    def string_literal(self, children):
+        return ast.StringLiteral(children[0].value)
+
+    def int_literal(self, children):
+        return ast.IntLiteral(children[0].value)
+
+    def boolean_literal_true(self, children):
+        return ast.BooleanLiteral(True)
+
+    def boolean_literal_false(self, children):
+        return ast.BooleanLiteral(False)
+
+    def nothing_literal(self, children):
+        return ast.NothingLiteral()
+
+    def this_ptr(self, children):
+        return ast.ThisPtr()
+
+    def cond_and(self, children):
+        return ast.CondAnd(children[0], children[1])
+
+    def cond_or(self, children):
+        return ast.CondOr(children[0], children[1])
+
+    def cond_not(self, children):
+        return ast.CondNot(children[0])
+
+
+def build_program(program, main_class):
+    # Finishes a program built by the ASTBuilder parser, moving the loose statements into their own class
+    # Only looks at the top level, the rest of the program is already built
+
+    logger.trace(f"Desugaring loose statements into new class {main_class}")
+    classes = [item for item in program.classes if isinstance(item, ast.Clazz)]
+    statements = [item for item in program.classes if not isinstance(item, ast.Clazz)]
+    classes.append(ast.Clazz(main_class, "Obj", [make_method("$constructor", [], main_class, statements)]))
+    program.classes = classes
+    return program
+
+
+def cleanup_passes(tree, main_class):
+    """Desugars a raw parse tree with each cleanup transformer in turn.
+    Much slower than ASTBuilder, and not used by the compiler: together
+    with ASTLowering it is kept only as the reference check_cleanup
+    compares ASTBuilder to.
+    """
+
+    tree = IfStatementCleanup().transform(tree) # Turn elif into nested ifs
+    tree = MethodInvokeCleanup().transform(tree) # Desugar binary ops +-*/ to method invocation
+    tree = StringLiteralCleanup().transform(tree) # Convert """ literals to "
+    tree = IdentifierCleanup().transform(tree) # Cleanup identifier mess grammar creates
+    tree = LooseStatementCleanup(main_class).transform(tree) # Move classless statements into their own class
+    tree = ConstructorCleanup().transform(tree) # Add tree node for constructor method
+    tree = MethodReturnCleanup().transform(tree) # Make every method end with return statement
+    return tree
             
 
 def visualize(tree, filename):
@@ -408,34 +758,120 @@ def visualize(tree, filename):
         logger.warn("Failed to visualize tree", e)
 
 
+def parser_cache_file():
+    # Gets the cache file for the current grammar and lark version
+    # A different grammar or lark install hashes to a different file, forcing a rebuild
+    grammar_hash = hashlib.sha256(quack_grammar.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(PARSER_CACHE_DIR, f"{PARSER_CACHE_PREFIX}{grammar_hash}_lark{lark.__version__}.cache")
+
+
+def get_parser():
+    # Builds the LALR parser, or loads it from the on-disk cache when the grammar hasn't changed
+
+    global _quack_parser
+    if _quack_parser is not None:
+        return _quack_parser
+
+    cache_file = parser_cache_file()
+    if os.path.exists(cache_file):
+        logger.debug(f"Attempting to load the parser from cache {cache_file}")
+    else:
+        logger.debug(f"No parser cache at {cache_file}, building the grammar from scratch")
+        try:
+            os.makedirs(PARSER_CACHE_DIR, exist_ok=True)
+
+            # Throw away caches of older grammars so they don't pile up
+            for stale in glob.glob(os.path.join(PARSER_CACHE_DIR, PARSER_CACHE_PREFIX + "*")):
+                os.remove(stale)
+        except OSError as e:
+            logger.warning(f"Failed to prepare parser cache directory {PARSER_CACHE_DIR}: {e}")
+
+    # Lark writes the cache itself, and falls back to a full build if the file is unusable
+    # The transformer isn't part of the cache key, it is attached after loading
+    _quack_parser = Lark(quack_grammar, parser="lalr", cache=cache_file, transformer=ASTBuilder())
+    return _quack_parser
+
+
 def parse(prgm_text, main_class="Main"):
-    # Lexes and parses the prgm
+    # Lexes and parses the prgm into the typed AST
 
     logger = logging.getLogger("quack-parser")
 
     # Lex the program
     logger.debug("Attempting to parse the grammer")
-    quack_lexer = Lark(quack_grammar, parser="lalr")
+    quack_lexer = get_parser()
     logger.debug("Atetmpting to generate the tree")
     try:
-        tree = quack_lexer.parse(prgm_text)
+        program = quack_lexer.parse(prgm_text)
     except UnexpectedInput as e:
         msg = f"\n{str(e)}\nContext:\n\n{e.get_context(prgm_text)}"
         logger.critical(msg)
         compile_error("Program failed lexing/parsing state")
     logger.debug("Successfully generated the AST")
 
-    # Cleanup the tree
+    # Most of the program was desugared and built during parsing by ASTBuilder
     logger.debug("Attempting to transform the tree")
-    tree = IfStatementCleanup().transform(tree) # Turn elif into nested ifs
-    tree = MethodInvokeCleanup().transform(tree) # Desugar binary ops +-*/ to method invocation
-    tree = StringLiteralCleanup().transform(tree) # Convert """ literals to "
-    tree = IdentifierCleanup().transform(tree) # Cleanup identifier mess grammar creates
-    tree = LooseStatementCleanup(main_class).transform(tree) # Move classless statements into their own class
-    tree = ConstructorCleanup().transform(tree) # Add tree node for constructor method
-    tree = MethodReturnCleanup().transform(tree) # Make every method end with return statement
-    logger.trace(f"Transformed tree: {tree}")
+    program = build_program(program, main_class)
+    logger.trace(f"Transformed tree: {program}")
     logger.debug("Successfully transformed the tree")
 
-    return tree
+    return program
+
+
+def parse_tree(prgm_text, main_class="Main"):
+    # Parses the prgm into a cleaned up lark tree, as cleanup_passes makes it. Used for visualizing
+    raw_parser = Lark(quack_grammar, parser="lalr", cache=parser_cache_file())
+    return cleanup_passes(raw_parser.parse(prgm_text), main_class)
+
+
+def lower(tree):
+    # Lowers a tree returned by parse_tree() into the typed AST
+
+    logger.debug("Attempting to lower the tree into the AST")
+    program = ASTLowering().transform(tree)
+    logger.debug("Successfully lowered the tree")
+    return program
+
+
+def same_ast(node1, node2):
+    # Checks two ASTs are identical, field by field
+
+    if isinstance(node1, (list, tuple)) and isinstance(node2, (list, tuple)):
+        return type(node1) == type(node2) and len(node1) == len(node2) and \
+            all(same_ast(c1, c2) for c1, c2 in zip(node1, node2))
+    if isinstance(node1, ast.Node) and isinstance(node2, ast.Node):
+        fields = [name for clazz in type(node1).__mro__ for name in getattr(clazz, "__slots__", ())]
+        return type(node1) == type(node2) and \
+            all(same_ast(getattr(node1, name), getattr(node2, name)) for name in fields)
+    return node1 == node2
+
+
+def source_files():
+    # Every program in src/
+    return sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "*.qk")))
+
+
+def check_cleanup(files):
+    # Checks ASTBuilder gives the same AST as the separate cleanup passes followed by ASTLowering
+    # Returns the files where they differ
+    failed = []
+    for prgm_file in files:
+        with open(prgm_file, "r") as f:
+            prgm_text = f.read()
+        main_class = "".join(os.path.basename(prgm_file).split(".")[:-1])
+        expected = lower(parse_tree(prgm_text, main_class))
+        got = parse(prgm_text, main_class=main_class)
+        if not same_ast(expected, got):
+            failed.append(prgm_file)
+    return failed
+
 
+if __name__ == "__main__":
+    # Usage: python3 parser.py [source files], defaults to every program in src/
+    # tests/test_parser.py runs the same check
+    log_helper.setup_logging("INFO")
+    files = sys.argv[1:] or source_files()
+    failed = check_cleanup(files)
+    for prgm_file in files:
+        print(f"{'FAIL' if prgm_file in failed else 'OK  '} {prgm_file}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,309 @@
+"""
+Peephole optimizer over the instructions generated for each method, before they are split into basic blocks
+
+Window rules rewrite a few neighbouring instructions at a time, and method rules look at the whole method
+(for jump targets). Rules are applied until none of them changes the method. Each rule counts its hits
+"""
+
+import logging
+import log_helper
+
+from ir import Instr, BRANCHES, INVERSE, JUMP_POPS, label
+
+logger = logging.getLogger("peephole")
+
+TYPECASE_LOAD = Instr("load", "__typecase_var")
+
+
+# Window rules get the next few instructions of the method and return the instructions to replace them with,
+# or None if the rule doesn't apply
+
+def push_pop(window):
+    # A constant or local that is pushed and popped straight away
+    # For example the value of a discarded const none statement
+    push, pop = window
+    if push.op in ["const", "load"] and pop.op == "pop":
+        return []
+
+def load_store(window):
+    # load x; store x does nothing
+    load, store = window
+    if load.op == "load" and store.op == "store" and load.operand == store.operand:
+        return []
+
+def store_return(window):
+    # Locals are dead once the method returns, so store x; load x; return keeps x on the stack
+    store, load, ret = window
+    if store.op == "store" and load.op == "load" and store.operand == load.operand and ret.op == "return":
+        return [ret]
+
+def const_branch(window):
+    # A branch on a constant Boolean is either always or never taken
+    const, branch = window
+    if const.op != "const" or const.operand not in ["true", "false"] or branch.op not in BRANCHES:
+        return None
+    if (const.operand == "true") == (branch.op == "jump_if"):
+        return [Instr("jump", branch.operand)]
+    return []
+
+def branch_over_jump(window):
+    # jump_if a; jump b; a: becomes jump_ifnot b; a:
+    branch, jump, label = window
+    if branch.op not in INVERSE or not label.is_label() or branch.operand != label.operand:
+        return None
+    if jump.op != "jump":
+        return None
+    return [Instr(INVERSE[branch.op], jump.operand), label]
+
+def typecase_bind(window):
+    # Typecase copies its value into the branch variable before testing the branch type.
+    # The branch variable is only used inside the branch, so copy it after the test passes
+    load1, store, load2, test, branch = window
+    if load1 != TYPECASE_LOAD or load2 != load1 or store.op != "store":
+        return None
+    if test.op != "is_instance" or branch.op != "jump_ifnot":
+        return None
+    return [load2, test, branch, load1, store]
+
+def unreachable(window):
+    # Nothing after a jump or return runs until the next label
+    end, instr = window
+    if end.op in ["jump", "return"] and not instr.is_label():
+        return [end]
+
+
+# Method rules get the whole method and return the new method, or None if nothing changed
+
+def label_runs(code):
+    # Maps each label to the labels at the same place, i.e. its run of consecutive labels
+    runs = {}
+    run = []
+    for instr in code + [None]:
+        if instr is not None and instr.is_label():
+            run.append(instr.operand)
+        else:
+            for name in run:
+                runs[name] = run
+            run = []
+    return runs
+
+def jump_to_next(code):
+    # A jump to one of the labels right after it. An unconditional jump is dropped,
+    # a conditional jump still has to pop what it compares
+    runs = label_runs(code)
+    changed = False
+    new_code = []
+    for i, instr in enumerate(code):
+        if instr.is_jump() and i + 1 < len(code) and code[i + 1].is_label():
+            if instr.operand in runs[code[i + 1].operand]:
+                changed = True
+                new_code.extend(Instr("pop") for _ in range(JUMP_POPS[instr.op]))
+                continue
+        new_code.append(instr)
+    return new_code if changed else None
+
+def merge_labels(code):
+    # Jumps to a run of labels all go to its first label, so the rest become unused
+    runs = label_runs(code)
+    changed = False
+    new_code = []
+    for instr in code:
+        if instr.is_jump() and instr.operand in runs and runs[instr.operand][0] != instr.operand:
+            instr = Instr(instr.op, runs[instr.operand][0])
+            changed = True
+        new_code.append(instr)
+    return new_code if changed else None
+
+def store_load(code):
+    # A local whose every load directly follows a store to it never needs its slot.
+    # The store and load pairs go, and the remaining stores only pop their value
+    loads = {}
+    paired = {}
+    for i, instr in enumerate(code):
+        if instr.op == "load":
+            var = instr.operand
+            loads[var] = loads.get(var, 0) + 1
+            if i > 0 and code[i - 1] == Instr("store", var):
+                paired[var] = paired.get(var, 0) + 1
+    temps = set(var for var in paired if paired[var] == loads[var] and var != "$")
+    if not temps:
+        return None
+
+    new_code = []
+    for instr in code:
+        if instr.op == "load" and instr.operand in temps:
+            new_code.pop() # The store right before it, already turned into a pop
+        elif instr.op == "store" and instr.operand in temps:
+            new_code.append(Instr("pop"))
+        else:
+            new_code.append(instr)
+    return new_code
+
+def thread_jumps(code):
+    # Jumps to a label followed by an unconditional jump go straight to its target
+    targets = {}
+    for i, instr in enumerate(code):
+        if instr.is_label():
+            # Skip past any other labels at the same place
+            j = i + 1
+            while j < len(code) and code[j].is_label():
+                j += 1
+            if j < len(code) and code[j].op == "jump":
+                targets[instr.operand] = code[j].operand
+
+    def final_target(name):
+        seen = set()
+        while name in targets and name not in seen:
+            seen.add(name)
+            name = targets[name]
+        return name if name not in seen else None # None if the jumps loop forever
+
+    changed = False
+    new_code = []
+    for instr in code:
+        if instr.is_jump():
+            final = final_target(instr.operand)
+            if final is not None and final != instr.operand:
+                instr = Instr(instr.op, final)
+                changed = True
+        new_code.append(instr)
+    return new_code if changed else None
+
+def unused_labels(code):
+    # Labels no jump goes to
+    used = set(instr.operand for instr in code if instr.is_jump())
+    new_code = [instr for instr in code if not instr.is_label() or instr.operand in used]
+    return new_code if len(new_code) < len(code) else None
+
+
+# Rule table of (name, window size or None for method rules, rule)
+PEEPHOLE_RULES = [
+    ("push_pop", 2, push_pop),
+    ("load_store", 2, load_store),
+    ("store_return", 3, store_return),
+    ("const_branch", 2, const_branch),
+    ("branch_over_jump", 3, branch_over_jump),
+    ("typecase_bind", 5, typecase_bind),
+    ("unreachable", 2, unreachable),
+    ("store_load", None, store_load),
+    ("jump_to_next", None, jump_to_next),
+    ("merge_labels", None, merge_labels),
+    ("thread_jumps", None, thread_jumps),
+    ("unused_labels", None, unused_labels)
+]
+
+
+class PeepholeOptimizer:
+
+    def __init__(self, rules=PEEPHOLE_RULES):
+        self.rules = rules
+        self.hits = {name: 0 for name, _, _ in rules} # Rule name -> times applied
+
+    def apply_window(self, name, size, rule, code):
+        # Slides the window over the method, returns the new method and whether anything changed
+        changed = False
+        new_code = []
+        i = 0
+        while i < len(code):
+            if i + size <= len(code):
+                replacement = rule(code[i:i + size])
+                if replacement is not None:
+                    logger.trace(f"Rule {name} replaced {code[i:i + size]} with {replacement}")
+                    self.hits[name] += 1
+                    changed = True
+                    # Step back so the replacement can match again with what came before
+                    back = len(new_code) - min(size - 1, len(new_code))
+                    code = new_code[back:] + replacement + code[i + size:]
+                    new_code = new_code[:back]
+                    i = 0
+                    continue
+            new_code.append(code[i])
+            i += 1
+        return new_code, changed
+
+    def optimize(self, code):
+        # Applies rules to the method's instructions until none apply
+        changed = True
+        while changed:
+            changed = False
+            for name, size, rule in self.rules:
+                if size is None:
+                    new_code = rule(code)
+                    if new_code is not None:
+                        logger.trace(f"Rule {name} rewrote the method")
+                        self.hits[name] += 1
+                        code = new_code
+                        changed = True
+                else:
+                    code, applied = self.apply_window(name, size, rule, code)
+                    changed = changed or applied
+        return code
+
+
+def optimize(asm):
+    # Optimizes every method in place, asm maps class -> method -> flat instruction list
+    optimizer = PeepholeOptimizer()
+    before = 0
+    after = 0
+    for clazz in asm:
+        for method in asm[clazz]:
+            before += len(asm[clazz][method])
+            asm[clazz][method] = optimizer.optimize(asm[clazz][method])
+            after += len(asm[clazz][method])
+    logger.debug(f"Peephole optimizer went from {before} to {after} instructions, rule hits {optimizer.hits}")
+    return optimizer.hits
+
+
+if __name__ == "__main__":
+    log_helper.setup_logging("INFO")
+    optimizer = PeepholeOptimizer()
+
+    def parse(lines):
+        # Instructions from lines written like the flat instruction list
+        code = []
+        for line in lines:
+            op, _, operand = line.partition(" ")
+            code.append(label(operand) if op == ".label" else Instr(op, operand or None))
+        return code
+
+    code = parse([
+        "enter",
+        "const none",
+        "pop",
+        "load x",
+        "store x",
+        "const true",
+        "jump_ifnot a",
+        "jump b",
+        ".label a",
+        "load x",
+        "jump_if c",
+        "jump d",
+        ".label c",
+        "const 1",
+        "jump d",
+        "const 2",
+        ".label d",
+        ".label b",
+        "load x",
+        "return 0"
+    ])
+    print([str(instr) for instr in optimizer.optimize(code)])
+    typecase = parse([
+        "enter",
+        "load x",
+        "store __typecase_var",
+        "load __typecase_var",
+        "store b",
+        "load __typecase_var",
+        "is_instance Boolean",
+        "jump_ifnot typecase_1",
+        "load b",
+        "return 0",
+        ".label typecase_1",
+        ".label typecaseend_1",
+        "load $",
+        "return 0"
+    ])
+    print([str(instr) for instr in optimizer.optimize(typecase)])
+    print(optimizer.hits)
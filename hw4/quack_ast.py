@@ -0,0 +1,201 @@
+"""
+The typed abstract syntax tree for Quack programs. parser.py lowers the cleaned up lark tree into these nodes
+
+Every kind of node has its own class with named fields, so passes dispatch on the node class
+instead of scanning tree.data strings, and identifier names are already resolved to plain strings
+"""
+
+
+class Node:
+    # Base class for all tree nodes
+    # Subclasses list their fields in __slots__ (also the constructor argument order),
+    # the fields holding child nodes in child_fields, and the visitor method name in rule
+
+    __slots__ = ()
+    rule = None
+    child_fields = ()
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def children(self):
+        # Yields the child nodes in traversal order
+        for name in self.child_fields:
+            child = getattr(self, name)
+            if isinstance(child, list):
+                yield from child
+            elif child is not None:
+                yield child
+
+    def __repr__(self):
+        fields = ", ".join(repr(getattr(self, name)) for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Visitor:
+    # Walks the tree bottom up, calling the method named by each node's rule if the pass has one
+    # Same traversal as lark's Visitor_Recursive. Passes override visit for custom traversals
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._handlers = {} # Node class -> handler, filled in as node classes are seen
+
+    def visit(self, node):
+        for child in node.children():
+            self.visit(child)
+        self._call_userfunc(node)
+        return node
+
+    def visit_all(self, nodes):
+        # Visits a list of nodes, such as a statement block
+        for node in nodes:
+            self.visit(node)
+
+    def get_handler(self, node):
+        # Gets the (unbound) method handling this node, or None if the pass doesn't have one
+        handlers = type(self)._handlers
+        node_class = type(node)
+        if node_class not in handlers:
+            handlers[node_class] = getattr(type(self), node_class.rule, None)
+        return handlers[node_class]
+
+    def _call_userfunc(self, node):
+        handler = self.get_handler(node)
+        if handler is not None:
+            return handler(self, node)
+
+
+# Program structure
+
+class Program(Node):
+    __slots__ = ("classes",)
+    rule = "program"
+    child_fields = ("classes",)
+
+class Clazz(Node):
+    # Every class has an explicit superclass and a $constructor method after parsing
+    __slots__ = ("name", "superclass", "methods")
+    rule = "clazz"
+    child_fields = ("methods",)
+
+class ClassMethod(Node):
+    # args is a list of (name, type name) pairs
+    __slots__ = ("name", "args", "return_type", "body")
+    rule = "class_method"
+    child_fields = ("body",)
+
+
+# Statements
+
+class Statement(Node):
+    # An expression evaluated for its side effects
+    __slots__ = ("expr",)
+    rule = "statement"
+    child_fields = ("expr",)
+
+class Assignment(Node):
+    # target is an Identifier or Field. decl_type is the declared type name, or None if not declared
+    __slots__ = ("target", "value", "decl_type")
+    rule = "assignment"
+    child_fields = ("target", "value")
+
+    def __init__(self, target, value, decl_type=None):
+        super().__init__(target, value, decl_type)
+
+class IfStatement(Node):
+    # else_body is None when there's no else branch. An elif is a nested IfStatement in else_body
+    __slots__ = ("cond", "then_body", "else_body")
+    rule = "if_structure"
+    child_fields = ("cond", "then_body", "else_body")
+
+class WhileStatement(Node):
+    __slots__ = ("cond", "body")
+    rule = "while_structure"
+    child_fields = ("cond", "body")
+
+class ReturnStatement(Node):
+    # Blank returns have a NothingLiteral value after parsing
+    __slots__ = ("value",)
+    rule = "return_statement"
+    child_fields = ("value",)
+
+class TypecaseStatement(Node):
+    __slots__ = ("expr", "alts")
+    rule = "typecase_statement"
+    child_fields = ("expr", "alts")
+
+class TypeAlt(Node):
+    __slots__ = ("name", "type_name", "body")
+    rule = "type_alt"
+    child_fields = ("body",)
+
+
+# Expressions
+
+class Expr(Node):
+    # type is the static type name, stored by type inference once it has converged
+    __slots__ = ("type",)
+
+    def __init__(self, *args):
+        self.type = None
+        super().__init__(*args)
+
+class Identifier(Expr):
+    # A local variable or method argument
+    __slots__ = ("name",)
+    rule = "identifier"
+
+class Field(Expr):
+    # obj.name, obj is a ThisPtr for this.name
+    __slots__ = ("obj", "name")
+    rule = "field"
+    child_fields = ("obj",)
+
+class MethodInvocation(Expr):
+    # Binary and unary operators are desugared into method invocations
+    __slots__ = ("method", "receiver", "args")
+    rule = "method_invocation"
+    child_fields = ("receiver", "args")
+
+class ObjInstantiation(Expr):
+    __slots__ = ("class_name", "args")
+    rule = "obj_instantiation"
+    child_fields = ("args",)
+
+class IntLiteral(Expr):
+    # value is the digit string
+    __slots__ = ("value",)
+    rule = "int_literal"
+
+class StringLiteral(Expr):
+    # value is the escaped, double quoted form used in the assembly
+    __slots__ = ("value",)
+    rule = "string_literal"
+
+class BooleanLiteral(Expr):
+    __slots__ = ("value",)
+    rule = "boolean_literal"
+
+class NothingLiteral(Expr):
+    __slots__ = ()
+    rule = "nothing_literal"
+
+class ThisPtr(Expr):
+    __slots__ = ()
+    rule = "this_ptr"
+
+class CondAnd(Expr):
+    __slots__ = ("left", "right")
+    rule = "cond_and"
+    child_fields = ("left", "right")
+
+class CondOr(Expr):
+    __slots__ = ("left", "right")
+    rule = "cond_or"
+    child_fields = ("left", "right")
+
+class CondNot(Expr):
+    __slots__ = ("expr",)
+    rule = "cond_not"
+    child_fields = ("expr",)
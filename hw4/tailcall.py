@@ -0,0 +1,81 @@
+"""
+Self tail call elimination on the IR. Runs after devirtualization
+
+A method ending in return this.m(args), where m is the method itself and no subclass overrides it,
+doesn't need a new frame. The arguments already on the stack are stored over the method's own arguments,
+and control jumps back to the top of the method, so the recursion runs as a loop in constant stack space
+"""
+
+import logging
+import log_helper
+
+import ir
+
+logger = logging.getLogger("tailcall")
+
+HEAD_LABEL = "tailcall_head" # Label placed right after enter
+
+
+def is_self_tail_call(method, block):
+    # Whether the block ends with a direct call of the method on this, returning its result
+    if len(block.instrs) < 3:
+        return False
+    load, call, ret = block.instrs[-3:]
+    return (load == ir.Instr("load", "$") and call == ir.Instr("call_direct", f"$:{method.name}")
+            and ret.op == "return")
+
+
+def eliminate(method):
+    # Turns the method's self tail calls into jumps to its head, returns the number eliminated
+    if method.name == "$constructor":
+        return 0
+    tail_blocks = [block for block in method.blocks if is_self_tail_call(method, block)]
+    if not tail_blocks:
+        return 0
+
+    # The last argument is on top of the stack
+    restore = [ir.Instr("store", arg) for arg in reversed(method.args)] + [ir.Instr("jump", HEAD_LABEL)]
+    for block in tail_blocks:
+        block.instrs[-3:] = restore
+    code = method.instrs()
+    enter = code.index(ir.Instr("enter"))
+    method.set_code(code[:enter + 1] + [ir.label(HEAD_LABEL)] + code[enter + 1:])
+    return len(tail_blocks)
+
+
+def eliminate_all(program_ir):
+    # Eliminates self tail calls in every method, program_ir maps class -> ClassIR
+    eliminated = {}
+    for clazz in program_ir:
+        eliminated[clazz] = 0
+        for method in program_ir[clazz].methods:
+            count = eliminate(method)
+            if count > 0:
+                logger.info(f"Eliminated {count} self tail calls in method {clazz}:{method.name}")
+            eliminated[clazz] += count
+    return eliminated
+
+
+if __name__ == "__main__":
+    log_helper.setup_logging("INFO")
+    # def fact(n: Int, acc: Int): Int { if n == 0 { return acc; } return this.fact(n - 1, acc * n); }
+    method = ir.MethodIR("fact", ["n", "acc"], [], [
+        ir.Instr("enter"),
+        ir.Instr("const", "0"),
+        ir.Instr("load", "n"),
+        ir.Instr("jump_if_ne", "ifend_1"),
+        ir.Instr("load", "acc"),
+        ir.Instr("return", "2"),
+        ir.label("ifend_1"),
+        ir.Instr("const", "1"),
+        ir.Instr("load", "n"),
+        ir.Instr("sub"),
+        ir.Instr("load", "n"),
+        ir.Instr("load", "acc"),
+        ir.Instr("mul"),
+        ir.Instr("load", "$"),
+        ir.Instr("call_direct", "$:fact"),
+        ir.Instr("return", "2")
+    ])
+    print(f"Expect 1, got {eliminate(method)}")
+    print("\n".join(method.dump()))
@@ -1,30 +1,35 @@
 """
 Performs type inferencing on the given tree
 Also performs type checking on conditionals to make sure they are Boolean
+
+Inference is worklist driven. Each assignment and check is a unit that records which locals,
+fields and method return types it reads. When one of those types changes, only the units
+depending on it are evaluated again, until nothing changes
 """
 
-from lark import Lark, v_args, Tree, Token
-from lark.visitors import Visitor_Recursive
 import sys
 import logging
 import log_helper
-import copy
+from collections import ChainMap
 
+import quack_ast as ast
 from default_class_map import default_class_map
+from class_hierarchy import LATTICE_TOP, LATTICE_BOTTOM
 
+# Per class tables that subclasses inherit
+INHERITED_TABLES = ["field_list", "method_returns", "method_args", "method_arg_names"]
 logger = logging.getLogger("type-inferencer")
 
 # Default classes for certain tree nodes
 tree_type_table = {
-    "boolean_literal_false": "Boolean",
-    "boolean_literal_true": "Boolean",
-    "nothing_literal": "Nothing",
-    "int_literal": "Int",
-    "string_literal": "String",
-    "cond_and": "Boolean",
-    "cond_not": "Boolean",
-    "cond_or": "Boolean",
-    "this_ptr": "$"
+    ast.BooleanLiteral: "Boolean",
+    ast.NothingLiteral: "Nothing",
+    ast.IntLiteral: "Int",
+    ast.StringLiteral: "String",
+    ast.CondAnd: "Boolean",
+    ast.CondNot: "Boolean",
+    ast.CondOr: "Boolean",
+    ast.ThisPtr: "$"
 }
 
 def compile_error(msg):
@@ -32,125 +37,128 @@ def compile_error(msg):
     logger.fatal(f"COMPILE ERROR: {msg}")
     sys.exit(1)
 
-LATTICE_TOP = "$T" # Top of the lattice
-LATTICE_BOTTOM = "$B" # Bottom of the lattice
+def inherit(table):
+    # Layers an empty table for a subclass over its superclass's table
+    # Lookups fall through to the superclass, writes only go to the subclass layer
+    if isinstance(table, ChainMap):
+        return table.new_child()
+    return ChainMap({}, table)
 
-class TypeInferencer(Visitor_Recursive):
+class TypeInferencer(ast.Visitor):
 
-    def __init__(self):
-        self.changed = False
+    def __init__(self, hierarchy):
         self.curr_class = "" # Name of current class we are checking
         self.curr_method = "" # Name of current method we are checking
         self.class_map = default_class_map
+        self.hierarchy = hierarchy # Already holds every class, see manual_checks.check_hierarchy
+
+        # Worklist state. Types are keyed by ("local", class, method, name), ("field", class, name)
+        # and ("return", class, method). Units are (handler, node, class, method)
+        self.dependents = {} # Type key -> units that read it (dict used as an ordered set)
+        self.worklist = {} # Units waiting to be evaluated again (ordered set)
+        self.reads = set() # Type keys read by the unit being evaluated
+        self.writes = set() # Type keys changed by the unit being evaluated
+        self.units = 0 # Number of units found in the first pass
+        self.revisits = 0 # Number of times a unit was evaluated again
+
+    def read(self, key):
+        # Records the unit being evaluated depends on the type at key
+        self.reads.add(key)
+
+    def changed(self, key):
+        # Records the type at key changed, so every unit depending on it must be evaluated again
+        self.writes.add(key)
+        for unit in self.dependents.get(key, ()):
+            self.worklist[unit] = None
+
+        if key[0] != "local":
+            # Subclasses see the new type through their tables unless they override it
+            kind, clazz, name = key
+            table = "field_list" if kind == "field" else "method_returns"
+            for sub in self.hierarchy.subclasses[clazz]:
+                if sub not in self.class_map:
+                    continue # Not visited yet, it will layer over the new type
+                types = self.class_map[sub][table]
+                if isinstance(types, ChainMap) and name not in types.maps[0]:
+                    self.changed((kind, sub, name))
+
+    def evaluate(self, unit):
+        # Evaluates a unit in its class and method, then records what it depends on
+        handler, node, self.curr_class, self.curr_method = unit
+        self.reads = set()
+        self.writes = set()
+        handler(self, node)
+
+        for key in self.reads:
+            self.dependents.setdefault(key, {})[unit] = None
+
+        # A unit that changed a type it read may now see a different type, e.g. x = x.next()
+        if not self.reads.isdisjoint(self.writes):
+            self.worklist[unit] = None
+
+    def run_worklist(self):
+        # Evaluates units again until no types change
+        # Returns the number of rounds, each round being the units queued by the previous one
+        rounds = 0
+        while len(self.worklist) > 0:
+            rounds += 1
+            batch, self.worklist = self.worklist, {}
+            logger.trace(f"Worklist round {rounds} has {len(batch)} units")
+            for unit in batch:
+                self.revisits += 1
+                self.evaluate(unit)
+        return rounds
+
+    def _call_userfunc(self, node):
+        # Statements and checks are evaluated as worklist units
+        handler = self.get_handler(node)
+        if handler is not None:
+            self.units += 1
+            self.evaluate((handler, node, self.curr_class, self.curr_method))
 
     def lca(self, clazz1, clazz2):
         # Least common ancestor algorithm
         logger.trace(f"Performing lca algorithm with operands {clazz1} {clazz2}")
-
-        # Checks for top/bottom of lattice
-        if clazz1 == LATTICE_TOP or clazz2 == LATTICE_TOP:
-            return LATTICE_TOP
-        if clazz1 == LATTICE_BOTTOM:
-            return clazz2
-        if clazz2 == LATTICE_BOTTOM:
-            return clazz1
-
-        # Do actual LCA algorithm by comparing superclass lineage
-        clazz1_lineage = []
-        clazz2_lineage = []
-        c = clazz1
-        while c != "$":
-            clazz1_lineage.insert(0, c)
-            if c not in self.class_map:
-                compile_error(f"Cannot find class {c}")
-            c = self.class_map[c]["superclass"]
-        c = clazz2
-        while c != "$":
-            clazz2_lineage.insert(0, c)
-            if c not in self.class_map:
-                compile_error(f"Cannot find class {c}")
-            c = self.class_map[c]["superclass"]
-
-        if clazz1_lineage[0] != clazz2_lineage[0]:
-            # No match found, return type error
-            return LATTICE_TOP
-        
-        i = 0
-        while i < len(clazz1_lineage) and i < len(clazz2_lineage) and clazz1_lineage[i] == clazz2_lineage[i]:
-            i += 1
-
-        return clazz1_lineage[i-1]
-
+        return self.hierarchy.lca(clazz1, clazz2)
 
     def infer_type(self, ident):
         # Attempts to infer the type of this tree
 
-        if isinstance(ident, Tree):
-            # Check for default cases
-            if ident.data == "this_ptr":
-                return self.curr_class
-
-            if ident.data in tree_type_table:
-                return tree_type_table[ident.data]
-
-            # Check for fields
-            elif ident.data.startswith("identifier_field"):
-                if "this" in ident.data:
-                    clazz = self.curr_class
-                    name = self.get_ident_name(ident.children[0])
-                else:
-                    clazz = self.infer_type(ident.children[0])
-                    name = self.get_ident_name(ident.children[1])
-                if clazz not in self.class_map:
-                    compile_error(f"Attempted to get field from unknown class {clazz}")
-                return self.class_map[clazz]["field_list"].get(name, LATTICE_BOTTOM)
-
-            # Identifiers may be nested but will have a token eventually
-            elif ident.data.startswith("identifier"):
-                name = self.get_ident_name(ident.children[0])
-                return self.class_map[self.curr_class]["method_locals"][self.curr_method].get(name, LATTICE_BOTTOM)
-
-            elif ident.data == "method_invocation":
-                # See what type the calling object is first
-                clazz = self.infer_type(ident.children[1])
-                # Look for return type of method
-                method = self.get_ident_name(ident.children[0])
-                if method not in self.class_map[clazz]["method_returns"]:
-                    return LATTICE_BOTTOM
-                    # compile_error(f"Attempted to get return type of unknown method {method} in class {clazz}")
-                return self.class_map[clazz]["method_returns"][method]
-
-            elif ident.data == "obj_instantiation":
-                return self.get_ident_name(ident.children[0])
-            else:
-                compile_error(f"Attempted to infer type of unknown tree {ident}")
-
-        elif isinstance(ident, Token):
-            if ident.type == "INT":
-                return "Int"
-            elif ident.type == "ESCAPED_STRING":
-                return "String"
-            else:
-                compile_error(f"Attempted to infer type of unknown Token {ident}")
+        # Check for default cases
+        if isinstance(ident, ast.ThisPtr):
+            return self.curr_class
 
+        node_type = tree_type_table.get(type(ident))
+        if node_type is not None:
+            return node_type
+
+        # Check for fields
+        elif isinstance(ident, ast.Field):
+            clazz = self.infer_type(ident.obj)
+            if clazz not in self.class_map:
+                compile_error(f"Attempted to get field from unknown class {clazz}")
+            self.read(("field", clazz, ident.name))
+            return self.class_map[clazz]["field_list"].get(ident.name, LATTICE_BOTTOM)
+
+        elif isinstance(ident, ast.Identifier):
+            self.read(("local", self.curr_class, self.curr_method, ident.name))
+            return self.class_map[self.curr_class]["method_locals"][self.curr_method].get(ident.name, LATTICE_BOTTOM)
+
+        elif isinstance(ident, ast.MethodInvocation):
+            # See what type the calling object is first
+            clazz = self.infer_type(ident.receiver)
+            # Look for return type of method
+            method = ident.method
+            self.read(("return", clazz, method))
+            if method not in self.class_map[clazz]["method_returns"]:
+                return LATTICE_BOTTOM
+                # compile_error(f"Attempted to get return type of unknown method {method} in class {clazz}")
+            return self.class_map[clazz]["method_returns"][method]
+
+        elif isinstance(ident, ast.ObjInstantiation):
+            return ident.class_name
         else:
-            compile_error(f"Attempted to infer type of unknown object {ident}")
-
-    def get_ident_name(self, ident):
-        # Gets the actual name of an identifier
-
-        if isinstance(ident, Tree):
-            # For identifiers, just recurse
-            if ident.data.startswith("identifier"):
-                if "field" in ident.data and "this" not in ident.data:
-                    return self.get_ident_name(ident.children[1])
-                return self.get_ident_name(ident.children[0]) # Recurse on only child
-            else:
-                compile_error(f"Attempted to get identifier name in unknown tree type {ident.data} {ident}")
-        elif isinstance(ident, Token):
-            return ident.value
-        else:
-            compile_error(f"Attempted to get identifier name in unrecognizable object {ident}")
+            compile_error(f"Attempted to infer type of unknown tree {ident}")
 
     def set_ident_type(self, ident, new_type):
         # Sets the type of an identifier to the given type
@@ -162,124 +170,110 @@ class TypeInferencer(Visitor_Recursive):
         if new_type == LATTICE_BOTTOM:
             compile_error(f"Attempted to set data type of field to LATTICE_BOTTOM")
 
-        if isinstance(ident, str):
-            self.class_map[self.curr_class]["method_locals"][self.curr_method][ident] = new_type
-        elif ident.data.startswith("identifier_field"):
-            if "this" in ident.data:
-                clazz = self.curr_class
-                name = self.get_ident_name(ident.children[0])
-            else:
-                clazz = self.infer_type(ident.children[0])
-                name = self.get_ident_name(ident.children[1])
+        if isinstance(ident, (str, ast.Identifier)):
+            name = ident if isinstance(ident, str) else ident.name
+            types = self.class_map[self.curr_class]["method_locals"][self.curr_method]
+            key = ("local", self.curr_class, self.curr_method, name)
+        elif isinstance(ident, ast.Field):
+            clazz = self.infer_type(ident.obj)
             if clazz not in self.class_map:
                 compile_error(f"Attempted to get field from unknown class {clazz}")
-            self.class_map[clazz]["field_list"][name] = new_type
-
-
-        elif ident.data.startswith("identifier"):
-            name = self.get_ident_name(ident.children[0])
-            self.class_map[self.curr_class]["method_locals"][self.curr_method][name] = new_type
+            name = ident.name
+            types = self.class_map[clazz]["field_list"]
+            key = ("field", clazz, name)
         else:
             compile_error(f"Attempted to set type to {new_type} of unknown tree {ident}")
 
+        if types.get(name) != new_type:
+            types[name] = new_type
+            self.changed(key)
+
 
     def if_structure(self, tree):
         # Check first child is actually a conditional (subclass of Boolean)
-        clazz = self.infer_type(tree.children[0])
-        if self.lca(clazz, "Boolean") != "Boolean":
+        clazz = self.infer_type(tree.cond)
+        if not self.hierarchy.is_subtype(clazz, "Boolean"):
             compile_error("If conditional does not have Boolean value")
         return tree
 
     def while_structure(self, tree):
         # Check first child is actually a conditional (subclass of Boolean)
-        clazz = self.infer_type(tree.children[0])
-        if self.lca(clazz, "Boolean") != "Boolean":
+        clazz = self.infer_type(tree.cond)
+        if not self.hierarchy.is_subtype(clazz, "Boolean"):
             compile_error("While conditional does not have Boolean value")
         return tree
 
     def cond_and(self, tree):
         # Check both children are actually booleans
-        clazz = self.infer_type(tree.children[0])
-        if self.lca(clazz, "Boolean") != "Boolean":
+        clazz = self.infer_type(tree.left)
+        if not self.hierarchy.is_subtype(clazz, "Boolean"):
             compile_error("And expression does not have Boolean value")
-        clazz = self.infer_type(tree.children[1])
-        if self.lca(clazz, "Boolean") != "Boolean":
+        clazz = self.infer_type(tree.right)
+        if not self.hierarchy.is_subtype(clazz, "Boolean"):
             compile_error("And expression does not have Boolean value")
         return tree
 
     def cond_or(self, tree):
         # Check both children are actually booleans
-        clazz = self.infer_type(tree.children[0])
-        if self.lca(clazz, "Boolean") != "Boolean":
+        clazz = self.infer_type(tree.left)
+        if not self.hierarchy.is_subtype(clazz, "Boolean"):
             compile_error("Or expression does not have Boolean value")
-        clazz = self.infer_type(tree.children[1])
-        if self.lca(clazz, "Boolean") != "Boolean":
+        clazz = self.infer_type(tree.right)
+        if not self.hierarchy.is_subtype(clazz, "Boolean"):
             compile_error("Or expression does not have Boolean value")
         return tree
    
     def cond_not(self, tree):
         # Check child is actually boolean
-        clazz = self.infer_type(tree.children[0])
-        if self.lca(clazz, "Boolean") != "Boolean":
+        clazz = self.infer_type(tree.expr)
+        if not self.hierarchy.is_subtype(clazz, "Boolean"):
             compile_error("Not expression does not have Boolean value")
         return tree
 
     def assignment(self, tree):
 
         # Get identifier name
-        ident = self.get_ident_name(tree.children[0])
+        ident = tree.target.name
+
+        if tree.decl_type is not None:
+            # Explicit declaration. Resolve the declared type first, then treat as a regular assignment
+            logger.trace(f"Attempting to infer declared type of {ident} in tree {tree}")
+
+            # See what it currently is, or default to bottom of lattice
+            prev_type = self.infer_type(tree.target)
+
+            # Resolve with LCA
+            curr_type = self.lca(prev_type, tree.decl_type)
+            if curr_type != prev_type:
+                self.set_ident_type(tree.target, curr_type)
+            logger.debug(f"Previously {ident} was {prev_type}, declared as {tree.decl_type}, resolving as {curr_type}")
+
         logger.trace(f"Attempting to infer type of {ident} in tree {tree}")
 
         # Get current type of left hand side
-        prev_type = self.infer_type(tree.children[0])
+        prev_type = self.infer_type(tree.target)
 
         # See what the new type is
-        new_type = self.infer_type(tree.children[1])
+        new_type = self.infer_type(tree.value)
 
         # Resolve with LCA
         curr_type = self.lca(prev_type, new_type)
         if curr_type != prev_type:
-            self.set_ident_type(tree.children[0], curr_type)
-            self.changed = True
+            self.set_ident_type(tree.target, curr_type)
         logger.debug(f"Previously {ident} was {prev_type}, now is {new_type}, resolving as {curr_type}")
         return tree
 
-    def assignment_decl(self, tree):
-        # Similar to assignment, but we also then remove the explicit declaration 
-        # and transform it into a regular assignment node
-
-        # Get identifier name
-        ident = self.get_ident_name(tree.children[0])
-        logger.trace(f"Attempting to infer type of {ident} in tree {tree}")
-
-        # See what it currently is, or default to bottom of lattice
-        prev_type = self.infer_type(tree.children[0])
-
-        # See what its declared type is
-        decl_type = self.get_ident_name(tree.children[1])
-    
-        # Resolve with LCA
-        curr_type = self.lca(prev_type, decl_type)
-        if curr_type != prev_type:
-            self.set_ident_type(tree.children[0], curr_type)
-            self.changed = True
-        logger.debug(f"Previously {ident} was {prev_type}, declared as {decl_type}, resolving as {curr_type}")
-
-        # Transform then defer to assignment
-        tree.data = "assignment"
-        tree.children = [tree.children[0], tree.children[2]]
-        return self.assignment(tree)
-
     def clazz(self, tree):
-        self.curr_class = self.get_ident_name(tree.children[0])
-        superclass = self.get_ident_name(tree.children[1])
+        self.curr_class = tree.name
+        superclass = tree.superclass
 
         if superclass not in self.class_map:
             compile_error(f"Class {self.curr_class} inherits from unknown superclass {superclass}")
 
         if self.curr_class not in self.class_map:
             # First time seeing it, add to class hierarchy
-            cm = copy.deepcopy(self.class_map[superclass])
+            # Only overridden methods and new fields are stored in the class itself
+            cm = {table: inherit(self.class_map[superclass][table]) for table in INHERITED_TABLES}
             cm["superclass"] = superclass
             cm["method_locals"] = {}
             self.class_map[self.curr_class] = cm
@@ -287,8 +281,8 @@ class TypeInferencer(Visitor_Recursive):
         return tree
 
     def class_method(self, tree):
-        method_name = self.get_ident_name(tree.children[0])
-        method_return = self.get_ident_name(tree.children[2])
+        method_name = tree.name
+        method_return = tree.return_type
         self.curr_method = method_name
 
         # See if we are overriding
@@ -307,32 +301,28 @@ class TypeInferencer(Visitor_Recursive):
 
             # First check number of arguments match
             super_args = len(self.class_map[override]["method_args"][method_name])
-            decl_args = len(tree.children[1].children) // 2 # Ignore ident names
+            decl_args = len(tree.args)
 
             if super_args != decl_args:
                 logger.trace(self.class_map)
                 compile_error(f"Method {method_name} in {self.curr_class} has mismatched num args of overriden from {superclass}, expected {super_args} got {decl_args}")
 
             # Check argument covariance
-            for i in range(0, len(tree.children[1].children), 2):
-                super_type = self.class_map[override]["method_args"][method_name][i // 2]
-                decl_clazz = self.get_ident_name(tree.children[1].children[i+1])
+            for i, (_, decl_clazz) in enumerate(tree.args):
+                super_type = self.class_map[override]["method_args"][method_name][i]
 
-                if self.lca(super_type, decl_clazz) != super_type:
+                if not self.hierarchy.is_subtype(decl_clazz, super_type):
                     compile_error(f"Method {method_name} in {self.curr_class} has incompatible signature of overriden from {superclass}")
 
             # Check return contravariance
             super_type = self.class_map[override]["method_returns"][method_name]
-            superclass = method_return
-            while superclass != "$" and superclass != super_type:
-                if superclass not in self.class_map:
-                    compile_error(f"Cannot find class {superclass}")
-                superclass = self.class_map[superclass]["superclass"]
-            if superclass != super_type:
+            if not self.hierarchy.is_subtype(method_return, super_type):
                 compile_error(f"Method {method_name} in {self.curr_class} has incompatible signature of overriden from {superclass}")
 
         # Add return type
-        self.class_map[self.curr_class]["method_returns"][method_name] = method_return
+        if self.class_map[self.curr_class]["method_returns"].get(method_name) != method_return:
+            self.class_map[self.curr_class]["method_returns"][method_name] = method_return
+            self.changed(("return", self.curr_class, method_name))
 
         # Add formal arguments to local scope
         if self.curr_method not in self.class_map[self.curr_class]["method_locals"]:
@@ -341,9 +331,7 @@ class TypeInferencer(Visitor_Recursive):
             local = {}
             args = []
             arg_names = []
-            for i in range(0, len(tree.children[1].children), 2):
-                name = self.get_ident_name(tree.children[1].children[i])
-                clazz = self.get_ident_name(tree.children[1].children[i+1])
+            for name, clazz in tree.args:
                 local[name] = clazz
                 args.append(clazz)
                 arg_names.append(name)
@@ -354,13 +342,21 @@ class TypeInferencer(Visitor_Recursive):
         logger.trace(f"Local scope for class {self.curr_class} method {method_name} is now {self.class_map[self.curr_class]['method_locals'][self.curr_method]}")
         return tree
 
+    def formal_args(self, tree):
+        # Check the formal arguments kept their declared types
+        for name, decl_clazz in tree.args:
+            self.read(("local", self.curr_class, self.curr_method, name))
+            inferred_type = self.class_map[self.curr_class]["method_locals"][self.curr_method][name]
+            if inferred_type != decl_clazz: 
+                compile_error(f"Formal argument {name} was declared {decl_clazz} but has inferred type {inferred_type}")
+
     def type_alt(self, tree): 
         # Add to scope then recurse
-        ident = self.get_ident_name(tree.children[0])
-        clazz = self.get_ident_name(tree.children[1])
+        ident = tree.name
+        clazz = tree.type_name
         logger.trace(f"Adding ident {ident} of class {clazz} to method locals")
         self.set_ident_type(ident, clazz)
-        self.visit(tree.children[2])
+        self.visit_all(tree.body)
 
         # Also add dummy __typecase_var variable. Type doesn't matter
         self.set_ident_type("__typecase_var", "Obj")
@@ -368,29 +364,24 @@ class TypeInferencer(Visitor_Recursive):
         return tree
 
     def visit(self, tree):
-        if tree.data == "clazz":
+        if isinstance(tree, ast.Clazz):
             # Pre-order traversal
             tree = self.clazz(tree)
-            self.visit(tree.children[2])
+            self.visit_all(tree.methods)
 
-        elif tree.data == "class_method":
+        elif isinstance(tree, ast.ClassMethod):
             # Complicated traversal
             # First do pre-order
             tree = self.class_method(tree)
 
             # Then visit children
-            self.visit(tree.children[-1])
+            self.visit_all(tree.body)
 
             # Then check formal arguments
-            for i in range(0, len(tree.children[1].children), 2):
-                name = self.get_ident_name(tree.children[1].children[i])
-                decl_clazz = self.get_ident_name(tree.children[1].children[i+1])
+            self.units += 1
+            self.evaluate((TypeInferencer.formal_args, tree, self.curr_class, self.curr_method))
 
-                inferred_type = self.class_map[self.curr_class]["method_locals"][self.curr_method][name]
-                if inferred_type != decl_clazz: 
-                    compile_error(f"Formal argument {name} was declared {decl_clazz} but has inferred type {inferred_type}")
-
-        elif tree.data == "type_alt":
+        elif isinstance(tree, ast.TypeAlt):
             # Preorder traversal, let method handle it
             self.type_alt(tree)
 
@@ -399,14 +390,67 @@ class TypeInferencer(Visitor_Recursive):
 
         return tree
 
-def infer(tree):
-    # Performs type inferencing on the tree
+class TypeAnnotator(ast.Visitor):
+    # Stores the final inferred type on every expression node once inference has converged,
+    # so later passes read node.type instead of inferring again
+    # Children are visited first, so each node only looks at the types stored on its children
+
+    def __init__(self, class_map):
+        self.class_map = class_map
+        self.curr_class = ""
+        self.curr_method = ""
+
+    def node_type(self, node):
+        # Same rules as TypeInferencer.infer_type, one level deep.
+        # Unknown classes and methods are left as LATTICE_BOTTOM for manual_checks to report
+        if isinstance(node, ast.ThisPtr):
+            return self.curr_class
+
+        node_type = tree_type_table.get(type(node))
+        if node_type is not None:
+            return node_type
+
+        elif isinstance(node, ast.Field):
+            if node.obj.type not in self.class_map:
+                return LATTICE_BOTTOM
+            return self.class_map[node.obj.type]["field_list"].get(node.name, LATTICE_BOTTOM)
+
+        elif isinstance(node, ast.Identifier):
+            return self.class_map[self.curr_class]["method_locals"][self.curr_method].get(node.name, LATTICE_BOTTOM)
+
+        elif isinstance(node, ast.MethodInvocation):
+            if node.receiver.type not in self.class_map:
+                return LATTICE_BOTTOM
+            return self.class_map[node.receiver.type]["method_returns"].get(node.method, LATTICE_BOTTOM)
+
+        elif isinstance(node, ast.ObjInstantiation):
+            return node.class_name
+
+    def _call_userfunc(self, node):
+        if isinstance(node, ast.Expr):
+            node.type = self.node_type(node)
+
+    def visit(self, tree):
+        if isinstance(tree, ast.Clazz):
+            self.curr_class = tree.name
+        elif isinstance(tree, ast.ClassMethod):
+            self.curr_method = tree.name
+        return super().visit(tree)
+
+def infer(tree, hierarchy):
+    # Performs type inferencing on the tree, whose classes are in topological order
     logger.trace("Attempting to perform type inferencing")
-    i = TypeInferencer();
-    i.changed = True
-    while i.changed:
-        i.changed = False
-        i.visit(tree)
+    i = TypeInferencer(hierarchy);
+
+    # First pass sets up the class map and evaluates every unit once
+    i.visit(tree)
+
+    # Then only revisit what depends on types that changed since
+    rounds = i.run_worklist()
+    logger.debug(f"Type inference converged after 1 full pass and {rounds} worklist rounds, revisiting {i.revisits} of {i.units} units")
+
+    # Store the converged types on the tree
+    TypeAnnotator(i.class_map).visit(tree)
 
     logger.trace(f"Successfully performed type inferencing. Got {i.class_map}")
 
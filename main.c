@@ -43,7 +43,7 @@ int main(int argc, char *argv[]) {
         for (; ok && optind < argc; ++optind) {
             log_debug("Processing command line argument %d\n", optind);
             main_class = argv[optind];
-            ok = vm_load_class(main_class);
+            ok = vm_load_program(main_class);
         }
         vm_loader_set_main(main_class);
     }
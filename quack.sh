@@ -17,7 +17,10 @@ OUT="out"
 COMPILER_FOLDER=hw4
 
 # The compiler to invoke
-COMPILER="python3 $COMPILER_FOLDER/compiler.py -o $OUT -j $OBJ_LIB"
+COMPILER="python3 $COMPILER_FOLDER/compiler.py -O 1 -o $OUT -j $OBJ_LIB"
+
+# The linker to invoke, it writes the prelinked image the VM loads
+LINKER="python3 $COMPILER_FOLDER/link.py -j $OBJ_LIB"
 
 # ------
 
@@ -28,9 +31,10 @@ echo "OBJ lib folder: $OBJ_LIB"
 echo "Compiler output folder: $OUT"
 echo "Compiler working directory: $COMPILER_FOLDER"
 echo "Compiler exec command: $COMPILER"
+echo "Linker exec command: $LINKER"
 echo
 
-SRC_FILES=$(ls -Sr $COMPILER_FOLDER/src)
+SRC_FILES=$(ls $COMPILER_FOLDER/src)
 
 for f in $SRC_FILES; do
     echo "------------------------------------------"
@@ -48,11 +52,11 @@ for f in $SRC_FILES; do
         continue
     fi
 
-    # Copy JSON generated files into OBJ
-    json_files=$(ls -Sr $OUT | grep json)
-    for j in $json_files; do
-        cp $OUT/$j $OBJ_LIB
-    done
+    # Link the program into one image
+    if ! $LINKER $bn; then
+        echo
+        continue
+    fi
 
     echo
     echo "-> Running $bn"
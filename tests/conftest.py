@@ -0,0 +1,12 @@
+"""pytest setup for the hw4 compiler checks: the compiler's
+modules import each other by bare name, and expect project
+logging (with its TRACE level) to be configured first.
+"""
+import os
+import sys
+
+HW4 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hw4")
+sys.path.insert(0, HW4)
+
+import log_helper
+log_helper.setup_logging("WARNING")
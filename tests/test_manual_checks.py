@@ -0,0 +1,43 @@
+"""Checks for the hw4 static semantic checks.  Run with pytest
+from the repository root:  python3 -m pytest tests
+"""
+import random
+import time
+
+import quack_ast as ast
+import manual_checks
+
+
+def synthetic_classes(n):
+    """n (class, superclass) pairs listed subclasses first: a chain
+    n/2 deep, and n/2 leaves under Obj in shuffled order.
+    """
+    chain = [(f"Chain{i}", f"Chain{i - 1}" if i > 0 else "Obj") for i in range(n // 2)]
+    leaves = [(f"Leaf{i}", "Obj") for i in range(n // 2)]
+    random.Random(0).shuffle(leaves)
+    return list(reversed(chain)) + leaves
+
+
+def test_cycle_check():
+    assert not manual_checks.cycle_check([("class1", "class2"), ("class2", "class3"), ("class3", "class4")])
+    assert manual_checks.cycle_check([("class1", "class2"), ("class2", "class3"), ("class3", "class1")])
+
+
+def test_cycle_check_scales_to_50k_classes():
+    classes = synthetic_classes(50000)
+    assert not manual_checks.cycle_check(classes + [("Obj", "$")])
+    assert manual_checks.cycle_check(classes + [("Obj", "Chain24999")])
+
+
+def test_hierarchy_scales_to_50k_classes():
+    """check_hierarchy is linear: 50k classes, half of them in one
+    deep chain, must be checked and sorted in under a second.
+    """
+    classes = synthetic_classes(50000)
+    program = ast.Program([ast.Clazz(name, superclass, []) for name, superclass in classes])
+    start = time.perf_counter()
+    hierarchy = manual_checks.check_hierarchy(program)
+    elapsed = time.perf_counter() - start
+    assert program.classes[0].name == "Chain0"
+    assert hierarchy.lca("Chain24999", "Leaf0") == "Obj"
+    assert elapsed < 1, f"check_hierarchy took {elapsed:.3f}s for 50000 classes"
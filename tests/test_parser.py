@@ -0,0 +1,14 @@
+"""Checks for the hw4 Quack parser.  Run with pytest from the
+repository root:  python3 -m pytest tests
+"""
+import parser as quack_parser
+
+
+def test_fused_cleanup_matches_passes():
+    """The ASTBuilder run while parsing must give the same AST as
+    the separate cleanup_passes followed by ASTLowering, for every
+    program in hw4/src.
+    """
+    files = quack_parser.source_files()
+    assert files
+    assert quack_parser.check_cleanup(files) == []
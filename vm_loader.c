@@ -8,8 +8,13 @@
 #include <cjson/cJSON.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include <string.h>
 #include <assert.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 
 // Set load library path before loading each class by name.
@@ -45,6 +50,34 @@ static void set_loaded(class_ref c) {
     return;
 }
 
+/* Direct calls to be patched with code addresses.  The called
+ * method may not be translated until after the call is (it may
+ * be later in the same class, or in a class that is still
+ * loading), so we resolve them all once everything is loaded.
+ */
+#define MAX_DIRECT_CALLS 2000
+struct direct_call {
+    vm_addr patch_addr;  // Operand word of the call
+    class_ref clazz;
+    int slot;
+};
+static struct direct_call direct_calls[MAX_DIRECT_CALLS];
+static int n_direct_calls;
+
+static void resolve_direct_calls() {
+    for (int i=0; i < n_direct_calls; ++i) {
+        class_ref clazz = direct_calls[i].clazz;
+        vm_addr method_addr = clazz->vtable[direct_calls[i].slot];
+        log_debug("Direct call at %d to %s slot %d is code address %d",
+                  direct_calls[i].patch_addr - vm_code_block,
+                  clazz->header.class_name, direct_calls[i].slot,
+                  method_addr - vm_code_block);
+        *direct_calls[i].patch_addr = (vm_Word) {.code_addr = method_addr};
+    }
+    log_info("Resolved %d direct calls", n_direct_calls);
+    n_direct_calls = 0;
+}
+
 /* Initialize loader
  * (loads built-in classes, dummy main program,
  * special named constants)
@@ -81,6 +114,7 @@ void vm_loader_init(char *load_path_prefix) {
  * except a constructor).
  */
 void vm_loader_set_main(char *main_class_name) {
+    resolve_direct_calls();
     class_ref main_class = find_loaded(main_class_name);
     assert(main_class);
     vm_code_block[0] = (vm_Word) {.instr = vm_op_new};
@@ -118,35 +152,12 @@ class_ref ensure_loaded(char *class_name) {
 
 
 
-// Capacity limit:  For simplicity we read into a
-// buffer of 20k bytes.
-//
-#define FILE_BUFFER_CAPACITY (1024 * 100 * sizeof(char))
-
-
-/* read_file_fd
- * returns 0 (failure) or 1 (success)
+/* Translation of the code of one method, from the JSON array
+ * or from the array of words in a binary object file.
  */
-int read_file_fd(FILE *fd, char *file_buffer) {
-    int pos = 0;
-    char ch;
-    /* Simple, not efficient. */
-    while (1) {
-        ch = fgetc(fd);
-        if (feof(fd)) {
-            break;
-        } else if (ferror(fd)) {
-            perror("Error reading file");
-            break;
-        }
-        file_buffer[pos++] = ch;
-    }
-    // Do we need to add the null byte?  Maybe.
-    file_buffer[pos] = 0;
-    return 1;
-}
-
 vm_Word *translate_method_code(cJSON *ops, int const_map[], class_ref class_map[]);
+vm_Word *translate_method_words(int32_t *words, int n_words,
+                                int const_map[], class_ref class_map[]);
 
 /*
  * Constants in a class file (.json) are referenced as small
@@ -216,46 +227,21 @@ static int map_classes(class_ref class_map[], cJSON *tree, int capacity) {
 }
 
 
-static int load_json(char buf[]) {
-    cJSON *tree = NULL; // Tree as a whole
-    cJSON *val = NULL;  // Named value in tree
-    cJSON *el = NULL;   // Element of value
-    tree = cJSON_Parse(buf);  // Must free at end
-    if (tree == NULL) {
-        perror("load_json in vm_loader.c: Failed to parse buffer. ");
-        assert(tree);  // Will definitely abort
-    }
-
-    /* module constant index -> global constant index */
-    int constant_renumber_map[30];
-    int n_consts = remap_constants(constant_renumber_map, tree, 30);
-
-    // Mapping imported classes was here; moving AFTER we
-    // create and index this class so that it can reference itself
-
-    // Create and initialize a class object
-    // push_log_level(DEBUG);
-    char *class_name = cJSON_GetStringValue(
-            cJSON_GetObjectItemCaseSensitive(tree, "class_name"));
-    char *super_name = cJSON_GetStringValue(
-            cJSON_GetObjectItemCaseSensitive(tree, "super"));
-    log_info("Class %s extends %s", class_name, super_name);
-    // Counts of methods and fields; I'm letting the assembler do the work here.
-    int n_fields = (int) cJSON_GetNumberValue(
-            cJSON_GetObjectItemCaseSensitive(tree, "n_fields"));
-    int n_methods = (int) cJSON_GetNumberValue(
-            cJSON_GetObjectItemCaseSensitive(tree, "n_methods"));
+/* Create a class object with its inherited methods in the vtable,
+ * and add it to the loaded classes.  The class name is kept, not copied.
+ */
+static class_ref create_class(char *class_name, class_ref the_super,
+                              int n_fields, int n_methods, int n_inherited) {
+    log_info("Class %s extends %s", class_name, the_super->header.class_name);
     log_info("Class %s has %d methods and %d fields",
              class_name, n_methods, n_fields);
     size_t class_obj_size =
             sizeof(struct class_header_struct)
             + n_methods * sizeof(vm_Word);
     size_t obj_size = sizeof(struct obj_header_struct) + n_fields * sizeof(vm_Word);
-    class_ref the_super = ensure_loaded(super_name);
-    assert(the_super); // Error if we can't find the superclass
     class_ref the_class = (class_ref) malloc(class_obj_size);
     the_class->header = (struct class_header_struct) {
-            .class_name = strdup(class_name),
+            .class_name = class_name,
             .healthy_class_tag = HEALTHY,
             .n_fields = n_fields,
             .object_size = obj_size,
@@ -268,16 +254,44 @@ static int load_json(char buf[]) {
     log_debug("Size of object header alone is %d bytes\n",
              sizeof(struct obj_header_struct));
     // Copy inherited method pointers into vtable
-    int n_inherited = (int) cJSON_GetNumberValue(
-            cJSON_GetObjectItemCaseSensitive(tree, "n_inherited"));
     for (int i = 0; i < n_inherited; ++i) {
         the_class->vtable[i] = the_super->vtable[i];
     }
-    //pop_log_level();
 
     set_loaded(the_class);
     // We want the class in the "loaded classes" table before loading
     // methods, because the methods might have references to the current class.
+    return the_class;
+}
+
+static int load_json(cJSON *tree) {
+    cJSON *el = NULL;   // Element of value
+
+    /* module constant index -> global constant index */
+    int constant_renumber_map[30];
+    int n_consts = remap_constants(constant_renumber_map, tree, 30);
+
+    // Mapping imported classes was here; moving AFTER we
+    // create and index this class so that it can reference itself
+
+    // Create and initialize a class object
+    // push_log_level(DEBUG);
+    char *class_name = cJSON_GetStringValue(
+            cJSON_GetObjectItemCaseSensitive(tree, "class_name"));
+    char *super_name = cJSON_GetStringValue(
+            cJSON_GetObjectItemCaseSensitive(tree, "super"));
+    // Counts of methods and fields; I'm letting the assembler do the work here.
+    int n_fields = (int) cJSON_GetNumberValue(
+            cJSON_GetObjectItemCaseSensitive(tree, "n_fields"));
+    int n_methods = (int) cJSON_GetNumberValue(
+            cJSON_GetObjectItemCaseSensitive(tree, "n_methods"));
+    int n_inherited = (int) cJSON_GetNumberValue(
+            cJSON_GetObjectItemCaseSensitive(tree, "n_inherited"));
+    class_ref the_super = ensure_loaded(super_name);
+    assert(the_super); // Error if we can't find the superclass
+    class_ref the_class = create_class(strdup(class_name), the_super,
+                                       n_fields, n_methods, n_inherited);
+    //pop_log_level();
 
     /* module class index -> class reference,
     * with potential side effect of loading more class files.
@@ -299,10 +313,241 @@ static int load_json(char buf[]) {
                 translate_method_code(ops, constant_renumber_map, class_map);
         the_class->vtable[method_slot] = method_start_addr;
     }
-    cJSON_Delete(tree);
     return 1;
 }
 
+
+/* Binary object files (see OBJECT_MAGIC in vm_loader.h) are mapped
+ * into memory and read in place.  Their strings are NUL terminated
+ * in the file, so class names and string literals point into the
+ * mapping rather than being copied, and code words are read straight
+ * from it.  The mapping is therefore kept for the life of the program.
+ */
+struct object_reader {
+    char *at;   // Next unread byte
+    char *end;
+};
+
+static int32_t read_word(struct object_reader *reader) {
+    assert(reader->at + sizeof(int32_t) <= reader->end);
+    int32_t word = *(int32_t *) reader->at;
+    reader->at += sizeof(int32_t);
+    return word;
+}
+
+static int32_t *read_words(struct object_reader *reader, int n_words) {
+    assert(n_words >= 0 && reader->at + n_words * sizeof(int32_t) <= reader->end);
+    int32_t *words = (int32_t *) reader->at;
+    reader->at += n_words * sizeof(int32_t);
+    return words;
+}
+
+static char *read_string(struct object_reader *reader) {
+    int32_t length = read_word(reader);
+    char *text = reader->at;
+    assert(length >= 0 && text + length < reader->end && text[length] == 0);
+    // Padded to a whole number of words
+    reader->at += (length + sizeof(int32_t)) & ~(sizeof(int32_t) - 1);
+    return text;
+}
+
+static int load_binary(char *data, size_t size) {
+    struct object_reader reader = {.at = data, .end = data + size};
+    read_words(&reader, OBJECT_MAGIC_WORDS);
+    int version = read_word(&reader);
+    if (version != OBJECT_VERSION) {
+        log_error("Object file version %d, expected version %d",
+                  version, OBJECT_VERSION);
+        return 0;
+    }
+    int n_fields = read_word(&reader);
+    int n_methods = read_word(&reader);
+    int n_inherited = read_word(&reader);
+    int n_imports = read_word(&reader);
+    int n_constants = read_word(&reader);
+    int n_code = read_word(&reader);
+    char *class_name = read_string(&reader);
+    char *super_name = read_string(&reader);
+
+    // Imports are mapped once this class is loaded, so it can reference itself
+    char **imports = malloc(n_imports * sizeof(char *));
+    for (int i = 0; i < n_imports; ++i) {
+        imports[i] = read_string(&reader);
+    }
+    // Method and field names are only there for tools
+    for (int i = 0; i < n_methods + n_fields; ++i) {
+        read_string(&reader);
+    }
+
+    /* module constant index -> global constant index */
+    int *constant_renumber_map = malloc(n_constants * sizeof(int));
+    for (int i = 0; i < n_constants; ++i) {
+        int kind = read_word(&reader);
+        char *literal = read_string(&reader);
+        int internal = 0;
+        if (kind == 'i') {
+            internal = int_literal_const(literal);
+        } else if (kind == 's') {
+            internal = str_literal_const(literal);
+        } else {
+            log_error("Constant of unknown type");
+        }
+        constant_renumber_map[i] = internal;
+        log_debug("Literal %s internal %d remapped to %d",
+                  literal, i, internal);
+    }
+
+    class_ref the_super = ensure_loaded(super_name);
+    assert(the_super); // Error if we can't find the superclass
+    class_ref the_class = create_class(class_name, the_super,
+                                       n_fields, n_methods, n_inherited);
+
+    /* module class index -> class reference,
+     * with potential side effect of loading more class files.
+     */
+    class_ref *class_map = malloc(n_imports * sizeof(class_ref));
+    for (int i = 0; i < n_imports; ++i) {
+        class_map[i] = ensure_loaded(imports[i]);
+    }
+
+    for (int i = 0; i < n_code; ++i) {
+        char *method_name = read_string(&reader);
+        int method_slot = read_word(&reader);
+        int n_words = read_word(&reader);
+        int32_t *words = read_words(&reader, n_words);
+        log_debug("Method %s slot %d is %d words", method_name, method_slot, n_words);
+        the_class->vtable[method_slot] = translate_method_words(
+                words, n_words, constant_renumber_map, class_map);
+    }
+    free(imports);
+    free(constant_renumber_map);
+    free(class_map);
+    return 1;
+}
+
+/* A prelinked image (see IMAGE_MAGIC in vm_loader.h) holds a whole
+ * program.  Constants index one pool and classes one class table,
+ * superclasses first, with vtables already laid out, so it is loaded
+ * in one pass with no searching or recursive loads.  Like binary
+ * object files, it is read in place and kept.
+ */
+static int load_image(char *data, size_t size) {
+    struct object_reader reader = {.at = data, .end = data + size};
+    read_words(&reader, OBJECT_MAGIC_WORDS);
+    int version = read_word(&reader);
+    if (version != IMAGE_VERSION) {
+        log_error("Image version %d, expected version %d",
+                  version, IMAGE_VERSION);
+        return 0;
+    }
+    int n_classes = read_word(&reader);
+    int n_constants = read_word(&reader);
+    int n_words = read_word(&reader);
+
+    /* image constant index -> global constant index */
+    int *constant_map = malloc(n_constants * sizeof(int));
+    for (int i = 0; i < n_constants; ++i) {
+        int kind = read_word(&reader);
+        char *literal = read_string(&reader);
+        constant_map[i] = (kind == 'i') ? int_literal_const(literal)
+                                        : str_literal_const(literal);
+    }
+
+    // Method code will be placed here, in the order of the image
+    vm_Word *code_start = vm_current_address();
+    class_ref *class_table = malloc(n_classes * sizeof(class_ref));
+    for (int i = 0; i < n_classes; ++i) {
+        char *class_name = read_string(&reader);
+        int super_index = read_word(&reader);
+        int n_fields = read_word(&reader);
+        int n_methods = read_word(&reader);
+        if (super_index < 0) {
+            // Built in class
+            class_table[i] = find_loaded(class_name);
+            assert(class_table[i]);
+            continue;
+        }
+        assert(super_index < i);
+        class_ref the_super = class_table[super_index];
+        class_ref the_class = create_class(class_name, the_super,
+                                           n_fields, n_methods, 0);
+        int32_t *vtable = read_words(&reader, n_methods);
+        for (int slot = 0; slot < n_methods; ++slot) {
+            if (vtable[slot] >= 0) {
+                the_class->vtable[slot] = code_start + vtable[slot];
+            } else if (vtable[slot] == IMAGE_INHERITED) {
+                the_class->vtable[slot] = the_super->vtable[slot];
+            } else {
+                the_class->vtable[slot] = 0;
+            }
+        }
+        class_table[i] = the_class;
+    }
+
+    int32_t *words = read_words(&reader, n_words);
+    translate_method_words(words, n_words, constant_map, class_table);
+    log_info("Loaded image of %d classes, %d constants and %d code words",
+             n_classes, n_constants, n_words);
+    free(constant_map);
+    free(class_table);
+    return 1;
+}
+
+/* Translate one operation; its operand, if any, is
+ * translated by translate_operand.
+ */
+static void translate_op(int opcode) {
+    log_debug("[%d] Op: %d (%s)",
+           vm_current_address() - vm_code_block,
+           opcode, vm_op_bytecodes[opcode].name);
+    vm_code_block[vm_code_index++] = (vm_Word)
+            {.instr = vm_op_bytecodes[opcode].instr};
+}
+
+static void translate_operand(int opcode, int operand,
+                              int const_map[], class_ref class_map[]) {
+    log_debug("[%d] Operand: %d",
+              vm_current_address() - vm_code_block,
+              operand);
+    if (vm_op_bytecodes[opcode].instr == vm_op_const) {
+        int const_index;
+        if (operand == CODE_FALSE) {
+            const_index = lookup_const_index("$false");
+        } else if (operand == CODE_TRUE) {
+            const_index = lookup_const_index("$true");
+        } else if (operand == CODE_NOTHING) {
+            const_index = lookup_const_index("$nothing");
+        } else {
+            assert(operand >= 0);
+            const_index = const_map[operand];
+        }
+        assert(const_index);
+        check_health_object(get_const_value(const_index));
+        vm_code_block[vm_code_index++] = (vm_Word)
+                {.intval=  const_index};
+    } else if(vm_op_bytecodes[opcode].instr == vm_op_new
+              || vm_op_bytecodes[opcode].instr == vm_op_is_instance) {
+        class_ref clazz = class_map[operand];
+        log_debug("Translating allocation of new '%s'",
+                  clazz->header.class_name);
+        vm_code_block[vm_code_index++] = (vm_Word)
+                {.clazz = clazz};
+    } else if (vm_op_bytecodes[opcode].instr == vm_op_call_direct) {
+        // Patched with the code address in resolve_direct_calls
+        assert(n_direct_calls < MAX_DIRECT_CALLS);
+        direct_calls[n_direct_calls++] = (struct direct_call) {
+                .patch_addr = vm_current_address(),
+                .clazz = class_map[operand >> DIRECT_CALL_SHIFT],
+                .slot = operand & DIRECT_CALL_SLOT_MASK
+        };
+        vm_code_block[vm_code_index++] = (vm_Word)
+                {.code_addr = 0};
+    } else {
+        vm_code_block[vm_code_index++] = (vm_Word)
+                {.intval = operand};
+    }
+}
+
 vm_Word *translate_method_code(cJSON *ops, int const_map[], class_ref class_map[]) {
     // Translating code.  Constants must be renumbered since local
     // constant number is not global constant number.
@@ -312,82 +557,99 @@ vm_Word *translate_method_code(cJSON *ops, int const_map[], class_ref class_map[
     while (el) {
         assert(cJSON_IsNumber(el));
         int opcode = el->valueint;
-        log_debug("[%d] Op: %d (%s)",
-               vm_current_address() - vm_code_block,
-               opcode, vm_op_bytecodes[opcode].name);
-        vm_code_block[vm_code_index++] = (vm_Word)
-                {.instr = vm_op_bytecodes[opcode].instr};
-
+        translate_op(opcode);
         if (vm_op_bytecodes[opcode].n_operands) {
             // Max is 1 operand!
             el = el->next;
-            int operand = el->valueint;
-            log_debug("[%d] Operand: %d",
-                      vm_current_address() - vm_code_block,
-                      operand);
-            if (vm_op_bytecodes[opcode].instr == vm_op_const) {
-                int const_index;
-                if (operand == CODE_FALSE) {
-                    const_index = lookup_const_index("$false");
-                } else if (operand == CODE_TRUE) {
-                    const_index = lookup_const_index("$true");
-                } else if (operand == CODE_NOTHING) {
-                    const_index = lookup_const_index("$nothing");
-                } else {
-                    assert(operand >= 0);
-                    const_index = const_map[operand];
-                }
-                assert(const_index);
-                check_health_object(get_const_value(const_index));
-                vm_code_block[vm_code_index++] = (vm_Word)
-                        {.intval=  const_index};
-            } else if(vm_op_bytecodes[opcode].instr == vm_op_new
-                      || vm_op_bytecodes[opcode].instr == vm_op_is_instance) {
-                class_ref clazz = class_map[operand];
-                log_debug("Translating allocation of new '%s'",
-                          clazz->header.class_name);
-                vm_code_block[vm_code_index++] = (vm_Word)
-                        {.clazz = clazz};
-            } else {
-                vm_code_block[vm_code_index++] = (vm_Word)
-                        {.intval = operand};
-            }
+            translate_operand(opcode, el->valueint, const_map, class_map);
         }
         el = el->next;
     }
     return method_start_address;
 }
 
+vm_Word *translate_method_words(int32_t *words, int n_words,
+                                int const_map[], class_ref class_map[]) {
+    vm_Word *method_start_address = vm_current_address();
+    int i = 0;
+    while (i < n_words) {
+        int opcode = words[i++];
+        translate_op(opcode);
+        if (vm_op_bytecodes[opcode].n_operands) {
+            assert(i < n_words);
+            translate_operand(opcode, words[i++], const_map, class_map);
+        }
+    }
+    return method_start_address;
+}
+
 
 
-/* Load an "object" file (json format) from
- * a class name.
+/* Load an "object" file from a class name, the binary
+ * one if there is one and else the json one.
  */
 #define PATHBUFSIZE 4096
 extern int vm_load_class(char *classname) {
     char load_path[PATHBUFSIZE];
     // Use printf for multi-concat
-    snprintf(load_path, PATHBUFSIZE, "%s/%s.json", PATH_PREFIX, classname);
+    snprintf(load_path, PATHBUFSIZE, "%s/%s.tvmo", PATH_PREFIX, classname);
+    if (access(load_path, R_OK) != 0) {
+        snprintf(load_path, PATHBUFSIZE, "%s/%s.json", PATH_PREFIX, classname);
+    }
+    log_info("Loading %s", load_path);
+    return vm_load_from_path(load_path);
+}
+
+
+/* Load a program from its prelinked image, Main.tvmi, if there
+ * is one, and otherwise its main class and what that imports.
+ */
+extern int vm_load_program(char *main_class) {
+    char load_path[PATHBUFSIZE];
+    snprintf(load_path, PATHBUFSIZE, "%s/%s.tvmi", PATH_PREFIX, main_class);
+    if (access(load_path, R_OK) != 0) {
+        return vm_load_class(main_class);
+    }
     log_info("Loading %s", load_path);
     return vm_load_from_path(load_path);
 }
 
 
 int vm_load_from_path(char *path) {
-    char file_buffer[FILE_BUFFER_CAPACITY];
-    FILE *fd = fopen(path, "r");
-    if (! fd) {
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) {
         perror("Failed to open file");
         return 0;
     }
-    int ok;
-    ok = read_file_fd(fd, file_buffer);
-    if (ok) {
-        cJSON *jobj = cJSON_Parse(file_buffer);
-        ok = (jobj != NULL);
+    struct stat file_stat;
+    if (fstat(fd, &file_stat) != 0 || file_stat.st_size == 0) {
+        perror("Failed to read file");
+        close(fd);
+        return 0;
+    }
+    size_t size = file_stat.st_size;
+    char *data = mmap(NULL, size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);  // The mapping stays
+    if (data == MAP_FAILED) {
+        perror("Failed to map file");
+        return 0;
+    }
+    if (size >= sizeof(OBJECT_MAGIC) - 1
+        && memcmp(data, OBJECT_MAGIC, sizeof(OBJECT_MAGIC) - 1) == 0) {
+        return load_binary(data, size);
+    }
+    if (size >= sizeof(IMAGE_MAGIC) - 1
+        && memcmp(data, IMAGE_MAGIC, sizeof(IMAGE_MAGIC) - 1) == 0) {
+        return load_image(data, size);
     }
-    assert(ok);
-    ok = load_json(file_buffer);
-    fclose(fd);
+    // Otherwise json, which is parsed into a tree we then free
+    cJSON *tree = cJSON_ParseWithLength(data, size);
+    if (tree == NULL) {
+        perror("vm_load_from_path in vm_loader.c: Failed to parse json. ");
+        assert(tree);  // Will definitely abort
+    }
+    int ok = load_json(tree);
+    cJSON_Delete(tree);
+    munmap(data, size);
     return ok;
 }
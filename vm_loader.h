@@ -24,16 +24,40 @@ void vm_loader_set_main(char *main_class_name);
  */
 extern class_ref find_loaded(char *name);
 
-/* Load an "object" file (json format) from
- * a class name.
+/* Load an "object" file from a class name, Class.tvmo
+ * (binary format) if present and otherwise Class.json.
  */
 extern int vm_load_class(char *classname);
 
-/* Load an "object" file, which should be in JSON format.
+/* Load a program by its main class, from the prelinked image
+ * Main.tvmi if present, and otherwise class by class.
+ */
+extern int vm_load_program(char *main_class);
+
+/* Load an "object" file, in the binary format or in JSON,
+ * or a prelinked image.
  * Return 1 = success, 0 = failure.
  */
 extern int vm_load_from_path(char *path);
 
+/* Binary object files start with these 4 bytes, then the
+ * format version.  The layout is described in hw4/assemble.py,
+ * and it MUST be consistent between the loader and the
+ * assembler.  Words are little-endian, like the hosts we run on.
+ */
+#define OBJECT_MAGIC "TVMO"
+#define OBJECT_MAGIC_WORDS 1
+#define OBJECT_VERSION 1
+
+/* Prelinked images, written by hw4/link.py which describes the
+ * layout, start with these 4 bytes and then their version.
+ * A vtable entry is a code offset or one of the markers.
+ */
+#define IMAGE_MAGIC "TVMI"
+#define IMAGE_VERSION 1
+#define IMAGE_INHERITED (-1)
+#define IMAGE_NO_METHOD (-2)
+
 /* Constants in method bytecode will be small non-negative
  * integers corresponding to the "constants" list in the
  * object code json, or chosen from this fixed set of
@@ -46,4 +70,14 @@ extern int vm_load_from_path(char *path);
 #define CODE_FALSE (-2)
 #define CODE_TRUE (-3)
 
+/* The operand of a direct call packs the called class (an
+ * index into the "imports" list, like the operand of new)
+ * and the method's vtable slot, as (class << 16) | slot.
+ * The loader replaces it with the method's code address.
+ *
+ * NOTE:  This MUST be consistent with the assembler too.
+ */
+#define DIRECT_CALL_SHIFT 16
+#define DIRECT_CALL_SLOT_MASK ((1 << DIRECT_CALL_SHIFT) - 1)
+
 #endif //TINY_VM_VM_LOADER_H
@@ -307,3 +307,129 @@ extern void vm_op_store_field() {
     target_obj->fields[field_slot] = value;
     // pop_log_level();
 }
+
+/* =======  Int fast path  =========== */
+
+/* Arithmetic on Ints without pushing a frame and
+ * dispatching to the Int native methods.  The operands
+ * are in the same order as for the call they replace:
+ * receiver on top, argument below it.
+ */
+
+static int vm_pop_int(void) {
+    obj_ref value = vm_eval_pop();
+    assert_is_type(value, the_class_Int);
+    return ((obj_Int) value)->value;
+}
+
+/* [other this] -> [this + other] */
+extern void vm_op_add() {
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    vm_eval_push(new_int(this_value + other_value));
+}
+
+/* [other this] -> [this - other] */
+extern void vm_op_sub() {
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    vm_eval_push(new_int(this_value - other_value));
+}
+
+/* [other this] -> [this * other] */
+extern void vm_op_mul() {
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    vm_eval_push(new_int(this_value * other_value));
+}
+
+/* [other this] -> [this / other]
+ * Like Int:divide, there is no check for division by zero
+ */
+extern void vm_op_div() {
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    vm_eval_push(new_int(this_value / other_value));
+}
+
+/* [this] -> [-this] */
+extern void vm_op_neg() {
+    int this_value = vm_pop_int();
+    vm_eval_push(new_int(-this_value));
+}
+
+/* Int comparison fused with a conditional jump.
+ * Same operand order as the arithmetic above,
+ * followed by the relative jump span as for jump_if.
+ *
+ * jump_if_lt(span): [other this] -> [], jump if this < other
+ */
+
+extern void vm_op_jump_if_eq() {
+    int span = vm_fetch_next().intval;
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    if (this_value == other_value) {
+        vm_relative_jump(span);
+    }
+}
+
+extern void vm_op_jump_if_ne() {
+    int span = vm_fetch_next().intval;
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    if (this_value != other_value) {
+        vm_relative_jump(span);
+    }
+}
+
+extern void vm_op_jump_if_lt() {
+    int span = vm_fetch_next().intval;
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    if (this_value < other_value) {
+        vm_relative_jump(span);
+    }
+}
+
+extern void vm_op_jump_if_le() {
+    int span = vm_fetch_next().intval;
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    if (this_value <= other_value) {
+        vm_relative_jump(span);
+    }
+}
+
+extern void vm_op_jump_if_gt() {
+    int span = vm_fetch_next().intval;
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    if (this_value > other_value) {
+        vm_relative_jump(span);
+    }
+}
+
+extern void vm_op_jump_if_ge() {
+    int span = vm_fetch_next().intval;
+    int this_value = vm_pop_int();
+    int other_value = vm_pop_int();
+    if (this_value >= other_value) {
+        vm_relative_jump(span);
+    }
+}
+
+/* As vm_op_methodcall, but the loader has already
+ * resolved the method to its code address.
+ */
+extern void vm_op_call_direct() {
+    vm_addr method_addr = vm_fetch_next().code_addr;
+    // New "this" will be receiver object
+    vm_addr new_fp = vm_sp;
+    // Save program counter for return
+    vm_frame_push_word((vm_Word) {.code_addr = vm_pc});
+    // Save caller's frame pointer
+    vm_frame_push_word((vm_Word) {.frame_addr = vm_fp});
+    vm_fp = new_fp;
+    vm_pc = method_addr;
+}
@@ -107,5 +107,40 @@ extern void vm_op_load_field();  // Load from field of object
 // store_field n: [value target] -> [], target.fields[n] = value
 extern void vm_op_store_field(); // Store into field of object
 
+/* Int arithmetic without a method call.  The compiler
+ * emits these only when the receiver is statically an Int.
+ * As for a call, the receiver is on top of the stack.
+ *
+ * add: [other this] -> [this + other]
+ * neg: [this] -> [-this]
+ */
+extern void vm_op_add();
+extern void vm_op_sub();
+extern void vm_op_mul();
+extern void vm_op_div();
+extern void vm_op_neg();
+
+/* Int comparison fused with a conditional jump, so
+ * no Boolean is made.  Operands as for the Int
+ * arithmetic above, jump span next in code.
+ *
+ * jump_if_lt(span): [other this] -> [], jump if this < other
+ */
+extern void vm_op_jump_if_eq();
+extern void vm_op_jump_if_ne();
+extern void vm_op_jump_if_lt();
+extern void vm_op_jump_if_le();
+extern void vm_op_jump_if_gt();
+extern void vm_op_jump_if_ge();
+
+/* Call a method directly, without looking in the
+ * vtable.  The compiler only emits this where every
+ * possible receiver has the same method.  Next word
+ * is the method's code address, patched in by the loader.
+ *
+ * vm_op_call_direct(code_addr): [arg, arg, ...,  receiver] -> [result]
+ */
+extern void vm_op_call_direct();
+
 
 #endif //TINY_VM_VM_OPS_H